@@ -21,20 +21,10 @@ kubectl exec "${POD}" -- bash -euc \
   source \"${PROJECT_DIR}/venv/bin/activate\" && \
   echo '==> Running migrations...' && \
   python3 \"${SRC_DIR}/manage.py\" migrate && \
+  python3 \"${SRC_DIR}/manage.py\" createcachetable && \
   echo '==> Collecting static files...' && \
   python3 \"${SRC_DIR}/manage.py\" collectstatic --noinput
 "
 
 echo '==> Restarting webservice...'
 toolforge webservice --backend=kubernetes --mem 4Gi python3.11 restart
-
-echo '==> Pausing briefly to allow the container to start...'
-sleep 10
-
-POD="$(kubectl get pods -n tool-qs-dev -o name| head -n1 | cut -d/ -f2)"
-echo '==> Restarting batches...'
-kubectl exec "${POD}" -- bash -euc \
-"
-  source \"${PROJECT_DIR}/venv/bin/activate\" && \
-  python3 \"${SRC_DIR}/manage.py\" restart_batches
-"
\ No newline at end of file
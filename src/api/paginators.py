@@ -1,3 +1,4 @@
+from rest_framework.pagination import CursorPagination
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.reverse import reverse_lazy
@@ -22,9 +23,17 @@ class CustomPagination(PageNumberPagination):
         )
 
 
-class CustomBatchCommandPagination(PageNumberPagination):
+class CustomBatchCommandPagination(CursorPagination):
+    """
+    Cursor pagination over the command index, so that every page is
+    a range read on (batch, index) instead of an OFFSET scan.
+
+    The total comes from the batch command counters.
+    """
+
     page_size = 100
     max_page_size = 100
+    ordering = "index"
 
     def get_paginated_response(self, data):
         batch = self.request.batch  # We injected batch reference in the view
@@ -34,8 +43,8 @@ class CustomBatchCommandPagination(PageNumberPagination):
                     "next": self.get_next_link(),
                     "previous": self.get_previous_link(),
                 },
-                "total": self.page.paginator.count,
-                "page_size": len(self.page.object_list),
+                "total": batch.total_commands,
+                "page_size": len(self.page),
                 "batch": {
                     "pk": batch.pk,
                     "url": reverse_lazy(
@@ -77,6 +77,7 @@ class BatchCommandListSerializer(serializers.HyperlinkedModelSerializer):
 
     url = serializers.SerializerMethodField()
     action = serializers.SerializerMethodField()
+    label = serializers.SerializerMethodField()
 
     def get_action(self, obj):
         return obj.get_action_display()
@@ -86,6 +87,10 @@ class BatchCommandListSerializer(serializers.HyperlinkedModelSerializer):
             "command-detail", kwargs={"pk": obj.pk}, request=self.context["request"]
         )
 
+    def get_label(self, obj):
+        # Loaded by the view when the labels are requested
+        return getattr(obj, "display_label", None)
+
     class Meta:
         model = BatchCommand
         fields = [
@@ -93,6 +98,7 @@ class BatchCommandListSerializer(serializers.HyperlinkedModelSerializer):
             "pk",
             "index",
             "action",
+            "label",
             "json",
             "response_json",
             "status",
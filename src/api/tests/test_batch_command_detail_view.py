@@ -30,6 +30,15 @@ class BatchCommandDetailViewTest(TestCase):
         response = self.client.get(reverse("command-detail", kwargs={"pk": 1}))
         self.assertEqual(response.status_code, 404)
 
+    def test_preview_command_authenticated_request(self):
+        batch = Batch.objects.create(
+            name="Batch 1", user="myuser", status=Batch.STATUS_PREVIEW
+        )
+        command = BatchCommand.objects.create(batch=batch, index=0, raw="", json={})
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        response = self.client.get(reverse("command-detail", kwargs={"pk": command.pk}))
+        self.assertEqual(response.status_code, 404)
+
     def test_batch_command_authenticated_request(self):
         batch = Batch.objects.create(
             name="Batch 1", user="testuser", status=Batch.STATUS_RUNNING
@@ -1,17 +1,28 @@
+import requests_mock
+
 from django.contrib.auth.models import User
+from django.core.cache import cache as django_cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from rest_framework.authtoken.models import Token
 from rest_framework.reverse import reverse
 from rest_framework.test import APIClient
 
+from core.cache import SharedCache
+from core.client import Client as ApiClient
 from core.models import Batch
 from core.models import BatchCommand
 from core.parsers.v1 import V1CommandParser
+from core.tests.test_api import ApiMocker
+from web.models import Token as WikiToken
 
 
 class BatchCommandDetailViewTest(TestCase):
     def setUp(self):
+        django_cache.clear()
+        SharedCache.clear_all_local()
         self.user = User.objects.create(username="myuser")
         self.token = Token.objects.create(user=self.user)
         self.client = APIClient()
@@ -30,6 +41,13 @@ class BatchCommandDetailViewTest(TestCase):
         response = self.client.get(reverse("command-list", kwargs={"batchpk": 1}))
         self.assertEqual(response.status_code, 404)
 
+    def test_preview_authenticated_request(self):
+        batch = V1CommandParser().parse("My batch", "myuser", "Q1|P1|Q2")
+        batch.save_batch_and_preview_commands(Batch.STATUS_PREVIEW)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        response = self.client.get(reverse("command-list", kwargs={"batchpk": batch.pk}))
+        self.assertEqual(response.status_code, 404)
+
     def test_batch_command_list_authenticated_request(self):
         v1 = V1CommandParser()
         self.assertFalse(Batch.objects.count())
@@ -91,59 +109,75 @@ class BatchCommandDetailViewTest(TestCase):
 
         self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
 
-        response = self.client.get(
-            f"http://testserver/api/v1/batches/{batch.pk}/commands/"
-        )
-        self.assertEqual(response.status_code, 200)
-        data = response.data
-        self.assertEqual(
-            data["links"]["next"],
-            f"http://testserver/api/v1/batches/{batch.pk}/commands/?page=2",
-        )
-        self.assertEqual(data["links"]["previous"], None)
-        self.assertEqual(data["total"], 250)
-        self.assertEqual(data["page_size"], 100)
+        url = f"http://testserver/api/v1/batches/{batch.pk}/commands/"
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.data
+            self.assertEqual(data["total"], 250)
+            self.assertEqual(
+                data["batch"],
+                {"pk": batch.pk, "url": f"http://testserver/api/v1/batches/{batch.pk}/"},
+            )
+            pages.append(data)
+            url = data["links"]["next"]
+
+        self.assertEqual([p["page_size"] for p in pages], [100, 100, 50])
         self.assertEqual(
-            data["batch"],
-            {"pk": batch.pk, "url": f"http://testserver/api/v1/batches/{batch.pk}/"},
+            [c["index"] for p in pages for c in p["commands"]], list(range(0, 250))
         )
+        self.assertEqual(pages[0]["links"]["previous"], None)
+        self.assertIn("?cursor=", pages[1]["links"]["previous"])
 
-        response = self.client.get(
-            f"http://testserver/api/v1/batches/{batch.pk}/commands/?page=2"
-        )
+        response = self.client.get(pages[2]["links"]["previous"])
         self.assertEqual(response.status_code, 200)
-        data = response.data
         self.assertEqual(
-            data["batch"],
-            {"pk": batch.pk, "url": f"http://testserver/api/v1/batches/{batch.pk}/"},
+            [c["index"] for c in response.data["commands"]], list(range(100, 200))
         )
-        self.assertEqual(
-            data["links"]["next"],
-            f"http://testserver/api/v1/batches/{batch.pk}/commands/?page=3",
-        )
-        self.assertEqual(
-            data["links"]["previous"],
-            f"http://testserver/api/v1/batches/{batch.pk}/commands/",
-        )
-        self.assertEqual(data["total"], 250)
-        self.assertEqual(data["page_size"], 100)
 
-        response = self.client.get(
-            f"http://testserver/api/v1/batches/{batch.pk}/commands/?page=3"
-        )
-        self.assertEqual(response.status_code, 200)
-        data = response.data
-        self.assertEqual(
-            data["batch"],
-            {"pk": batch.pk, "url": f"http://testserver/api/v1/batches/{batch.pk}/"},
+    def test_batch_command_list_pages_are_index_ranges(self):
+        batch = Batch.objects.create(name="Paginated batch", user="user")
+        BatchCommand.objects.bulk_create(
+            BatchCommand(batch=batch, json={}, index=i) for i in range(0, 250)
         )
-        self.assertEqual(data["links"]["next"], None)
-        self.assertEqual(
-            data["links"]["previous"],
-            f"http://testserver/api/v1/batches/{batch.pk}/commands/?page=2",
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+
+        url = f"http://testserver/api/v1/batches/{batch.pk}/commands/"
+        url = self.client.get(url).data["links"]["next"]
+        url = self.client.get(url).data["links"]["next"]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.data["commands"][0]["index"], 200)
+        queries = [q["sql"] for q in context.captured_queries]
+        commands = [sql for sql in queries if 'FROM "core_batchcommand"' in sql]
+        self.assertEqual(len(commands), 1)
+        self.assertIn('"core_batchcommand"."index" > 199', commands[0])
+        self.assertNotIn("OFFSET", commands[0])
+        self.assertFalse([sql for sql in queries if "COUNT(" in sql])
+
+    @requests_mock.Mocker()
+    def test_batch_command_list_with_labels(self, mocker):
+        WikiToken.objects.create(user=self.user, value="wikitoken")
+        v1 = V1CommandParser()
+        batch = v1.parse("My batch", "myuser", "CREATE||Q1|P1|12||Q2|P4|9~0.1")
+        batch.save_batch_and_preview_commands()
+        ApiMocker.labels(
+            mocker, ApiClient.from_user(self.user), {"Q1": {"pt": "pt1", "en": "en1"}}
         )
-        self.assertEqual(data["total"], 250)
-        self.assertEqual(data["page_size"], 50)
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        url = reverse("command-list", kwargs={"batchpk": batch.pk})
+
+        response = self.client.get(url)
+        self.assertEqual([c["label"] for c in response.data["commands"]], [None] * 3)
+        self.assertEqual(mocker.call_count, 0)
+
+        for _ in range(2):
+            response = self.client.get(f"{url}?labels=pt")
+            labels = [c["label"] for c in response.data["commands"]]
+            self.assertEqual(labels, [None, "pt1", None])
+        # The second time, the labels were cached
+        self.assertEqual(mocker.call_count, 1)
 
     def test_non_allowed_methods_request(self):
         v1 = V1CommandParser()
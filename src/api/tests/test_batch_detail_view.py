@@ -30,6 +30,14 @@ class BatchDetailViewTest(TestCase):
         response = self.client.get(reverse("batch-detail", kwargs={"pk": 1}))
         self.assertEqual(response.status_code, 404)
 
+    def test_preview_authenticated_request(self):
+        preview = Batch.objects.create(
+            name="Batch 0", user="myuser", status=Batch.STATUS_PREVIEW
+        )
+        self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
+        response = self.client.get(reverse("batch-detail", kwargs={"pk": preview.pk}))
+        self.assertEqual(response.status_code, 404)
+
     def test_initial_empty_batch_authenticated_request(self):
         original = Batch.objects.create(name="Batch 0", user="testuser")
         self.client.credentials(HTTP_AUTHORIZATION="Token " + self.token.key)
@@ -12,6 +12,10 @@ from api.serializers import BatchCommandDetailSerializer
 from api.paginators import CustomPagination
 from api.paginators import CustomBatchCommandPagination
 
+from core.client import Client
+from core.exceptions import NoToken
+from core.exceptions import ServerError
+from core.exceptions import UnauthorizedToken
 from core.models import Batch
 from core.models import BatchCommand
 
@@ -28,7 +32,7 @@ class BatchListView(generics.GenericAPIView, mixins.ListModelMixin):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        queryset = Batch.objects.all().order_by("-created")
+        queryset = Batch.objects.visible().order_by("-created")
         user = self.request.query_params.get("username")
         if user is not None:
             queryset = queryset.filter(user=user)
@@ -49,36 +53,13 @@ class BatchDetailView(generics.GenericAPIView, mixins.RetrieveModelMixin):
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
 
-    queryset = Batch.objects.all()
+    queryset = Batch.objects.visible()
     serializer_class = BatchDetailSerializer
 
     def get_object(self):
-        from django.db.models import Q, Count
-
+        # The command counters are kept in the batch
         try:
-            error_commands = Count(
-                "batchcommand", filter=Q(batchcommand__status=BatchCommand.STATUS_ERROR)
-            )
-            initial_commands = Count(
-                "batchcommand",
-                filter=Q(batchcommand__status=BatchCommand.STATUS_INITIAL),
-            )
-            running_commands = Count(
-                "batchcommand",
-                filter=Q(batchcommand__status=BatchCommand.STATUS_RUNNING),
-            )
-            done_commands = Count(
-                "batchcommand", filter=Q(batchcommand__status=BatchCommand.STATUS_DONE)
-            )
-            batch = (
-                Batch.objects.annotate(error_commands=error_commands)
-                .annotate(initial_commands=initial_commands)
-                .annotate(running_commands=running_commands)
-                .annotate(done_commands=done_commands)
-                .annotate(total_commands=Count("batchcommand"))
-                .get(pk=self.kwargs["pk"])
-            )
-            return batch
+            return Batch.objects.visible().get(pk=self.kwargs["pk"])
         except Batch.DoesNotExist:
             raise Http404
 
@@ -89,6 +70,9 @@ class BatchDetailView(generics.GenericAPIView, mixins.RetrieveModelMixin):
 class BatchCommandListView(generics.GenericAPIView, mixins.ListModelMixin):
     """
     Batch commands listing. Uses pagination.
+
+    With `?labels=<language>`, the commands have the label of their entity,
+    taken from the shared label cache when possible.
     """
 
     authentication_classes = [
@@ -106,9 +90,20 @@ class BatchCommandListView(generics.GenericAPIView, mixins.ListModelMixin):
             .order_by("index")
         )
 
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        language = self.request.query_params.get("labels")
+        if language and page:
+            try:
+                client = Client.from_user(self.request.user)
+                BatchCommand.load_labels(client, page, language)
+            except (NoToken, UnauthorizedToken, ServerError):
+                pass
+        return page
+
     def get(self, request, *args, **kwargs):
         try:
-            batch = Batch.objects.get(pk=kwargs["batchpk"])
+            batch = Batch.objects.visible().get(pk=kwargs["batchpk"])
             request.batch = batch
         except Batch.DoesNotExist:
             raise Http404
@@ -123,7 +118,10 @@ class BatchCommandDetailView(generics.GenericAPIView, mixins.RetrieveModelMixin)
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
 
-    queryset = BatchCommand.objects.select_related("batch").all()
+    # Previews are only shown to their owner, by the preview page
+    queryset = BatchCommand.objects.select_related("batch").exclude(
+        batch__status=Batch.STATUS_PREVIEW
+    )
     serializer_class = BatchCommandDetailSerializer
 
     def get(self, request, *args, **kwargs):
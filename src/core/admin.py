@@ -2,6 +2,7 @@ from django.contrib import admin
 
 from core.models import Batch
 from core.models import BatchCommand
+from core.models import BatchImport
 
 
 @admin.register(BatchCommand)
@@ -26,3 +27,21 @@ class BatchAdmin(admin.ModelAdmin):
     list_display = ["id", "name", "user", "status", "created", "modified"]
     search_field = ["name", "user"]
     list_filter = ["status", "created", "modified"]
+
+
+@admin.register(BatchImport)
+class BatchImportAdmin(admin.ModelAdmin):
+    list_select_related = ["batch"]
+    list_display = [
+        "id",
+        "batch",
+        "batch_type",
+        "status",
+        "parsed_lines",
+        "total_lines",
+        "created",
+        "modified",
+    ]
+    list_filter = ["status", "created", "modified"]
+    raw_id_fields = ["batch"]
+    readonly_fields = ["source_file"]
@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache as django_cache
+
+# Stored in place of values that are known not to exist
+NOT_FOUND = "__not_found__"
+
+
+class SharedCache:
+    """
+    Cache shared by every client, thread and process.
+
+    An in-process LRU, bounded by `max_size` entries, sits in front of the
+    Django cache backend. It is only shared between processes when the
+    backend is, like the database cache configured by default. Both levels
+    expire entries after `ttl` seconds, or `not_found_ttl` seconds for
+    values stored with `set_not_found`.
+
+    Counts hits and misses, for both levels combined.
+    """
+
+    _instances = []
+
+    def __init__(self, prefix: str, ttl: int, not_found_ttl: int, max_size: int):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.max_size = max_size
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        SharedCache._instances.append(self)
+
+    def __str__(self):
+        return f"SharedCache {self.prefix}"
+
+    def shared_key(self, key):
+        return f"qsts3:{self.prefix}:{key}"
+
+    def get(self, key):
+        """
+        Returns the cached value, `NOT_FOUND` or None when it is not cached.
+        """
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self.local.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.local[key]
+
+        # Stored with the time it expires at, shared by every process, so
+        # that it's not kept locally for longer than what is left of its TTL
+        entry = django_cache.get(self.shared_key(key))
+        remaining = 0
+        if entry is not None:
+            expires, value = entry
+            remaining = expires - time.time()
+        with self.lock:
+            if remaining <= 0:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._set_local(key, value, remaining)
+        return value
+
+    def set(self, key, value):
+        self._set(key, value, self.ttl)
+
+    def set_not_found(self, key):
+        self._set(key, NOT_FOUND, self.not_found_ttl)
+
+    def _set(self, key, value, ttl):
+        django_cache.set(self.shared_key(key), (time.time() + ttl, value), ttl)
+        self._set_local(key, value, ttl)
+
+    def _set_local(self, key, value, ttl):
+        with self.lock:
+            self.local[key] = (time.monotonic() + ttl, value)
+            self.local.move_to_end(key)
+            while len(self.local) > self.max_size:
+                self.local.popitem(last=False)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "local": len(self.local)}
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @classmethod
+    def clear_all_local(cls):
+        """
+        Empties the in-process level of every cache.
+        """
+        for instance in cls._instances:
+            instance.clear_local()
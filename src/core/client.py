@@ -1,15 +1,24 @@
+import os
 import requests
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+from itertools import islice
+from typing import Iterable
 from typing import List
 
-from django.core.cache import cache as django_cache
 from django.conf import settings
 from django.contrib.auth.models import User
+from requests.adapters import HTTPAdapter
 from requests.exceptions import HTTPError
 
 from web.models import Token
 from web.oauth import oauth
 
+from .cache import NOT_FOUND
+from .cache import SharedCache
+from .exceptions import EditConflict
 from .exceptions import EntityTypeNotImplemented
 from .exceptions import NonexistantPropertyOrNoDataType
 from .exceptions import UserError
@@ -22,49 +31,80 @@ from .exceptions import NoValueTypeForThisDataType
 logger = logging.getLogger("qsts3")
 
 
-def cache_with_first_arg(cache_name):
-    """
-    Returns a decorator that caches the value in a dictionary cache with `cache_name`,
-    using as key the first argument of the method.
-
-    If there is not first argument or first keyword argument, it uses a generic key.
-    """
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
 
-    def decorator(method):
-        def wrapper(self, *args, **kwargs):
-            if not hasattr(self, cache_name):
-                setattr(self, cache_name, {})
 
-            if len(args) >= 1:
-                key = args[0]
-            elif len(kwargs) >= 1:
-                key = next(iter(kwargs.values()))
-            else:
-                key = "key"
+def http_session() -> requests.Session:
+    """
+    Returns the HTTP session shared by every client of this process,
+    keeping the connections to the API alive between requests.
 
-            cache = getattr(self, cache_name)
+    A forked process gets a new one, so that connections are not shared.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            _session = new_http_session()
+            _session_pid = os.getpid()
+        return _session
 
-            if cache.get(key) is not None:
-                return cache.get(key)
-            else:
-                value = method(self, *args, **kwargs)
-                cache[key] = value
-                return value
 
-        return wrapper
+def new_http_session() -> requests.Session:
+    """
+    Returns a session with a pool of `settings.HTTP_POOL_SIZE`
+    connections per host.
 
-    return decorator
+    Responses can come compressed with gzip. The session does not keep
+    cookies: it is shared between users, which are identified only by
+    the Authorization header of each request.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=settings.HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+# Property value types and the data type to value type mappers
+# are the same for every client and they rarely change.
+property_value_types = SharedCache(
+    "property-value-type",
+    ttl=settings.PROPERTY_CACHE_SECONDS,
+    not_found_ttl=settings.PROPERTY_CACHE_NOT_FOUND_SECONDS,
+    max_size=settings.PROPERTY_CACHE_LOCAL_SIZE,
+)
+property_data_types = SharedCache(
+    "property-data-types",
+    ttl=settings.PROPERTY_CACHE_SECONDS,
+    not_found_ttl=settings.PROPERTY_CACHE_NOT_FOUND_SECONDS,
+    max_size=10,
+)
+
+# Labels of entities, by wikibase, entity id and language
+entity_labels = SharedCache(
+    "entity-label",
+    ttl=settings.LABEL_CACHE_SECONDS,
+    not_found_ttl=settings.LABEL_CACHE_NOT_FOUND_SECONDS,
+    max_size=settings.LABEL_CACHE_LOCAL_SIZE,
+)
 
 
 class Client:
     BASE_REST_URL = settings.BASE_REST_URL
     ENDPOINT_PROFILE = f"{BASE_REST_URL}/oauth2/resource/profile"
     WIKIBASE_URL = f"{BASE_REST_URL}/wikibase/v1"
+    # Limit of ids in one wbgetentities call
+    MAX_IDS_PER_REQUEST = 50
+    MAX_CONCURRENT_REQUESTS = 4
+    # Error codes of the Wikibase REST API meaning that there's no such property
+    PROPERTY_NOT_FOUND_CODES = ["property-not-found", "invalid-property-id"]
 
     def __init__(self, token: Token):
         self.token = token
-        self.value_type_cache = {}
-        self.labels_cache = {}
 
     def __str__(self):
         return "API Client with token [redacted]"
@@ -113,6 +153,7 @@ class Client:
             new_token = oauth.mediawiki.fetch_access_token(
                 grant_type="refresh_token",
                 refresh_token=self.token.refresh_token,
+                timeout=settings.HTTP_TIMEOUT_SECONDS,
             )
         except HTTPError:
             raise UnauthorizedToken()
@@ -123,6 +164,10 @@ class Client:
     # Utilities
     # ----
 
+    @property
+    def session(self):
+        return http_session()
+
     def headers(self):
         return {
             "User-Agent": "QuickStatements 3.0",
@@ -133,7 +178,9 @@ class Client:
     def get(self, url):
         logger.debug(f"Sending GET request at {url}")
         self.refresh_token_if_needed()
-        response = requests.get(url, headers=self.headers())
+        response = self.session.get(
+            url, headers=self.headers(), timeout=settings.HTTP_TIMEOUT_SECONDS
+        )
         self.raise_for_status(response)
         return response
 
@@ -141,6 +188,8 @@ class Client:
         status = response.status_code
         if status == 401:
             raise UnauthorizedToken()
+        if status == 412:
+            raise EditConflict()
         if 400 <= status <= 499:
             j = response.json()
             raise UserError(status, j.get("code"), j.get("message"), j)
@@ -200,9 +249,23 @@ class Client:
         Sends a request to the Wikibase REST API, using the provided
         endpoint, method and json body.
         """
+        return self.wikibase_request_with_revision(method, endpoint, body)[0]
+
+    def wikibase_request_with_revision(self, method, endpoint, body, revision=None):
+        """
+        Same as `wikibase_request_wrapper`, but returns a tuple
+        of the response json and the revision id from the response.
+
+        If `revision` is given, the API only applies the request if the entity
+        is still at that revision, otherwise `EditConflict` is raised.
+        """
+        headers = self.headers()
+        if revision is not None:
+            headers["If-Match"] = f'"{revision}"'
         kwargs = {
             "json": body,
-            "headers": self.headers(),
+            "headers": headers,
+            "timeout": settings.HTTP_TIMEOUT_SECONDS,
         }
 
         url = self.wikibase_url(endpoint)
@@ -211,32 +274,59 @@ class Client:
 
         logger.debug(f"{method} request at {url} | sending with body {body}")
 
-        res = getattr(requests, method.lower())(url, **kwargs)
+        res = self.session.request(method.upper(), url, **kwargs)
 
-        logger.debug(f"{method} request at {url} | response: {res.json()}")
+        logger.debug(f"{method} request at {url} | response: {res.text}")
         self.raise_for_status(res)
-        return res.json()
+        return res.json(), self.response_revision(res)
+
+    @staticmethod
+    def response_revision(response):
+        """
+        Returns the revision id from the ETag header, or None.
+        """
+        etag = response.headers.get("ETag")
+        if not etag:
+            return None
+        return etag.removeprefix("W/").strip('"')
 
     # ---
     # Wikibase GET/reading
     # ---
 
-    @cache_with_first_arg("value_type_cache")
+    def property_cache_key(self, property_id):
+        return f"{self.WIKIBASE_URL}/{property_id}"
+
     def get_property_value_type(self, property_id):
         """
         Returns the expected value type of the property.
 
         Returns the value type as a string.
 
-        Uses a dictionary attribute for caching.
+        Uses the shared property cache, which also
+        remembers the properties that don't exist.
         """
+        key = self.property_cache_key(property_id)
+        cached = property_value_types.get(key)
+        if cached == NOT_FOUND:
+            raise NonexistantPropertyOrNoDataType(property_id)
+        if cached is not None:
+            return cached
+
         endpoint = f"/entities/properties/{property_id}"
         url = self.wikibase_url(endpoint)
 
         try:
             res = self.get(url).json()
             data_type = res["data_type"]
-        except (KeyError, UserError):
+        except KeyError:
+            property_value_types.set_not_found(key)
+            raise NonexistantPropertyOrNoDataType(property_id)
+        except UserError as e:
+            if e.response_code not in self.PROPERTY_NOT_FOUND_CODES:
+                # Rate limits, permissions... say nothing about the property
+                raise
+            property_value_types.set_not_found(key)
             raise NonexistantPropertyOrNoDataType(property_id)
 
         try:
@@ -244,6 +334,7 @@ class Client:
         except KeyError:
             raise NoValueTypeForThisDataType(property_id, data_type)
 
+        property_value_types.set(key, value_type)
         return value_type
 
     def data_type_to_value_type(self, data_type):
@@ -254,20 +345,70 @@ class Client:
 
         - `KeyError` if there is no associated value type.
         """
-        key = f"{self.WIKIBASE_URL}/property-data-types"
-
-        # We are caching this so that we don't need to hit it every time.
-        # We are using the global cache (django cache), instead of
-        # local dictionaries like the other caches, because this is
-        # equal to every client and it is unlikely to change between batches.
-        if django_cache.get(key) is not None:
-            mapper = django_cache.get(key)
-        else:
+        # Equal to every client and unlikely to change between batches
+        mapper = property_data_types.get(self.WIKIBASE_URL)
+        if mapper is None:
             mapper = self.get_property_data_types()
-            django_cache.set(key, mapper)
+            property_data_types.set(self.WIKIBASE_URL, mapper)
 
         return mapper[data_type]
 
+    def prefetch_property_value_types(self, property_ids: Iterable[str]):
+        """
+        Fills the value type cache for many properties at once, using
+        the Action API with up to `MAX_IDS_PER_REQUEST` ids per call,
+        sending `MAX_CONCURRENT_REQUESTS` calls at the same time.
+
+        Properties that don't exist are cached as such. The ones that
+        could not be resolved are left out of the cache, so that
+        `get_property_value_type` asks for them again.
+        """
+        missing = sorted(
+            id
+            for id in set(property_ids)
+            if property_value_types.get(self.property_cache_key(id)) is None
+        )
+        if not missing:
+            return
+        data_types = {}
+        for _, result in self._fetch_in_chunks(missing, self._get_data_types_or_empty):
+            data_types.update(result)
+
+        for property_id, data_type in data_types.items():
+            key = self.property_cache_key(property_id)
+            if data_type is None:
+                property_value_types.set_not_found(key)
+                continue
+            try:
+                property_value_types.set(key, self.data_type_to_value_type(data_type))
+            except KeyError:
+                pass
+
+    def _fetch_in_chunks(self, ids: List[str], fetch) -> list:
+        """
+        Calls `fetch` with up to `MAX_IDS_PER_REQUEST` of `ids` at a time,
+        `MAX_CONCURRENT_REQUESTS` calls at the same time.
+
+        Returns the (chunk, result) pairs, in order.
+        """
+        remaining = iter(ids)
+        chunks = []
+        while chunk := list(islice(remaining, self.MAX_IDS_PER_REQUEST)):
+            chunks.append(chunk)
+
+        # Once, before the threads share the token
+        self.refresh_token_if_needed()
+
+        with ThreadPoolExecutor(max_workers=self.MAX_CONCURRENT_REQUESTS) as executor:
+            return list(zip(chunks, executor.map(fetch, chunks)))
+
+    def _get_data_types_or_empty(self, property_ids: List[str]) -> dict:
+        try:
+            return self.get_multiple_data_types(property_ids)
+        except Exception as e:
+            logger.warning(f"Failed to get data types of {property_ids}: {e}")
+            return {}
+
     def verify_value_type(self, property_id, value_type):
         """
         Verifies if the value type of the property with `property_id` matches `value_type`.
@@ -293,8 +434,16 @@ class Client:
         """
         Returns the entire entity json document.
         """
+        return self.get_entity_and_revision(entity_id)[0]
+
+    def get_entity_and_revision(self, entity_id):
+        """
+        Returns a tuple of the entity json document and its
+        revision id, which is None when the API does not send it.
+        """
         url = self.wikibase_entity_url(entity_id, "")
-        return self.get(url).json()
+        res = self.get(url)
+        return res.json(), self.response_revision(res)
 
     # ---
     # Action API GET/reading
@@ -303,6 +452,36 @@ class Client:
     def action_api_url(self):
         return self.BASE_REST_URL.replace("/w/rest.php", "/w/api.php")
 
+    def get_multiple_data_types(self, property_ids: List[str]) -> dict:
+        """
+        Obtains the data types of multiple properties using the Action API.
+
+        Returns a dictionary with the property ids as keys and the
+        data types as values, None for properties that don't exist.
+        """
+        action_api = self.action_api_url()
+        ids = "|".join(property_ids)
+        params = {
+            "action": "wbgetentities",
+            "format": "json",
+            "props": "datatype",
+            "ids": ids,
+        }
+        logger.debug(f"Sending GET request at {action_api}, datatypes of ids={ids}")
+        res = self.session.get(
+            action_api,
+            headers=self.headers(),
+            params=params,
+            timeout=settings.HTTP_TIMEOUT_SECONDS,
+        )
+        self.raise_for_status(res)
+        entities = res.json().get("entities", {})
+        return {
+            id: entity.get("datatype")
+            for id, entity in entities.items()
+            if "missing" in entity or entity.get("datatype") is not None
+        }
+
     def get_multiple_labels(self, entity_ids: List[str], language: str) -> dict:
         """
         Obtains multiple labels using the Action API.
@@ -326,6 +505,76 @@ class Client:
             f"Sending GET request at {action_api}, languages={languages}, ids={ids}"
         )
         self.refresh_token_if_needed()
-        res = requests.get(action_api, headers=self.headers(), params=params)
+        res = self.session.get(
+            action_api,
+            headers=self.headers(),
+            params=params,
+            timeout=settings.HTTP_TIMEOUT_SECONDS,
+        )
         self.raise_for_status(res)
         return res.json()
+
+    def label_cache_key(self, entity_id, language):
+        return f"{self.WIKIBASE_URL}/{entity_id}/{language}"
+
+    def get_cached_labels(self, entity_ids: Iterable[str], language: str) -> dict:
+        """
+        Same as `get_labels`, with only the labels that are cached,
+        without sending any request.
+        """
+        labels = {}
+        for id in entity_ids:
+            cached = entity_labels.get(self.label_cache_key(id, language))
+            if cached is not None:
+                labels[id] = None if cached == NOT_FOUND else cached
+        return labels
+
+    def get_labels(self, entity_ids: Iterable[str], language: str) -> dict:
+        """
+        Returns a dictionary with the entity ids as keys and their labels
+        in `language`, or in English as a fallback, as values.
+
+        The labels are cached, and only the ones that are not go to the
+        Action API. Entities without a label, or that don't exist, are
+        cached as such and have None as their value.
+
+        The missing labels are requested with up to `MAX_IDS_PER_REQUEST`
+        ids per call, sending `MAX_CONCURRENT_REQUESTS` calls at the same
+        time. The entities of a call that fails have None as their value,
+        and are not cached.
+        """
+        entity_ids = set(entity_ids)
+        labels = self.get_cached_labels(entity_ids, language)
+        missing = sorted(entity_ids - labels.keys())
+        if not missing:
+            return labels
+
+        results = self._fetch_in_chunks(
+            missing, lambda chunk: self._get_labels_or_none(chunk, language)
+        )
+        for chunk, entities in results:
+            for id in chunk:
+                if entities is None:
+                    labels[id] = None
+                    continue
+                response_labels = entities.get(id, {}).get("labels", {})
+                label = response_labels.get(language, {}).get("value", None)
+                if not label:
+                    label = response_labels.get("en", {}).get("value", None)
+                key = self.label_cache_key(id, language)
+                if label:
+                    entity_labels.set(key, label)
+                else:
+                    entity_labels.set_not_found(key)
+                labels[id] = label or None
+
+        return labels
+
+    def _get_labels_or_none(self, entity_ids: List[str], language: str):
+        try:
+            return self.get_multiple_labels(entity_ids, language).get("entities", {})
+        except UnauthorizedToken:
+            raise
+        except Exception as e:
+            logger.warning(f"Failed to get labels of {entity_ids}: {e}")
+            return None
@@ -92,6 +92,13 @@ class ServerError(ApiException):
         return super().__init__(message)
 
 
+class EditConflict(ApiException):
+    def __init__(self, entity_id=None):
+        self.entity_id = entity_id
+        message = "The entity was modified by another edit in the meantime."
+        return super().__init__(message)
+
+
 class EntityTypeNotImplemented(ApiException):
     def __init__(self, entity_id):
         message = f"{entity_id}: entity type not supported"
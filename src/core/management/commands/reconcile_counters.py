@@ -0,0 +1,35 @@
+import logging
+
+from django.core.management.base import BaseCommand
+from core.models import Batch
+
+logger = logging.getLogger("qsts3")
+
+
+class Command(BaseCommand):
+    """
+    Recalculates the command counters of the batches from their commands.
+
+    The send_batches workers already do this periodically for running
+    batches, so this is only needed after changing commands by hand.
+    """
+
+    help = "Recalculate the command counters of the batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Include batches that are not running",
+        )
+
+    def handle(self, *args, **options):
+        if options["all"]:
+            batches = Batch.objects.all()
+        else:
+            batches = Batch.objects.filter(status=Batch.STATUS_RUNNING)
+        count = 0
+        for batch in batches.iterator():
+            batch.reconcile_counters()
+            count += 1
+        logger.info(f"[command] reconcile_counters updated {count} batches")
@@ -1,4 +1,3 @@
-from datetime import datetime
 import logging
 
 from django.core.management.base import BaseCommand
@@ -9,17 +8,15 @@ logger = logging.getLogger("qsts3")
 
 class Command(BaseCommand):
     """
-    Mitigation fix to re-run batches that are blocked in an eternal
-    running state because of a server restart.
+    Puts back into the queue the running batches whose worker stopped
+    sending heartbeats, like after a server restart.
+
+    The send_batches workers already do this periodically, so this is
+    only needed when no worker is running.
     """
 
-    help = "Restart all running batches, after a server restart"
+    help = "Restart running batches whose lease expired"
 
     def handle(self, *args, **options):
-        batches = []
-        for batch in Batch.objects.filter(status=Batch.STATUS_RUNNING):
-            logger.info(f"[{batch}] restarting by server restart...")
-            batch.message = f"Restarted after a server restart: {datetime.now()}"
-            batch.status = Batch.STATUS_INITIAL
-            batches.append(batch)
-        Batch.objects.bulk_update(batches, ["message", "status"])
+        reclaimed = Batch.objects.reclaim_expired()
+        logger.info(f"[command] restart_batches reclaimed {reclaimed} batches")
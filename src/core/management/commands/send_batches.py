@@ -1,50 +1,117 @@
 import logging
+import os
+import socket
 import threading
 import time
 
 from core.models import Batch
+from core.models import BatchImport
+from core.parsers.imports import run_import
+from core.parsers.parallel import enable_pool
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.db import connection
 
 logger = logging.getLogger("qsts3")
 
 
-def process_batches(batches):
-    for batch in batches.iterator():
+def worker_id(number):
+    """
+    Returns an identifier that is unique between hosts, processes and threads.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}:{number}"
+
+
+def process_batches(worker, timeout=2, until_empty=False):
+    """
+    Claims and runs batches until there are no more batches to claim,
+    when `until_empty` is True, or forever, sleeping `timeout` seconds
+    when idle.
+
+    The imports of large new batches are parsed first, since
+    their owners are waiting for the preview.
+
+    Batches and imports whose lease expired, because their worker crashed,
+    are put back into the queue every `settings.BATCH_RECLAIM_SECONDS`.
+
+    The command counters of the running batches are recalculated,
+    and the previews that were never started are deleted,
+    every `settings.BATCH_RECONCILE_SECONDS`.
+    """
+    last_reclaim = -settings.BATCH_RECLAIM_SECONDS
+    last_reconcile = time.monotonic()
+    while True:
+        if time.monotonic() - last_reclaim >= settings.BATCH_RECLAIM_SECONDS:
+            Batch.objects.reclaim_expired()
+            BatchImport.objects.reclaim_expired()
+            last_reclaim = time.monotonic()
+
+        if time.monotonic() - last_reconcile >= settings.BATCH_RECONCILE_SECONDS:
+            Batch.objects.reconcile_counters()
+            Batch.objects.delete_expired_previews()
+            last_reconcile = time.monotonic()
+
+        batch_import = BatchImport.objects.claim_next(worker)
+        if batch_import is not None:
+            run_import(batch_import)
+            continue
+
+        batch = Batch.objects.claim_next(worker)
+        if batch is None:
+            if until_empty:
+                return
+            logger.debug(f"[{worker}] No batches to process. Sleeping {timeout}s...")
+            time.sleep(timeout)
+            continue
         try:
             batch.run()
         except Exception as exc:
             logger.exception(f"Failed to process {batch}: {exc}")
+            # Otherwise it is reclaimed once its lease expires,
+            # and fails the same way again, forever
+            batch.block_with_message(f"The batch failed: {exc}")
 
 
 class Command(BaseCommand):
     TIMEOUT_SEC = 2
     help = "Sends all available batches to the Wikidata API"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.SEND_BATCHES_WORKERS,
+            help="Number of batches this process can run at the same time",
+        )
+        parser.add_argument(
+            "--until-empty",
+            action="store_true",
+            help="Exit when there are no batches left to claim",
+        )
+
+    def work(self, worker, until_empty):
+        try:
+            process_batches(worker, self.TIMEOUT_SEC, until_empty)
+        finally:
+            # Each thread has its own database connection
+            connection.close()
+
     def handle(self, *args, **options):
         logger.info("[command] send_batches management command started!")
-        user_threads = {}
-
-        while True:
-            batches = Batch.objects.filter(status=Batch.STATUS_INITIAL)
-            users = batches.values_list("user", flat=True).distinct()
-
-            completed = [u for u, t in user_threads.items() if not t.is_alive()]
-            for user in completed:
-                del user_threads[user]
-
-            for user in users:
-                thread = user_threads.get(user, None)
-                if thread is not None and thread.is_alive():
-                    logger.debug(f"Thread for user {user} is running...")
-                    continue
-
-                user_batches = batches.filter(user=user)
-                thread = threading.Thread(
-                    target=process_batches, daemon=True, args=(user_batches,)
-                )
-                logger.info(f"Starting thread for user {user}...")
-                thread.start()
-                user_threads[user] = thread
-
-            logger.debug(f"No batches to process. Sleeping {self.TIMEOUT_SEC}s...")
-            time.sleep(self.TIMEOUT_SEC)
+        workers = max(1, options["workers"])
+        until_empty = options["until_empty"]
+        enable_pool()
+
+        threads = []
+        for number in range(workers):
+            thread = threading.Thread(
+                target=self.work,
+                daemon=True,
+                args=(worker_id(number), until_empty),
+            )
+            logger.info(f"Starting worker {number}...")
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
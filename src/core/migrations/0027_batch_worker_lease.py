@@ -0,0 +1,23 @@
+# Generated by Django 5.0.9 on 2026-10-17 04:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0026_alter_batchcommand_error_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="lease_expires_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="worker",
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
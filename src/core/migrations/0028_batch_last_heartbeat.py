@@ -0,0 +1,18 @@
+# Generated by Django 5.0.9 on 2026-10-17 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0027_batch_worker_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="last_heartbeat",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
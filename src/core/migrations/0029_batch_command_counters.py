@@ -0,0 +1,71 @@
+# Generated by Django 5.0.9 on 2026-10-17 04:20
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_commands(apps, schema_editor):
+    """
+    Fills the counters of the existing batches
+    """
+    db_alias = schema_editor.connection.alias
+
+    Batch = apps.get_model("core", "Batch")
+    BatchCommand = apps.get_model("core", "BatchCommand")
+
+    fields = {
+        -1: "error_commands",
+        0: "initial_commands",
+        1: "running_commands",
+        2: "done_commands",
+    }
+    counters = {}
+    rows = (
+        BatchCommand.objects.using(db_alias)
+        .order_by()
+        .values("batch_id", "status")
+        .annotate(count=Count("pk"))
+    )
+    for row in rows:
+        values = counters.setdefault(row["batch_id"], {"total_commands": 0})
+        values[fields[row["status"]]] = row["count"]
+        values["total_commands"] += row["count"]
+
+    for batch_id, values in counters.items():
+        Batch.objects.using(db_alias).filter(pk=batch_id).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0028_batch_last_heartbeat"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batch",
+            name="done_commands",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="error_commands",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="initial_commands",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="running_commands",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="batch",
+            name="total_commands",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_commands, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.9 on 2026-10-17 04:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0029_batch_command_counters"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="batchcommand",
+            index=models.Index(
+                fields=["batch", "status", "index"], name="batchcommand_status_idx"
+            ),
+        ),
+    ]
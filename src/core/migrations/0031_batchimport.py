@@ -0,0 +1,62 @@
+# Generated by Django 5.0.9 on 2026-10-17 05:01
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0030_batchcommand_status_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BatchImport",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("batch_type", models.CharField(max_length=8)),
+                ("source", models.TextField(blank=True)),
+                (
+                    "status",
+                    models.IntegerField(
+                        choices=[
+                            (-1, "Error"),
+                            (0, "Initial"),
+                            (1, "Running"),
+                            (2, "Done"),
+                        ],
+                        db_index=True,
+                        default=0,
+                    ),
+                ),
+                ("message", models.TextField(blank=True, null=True)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("modified", models.DateTimeField(auto_now=True)),
+                ("worker", models.CharField(blank=True, max_length=255, null=True)),
+                ("lease_expires_at", models.DateTimeField(blank=True, null=True)),
+                ("total_lines", models.IntegerField(default=0)),
+                ("parsed_lines", models.IntegerField(default=0)),
+                (
+                    "batch",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="batch_import",
+                        to="core.batch",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Batch Import",
+                "verbose_name_plural": "Batch Imports",
+            },
+        ),
+    ]
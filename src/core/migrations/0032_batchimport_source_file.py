@@ -0,0 +1,32 @@
+# Generated by Django 5.0.9 on 2026-10-17 05:27
+
+from django.core.files.base import ContentFile
+from django.db import migrations, models
+
+
+def move_sources_to_files(apps, schema_editor):
+    # Only the imports not parsed yet still have a source
+    BatchImport = apps.get_model("core", "BatchImport")
+    for batch_import in BatchImport.objects.exclude(source="").iterator():
+        content = ContentFile(batch_import.source.encode("utf-8"), "commands.txt")
+        batch_import.source_file.save(content.name, content, save=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0031_batchimport"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="batchimport",
+            name="source_file",
+            field=models.FileField(blank=True, upload_to="imports/"),
+        ),
+        migrations.RunPython(move_sources_to_files, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="batchimport",
+            name="source",
+        ),
+    ]
@@ -1,18 +1,32 @@
 import copy
 import csv
 import logging
+import time
 import jsonpatch
+from collections import Counter
+from collections import OrderedDict
+from itertools import islice
 from typing import Optional
 from typing import List
 from datetime import datetime
+from datetime import timedelta
 from dataclasses import dataclass
 
 from django.conf import settings
+from django.core.files import File
+from django.db import DatabaseError
 from django.db import models
+from django.db import transaction
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import Q
+from django.db.models.fields.json import KT
+from django.utils.timezone import now
 from django.utils.translation import gettext as _
 
 from .client import Client
 from .exceptions import ApiException
+from .exceptions import EditConflict
 from .exceptions import InvalidPropertyValueType
 from .exceptions import NoToken
 from .exceptions import UnauthorizedToken
@@ -45,6 +59,291 @@ class CombiningState:
         return cls(commands=[], entity=None)
 
 
+class CommandBuffer:
+    """
+    Write-behind buffer for the status transitions of the commands of a running batch.
+
+    Commands are kept by primary key, so several transitions of the same
+    command become a single row update. They are written with one `bulk_update`
+    when `size` commands are waiting or `seconds` have passed since the last flush.
+    """
+
+    FIELDS = [
+        "status",
+        "error",
+        "message",
+        "json",
+        "response_json",
+        "value_type_verified",
+        "modified",
+    ]
+
+    def __init__(self, size: Optional[int] = None, seconds: Optional[float] = None):
+        self.size = settings.BATCH_COMMAND_BUFFER_SIZE if size is None else size
+        self.seconds = (
+            settings.BATCH_COMMAND_BUFFER_SECONDS if seconds is None else seconds
+        )
+        self.pending = {}
+        self.last_flush = time.monotonic()
+
+    def add(self, command: "BatchCommand"):
+        # bulk_update does not fill auto_now fields
+        command.modified = now()
+        self.pending[command.pk] = command
+        if (
+            len(self.pending) >= self.size
+            or time.monotonic() - self.last_flush >= self.seconds
+        ):
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            commands = list(self.pending.values())
+            changes = {}
+            for command in commands:
+                changes.setdefault(command.batch_id, Counter())
+                changes[command.batch_id].update(command.counter_changes())
+            with transaction.atomic():
+                BatchCommand.objects.bulk_update(commands, self.FIELDS)
+                for batch_id, batch_changes in changes.items():
+                    Batch.objects.update_counters(batch_id, batch_changes)
+            for command in commands:
+                command.saved_status = command.status
+            self.pending = {}
+        self.last_flush = time.monotonic()
+
+
+class EntityCache:
+    """
+    Entities edited by a running batch, with their revision ids.
+
+    It is seeded from the responses of the edits, which contain the
+    whole entity, so that the next command on the same entity doesn't
+    need to get it again. Only entities with a known revision are kept:
+    edits based on them are sent with that revision, so the API refuses
+    them if someone else edited the entity in the meantime.
+    """
+
+    MAX_ENTITIES = 100
+
+    def __init__(self):
+        self.entities = OrderedDict()
+
+    def get(self, client: Client, entity_id: str):
+        """
+        Returns a copy of the entity json and its revision,
+        from the cache or from the API.
+        """
+        if entity_id in self.entities:
+            self.entities.move_to_end(entity_id)
+            entity, revision = self.entities[entity_id]
+            return copy.deepcopy(entity), revision
+        entity, revision = client.get_entity_and_revision(entity_id)
+        self.set(entity_id, entity, revision)
+        return entity, revision
+
+    def set(self, entity_id: str, entity: dict, revision: Optional[str]):
+        if entity_id is None or revision is None:
+            return
+        self.entities[entity_id] = (copy.deepcopy(entity), revision)
+        self.entities.move_to_end(entity_id)
+        while len(self.entities) > self.MAX_ENTITIES:
+            self.entities.popitem(last=False)
+
+    def invalidate(self, entity_id: str):
+        self.entities.pop(entity_id, None)
+
+    def clear(self):
+        self.entities.clear()
+
+
+class BatchManager(models.Manager):
+    # How many candidate users are tried per claim attempt
+    CLAIM_CANDIDATES = 10
+
+    def claim_next(self, worker: str, lease_seconds: Optional[int] = None):
+        """
+        Atomically claims the oldest INITIAL batch for `worker`.
+
+        The claimed batch is marked as RUNNING, owned by `worker` and leased
+        for `lease_seconds` (defaults to `settings.BATCH_LEASE_SECONDS`).
+
+        Users that already have a RUNNING batch are skipped, so that
+        each user has at most one batch being processed at a time,
+        no matter how many workers there are.
+
+        Returns the claimed batch or None if there is nothing to claim.
+        """
+        if lease_seconds is None:
+            lease_seconds = settings.BATCH_LEASE_SECONDS
+
+        busy_users = self.filter(status=Batch.STATUS_RUNNING).values("user")
+        # Users ordered by their oldest waiting batch
+        candidates = (
+            self.filter(status=Batch.STATUS_INITIAL)
+            .exclude(user__in=busy_users)
+            .values("user")
+            .annotate(oldest=models.Min("pk"))
+            .order_by("oldest")
+            .values_list("user", flat=True)
+        )
+
+        for user in candidates[: self.CLAIM_CANDIDATES]:
+            batch = self._claim_for_user(user, worker, lease_seconds)
+            if batch is not None:
+                return batch
+        return None
+
+    def _claim_for_user(self, user, worker, lease_seconds):
+        """
+        Claims the oldest INITIAL batch of `user`, if the user has no RUNNING batch.
+
+        Every unfinished batch of the user is locked while deciding, which
+        serializes concurrent claims for the same user. If another worker
+        holds the lock, we give up on this user instead of waiting.
+        """
+        try:
+            with transaction.atomic():
+                unfinished = list(
+                    self.select_for_update(nowait=True)
+                    .filter(
+                        user=user,
+                        status__in=[Batch.STATUS_INITIAL, Batch.STATUS_RUNNING],
+                    )
+                    .order_by("pk")
+                    .values_list("pk", "status")
+                )
+                statuses = [status for _, status in unfinished]
+                if Batch.STATUS_RUNNING in statuses or not unfinished:
+                    return None
+                pk = unfinished[0][0]
+                current = now()
+                claimed = self.filter(pk=pk, status=Batch.STATUS_INITIAL).update(
+                    status=Batch.STATUS_RUNNING,
+                    worker=worker,
+                    lease_expires_at=current + timedelta(seconds=lease_seconds),
+                    modified=current,
+                )
+        except DatabaseError as e:
+            logger.debug(f"[{worker}] could not claim a batch for {user}: {e}")
+            return None
+
+        if claimed:
+            batch = self.get(pk=pk)
+            logger.info(f"[{batch}] claimed by {worker}")
+            return batch
+        return None
+
+    def expired(self):
+        """
+        Returns the RUNNING batches whose lease expired.
+
+        Batches without a lease are considered expired.
+        """
+        return self.filter(status=Batch.STATUS_RUNNING).filter(
+            models.Q(lease_expires_at__lt=now())
+            | models.Q(lease_expires_at__isnull=True)
+        )
+
+    def reclaim_expired(self):
+        """
+        Puts back into the queue the batches whose worker stopped sending heartbeats.
+
+        Their RUNNING commands go back to INITIAL, so that the batch
+        is resumed from the first command that is not DONE.
+
+        Returns the number of reclaimed batches.
+        """
+        reclaimed = 0
+        for pk in self.expired().values_list("pk", flat=True):
+            with transaction.atomic():
+                current = now()
+                updated = (
+                    self.expired()
+                    .filter(pk=pk)
+                    .update(
+                        status=Batch.STATUS_INITIAL,
+                        worker=None,
+                        lease_expires_at=None,
+                        message=f"Restarted after its worker stopped responding: {current}",
+                        modified=current,
+                    )
+                )
+                if updated:
+                    restarted = BatchCommand.objects.filter(
+                        batch_id=pk, status=BatchCommand.STATUS_RUNNING
+                    ).update(status=BatchCommand.STATUS_INITIAL, modified=current)
+                    self.update_counters(
+                        pk,
+                        {
+                            BatchCommand.STATUS_RUNNING: -restarted,
+                            BatchCommand.STATUS_INITIAL: restarted,
+                        },
+                    )
+                    logger.info(f"[Batch #{pk}] reclaimed after its lease expired")
+                    reclaimed += updated
+        return reclaimed
+
+    def update_counters(self, batch_id, changes: dict):
+        """
+        Adds to the command counters of the batch.
+
+        `changes` maps command statuses, or "total", to the amount to add.
+        """
+        values = {
+            BatchCommand.COUNTER_FIELDS[key]: F(BatchCommand.COUNTER_FIELDS[key])
+            + amount
+            for key, amount in changes.items()
+            if amount
+        }
+        if values:
+            self.filter(pk=batch_id).update(**values)
+
+    def visible(self):
+        """
+        Returns the batches that are listed, leaving out previews,
+        which are only seen by their owner before starting them.
+        """
+        return self.exclude(status=Batch.STATUS_PREVIEW)
+
+    def delete_expired_previews(self, max_age: Optional[int] = None):
+        """
+        Deletes the previews that were not started in `max_age` seconds
+        (defaults to `settings.BATCH_PREVIEW_SECONDS`), with their commands
+        and the files of their imports.
+
+        Returns the number of deleted batches.
+        """
+        if max_age is None:
+            max_age = settings.BATCH_PREVIEW_SECONDS
+        expired = self.filter(
+            status=Batch.STATUS_PREVIEW,
+            modified__lt=now() - timedelta(seconds=max_age),
+        )
+        deleted = 0
+        for pk in expired.values_list("pk", flat=True):
+            with transaction.atomic():
+                # Locked, so that it can't be started while being deleted
+                preview = self.select_for_update().filter(
+                    pk=pk, status=Batch.STATUS_PREVIEW
+                )
+                if preview.exists():
+                    for batch_import in BatchImport.objects.filter(batch_id=pk):
+                        batch_import.delete_source()
+                    BatchCommand.objects.filter(batch_id=pk).delete()
+                    preview.delete()
+                    deleted += 1
+        return deleted
+
+    def reconcile_counters(self):
+        """
+        Recalculates the command counters of the RUNNING batches,
+        fixing any drift from updates that bypassed them.
+        """
+        for batch in self.filter(status=Batch.STATUS_RUNNING):
+            batch.reconcile_counters()
+
+
 class Batch(models.Model):
     """
     Represents a BATCH, containing multiple commands
@@ -77,6 +376,34 @@ class Batch(models.Model):
     block_on_errors = models.BooleanField(default=False)
     combine_commands = models.BooleanField(default=False)
 
+    # -------
+    # Worker claim fields
+    # -------
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    last_heartbeat = models.DateTimeField(null=True, blank=True)
+
+    # -------
+    # Command counters
+    # -------
+    # Kept up to date when commands are saved, so that
+    # showing the progress of a batch does not count its commands.
+    initial_commands = models.IntegerField(default=0)
+    running_commands = models.IntegerField(default=0)
+    done_commands = models.IntegerField(default=0)
+    error_commands = models.IntegerField(default=0)
+    total_commands = models.IntegerField(default=0)
+
+    COUNTERS = [
+        "initial_commands",
+        "running_commands",
+        "done_commands",
+        "error_commands",
+        "total_commands",
+    ]
+
+    objects = BatchManager()
+
     def __str__(self):
         return f"Batch #{self.pk}"
 
@@ -84,6 +411,40 @@ class Batch(models.Model):
         verbose_name = _("Batch")
         verbose_name_plural = _("Batches")
 
+    def save(self, *args, **kwargs):
+        # The counters are only changed in the database, with
+        # increments, so they are never written from an outdated instance
+        if not self._state.adding and "update_fields" not in kwargs:
+            kwargs["update_fields"] = [
+                f.name
+                for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.COUNTERS
+            ]
+        super().save(*args, **kwargs)
+
+    def reconcile_counters(self):
+        """
+        Recalculates the command counters from the commands.
+        """
+        with transaction.atomic():
+            # Waits for the increments being written
+            Batch.objects.select_for_update().filter(pk=self.pk).exists()
+            counts = dict(
+                BatchCommand.objects.filter(batch_id=self.pk)
+                .order_by()
+                .values("status")
+                .annotate(count=Count("pk"))
+                .values_list("status", "count")
+            )
+            values = {
+                field: counts.get(status, 0)
+                for status, field in BatchCommand.COUNTER_FIELDS.items()
+            }
+            values["total_commands"] = sum(counts.values())
+            Batch.objects.filter(pk=self.pk).update(**values)
+        for field, value in values.items():
+            setattr(self, field, value)
+
     def commands(self):
         return BatchCommand.objects.filter(batch=self).all().order_by("index")
 
@@ -96,8 +457,21 @@ class Batch(models.Model):
         if not self.is_initial_or_running:
             return
 
-        self.start()
+        # Stopped by its owner, or reclaimed by another worker, since the claim
+        if not self.start():
+            return
 
+        self.command_buffer = CommandBuffer()
+        self.entity_cache = EntityCache()
+        try:
+            self.run_commands()
+        finally:
+            self.flush_commands()
+
+    def run_commands(self):
+        """
+        Verifies the value types and sends the commands. Used by `run`.
+        """
         try:
             client = Client.from_username(self.user)
             is_autoconfirmed = client.get_is_autoconfirmed()
@@ -107,28 +481,26 @@ class Batch(models.Model):
             return self.block_is_not_autoconfirmed()
 
         # TODO: if self.verify_value_types_before_running
-        for command in self.commands().filter(value_type_verified=False).iterator():
-            try:
-                command.verify_value_types(client)
-            except (InvalidPropertyValueType, NonexistantPropertyOrNoDataType):
-                if self.block_on_errors:
-                    return self.block_by(command)
+        if not self.verify_value_types(client):
+            return
 
-        last_id = None
+        # The commands below are loaded again, with the verification results
+        self.flush_commands()
+
+        last_id = self.resumed_last_id()
         state = CombiningState.empty()
         commands = self.commands().exclude(status=BatchCommand.STATUS_DONE)
 
         iterator = commands.iterator()
 
         try:
-            current = next(iterator)
+            current = self.attach(next(iterator))
             while current is not None:
-                self.refresh_from_db()
-                if self.is_stopped:
+                if not self.keep_running():
                     # The status changed, so we have to stop
                     return
                 try:
-                    upcoming = next(iterator)
+                    upcoming = self.attach(next(iterator))
                 except StopIteration:
                     upcoming = None
 
@@ -142,6 +514,11 @@ class Batch(models.Model):
                 state = current.final_combining_state
                 if current.action == BatchCommand.ACTION_CREATE:
                     last_id = current.response_id()
+                finished = current.status != BatchCommand.STATUS_RUNNING
+                if finished and not current.is_idempotent():
+                    # Sending it again after a crash would duplicate the edit,
+                    # or fail, so its status is written right away
+                    self.flush_commands()
 
                 current = upcoming
 
@@ -150,20 +527,205 @@ class Batch(models.Model):
 
         self.finish()
 
-    def start(self):
+    def verify_value_types(self, client: Client):
+        """
+        Verifies the value types of all the commands not verified yet.
+
+        The data types of every property used are fetched in bulk first,
+        then the commands are checked against the cache and the ones
+        that pass are marked as verified with a single update.
+
+        Returns False when the batch must not go on: it was stopped
+        or it was blocked by a command with an invalid value type.
+        """
+        unverified = self.commands().filter(value_type_verified=False)
+
+        # Only the json, without building the commands
+        property_ids = set()
+        additions = unverified.filter(action=BatchCommand.ACTION_ADD)
+        for json in additions.values_list("json", flat=True).iterator():
+            if not self.keep_running():
+                return False
+            if json.get("what") == "statement":
+                property_ids.update(BatchCommand.json_properties(json))
+        client.prefetch_property_value_types(property_ids)
+
+        last_index = None
+        keep_going = True
+        for command in unverified.iterator():
+            if not self.keep_running():
+                keep_going = False
+                break
+            self.attach(command)
+            try:
+                command.check_value_types(client)
+            except (InvalidPropertyValueType, NonexistantPropertyOrNoDataType) as e:
+                if not command.is_error_status():
+                    command.error_with_exception(e)
+                if self.block_on_errors:
+                    self.block_by(command)
+                    keep_going = False
+                    break
+            except (UserError, ServerError) as e:
+                # Says nothing about the value types: this command and the
+                # ones after it are verified one by one as they are sent
+                logger.warning(f"[{self}] stopped verifying at {command}: {e}")
+                break
+            last_index = command.index
+
+        if last_index is not None:
+            # The commands that failed are in ERROR once written, so they
+            # are left out without listing them, however many there are
+            self.flush_commands()
+            unverified.filter(index__lte=last_index).exclude(
+                status=BatchCommand.STATUS_ERROR
+            ).update(value_type_verified=True, modified=now())
+        return keep_going
+
+    def resumed_last_id(self):
+        """
+        Returns the id of the item created by the last CREATE command that
+        already ran, for the LAST commands of a run that resumes the batch,
+        or None when there's none or it failed.
+        """
+        create = (
+            self.commands()
+            .filter(action=BatchCommand.ACTION_CREATE)
+            .exclude(status=BatchCommand.STATUS_INITIAL)
+            .order_by("-index")
+            .first()
+        )
+        if create is None or create.status != BatchCommand.STATUS_DONE:
+            return None
+        # Combined commands get the id without a response of their own
+        return create.response_id() or create.entity_id()
+
+    def attach(self, command):
+        """
+        Makes the command share this batch instance,
+        its write buffer and its entity cache.
+        """
+        command.batch = self
+        command.buffer = getattr(self, "command_buffer", None)
+        command.entity_cache = getattr(self, "entity_cache", None)
+        return command
+
+    def flush_commands(self):
+        """
+        Writes the buffered command transitions to the database.
+        """
+        buffer = getattr(self, "command_buffer", None)
+        if buffer is not None:
+            buffer.flush()
+
+    def start(self) -> bool:
+        """
+        Sets the batch as RUNNING, with a new lease, while it is still
+        INITIAL or RUNNING and held by this worker.
+
+        Returns False when it was stopped or taken by another worker.
+        """
         logger.debug(f"[{self}] running...")
-        self.message = f"Batch started processing at {datetime.now()}"
+        message = f"Batch started processing at {datetime.now()}"
+        self.renew_lease()
+        updated = Batch.objects.filter(
+            pk=self.pk,
+            status__in=[self.STATUS_INITIAL, self.STATUS_RUNNING],
+            worker=self.worker,
+        ).update(
+            status=self.STATUS_RUNNING,
+            message=message,
+            last_heartbeat=self.last_heartbeat,
+            lease_expires_at=self.lease_expires_at,
+            modified=now(),
+        )
+        if not updated:
+            logger.info(f"[{self}] stopped or taken from {self.worker}")
+            self.refresh_from_db(fields=["status", "message", "worker"])
+            return False
         self.status = self.STATUS_RUNNING
-        self.save()
+        self.message = message
+        return True
+
+    def renew_lease(self):
+        current = now()
+        self.last_heartbeat = current
+        self.lease_expires_at = current + timedelta(
+            seconds=settings.BATCH_LEASE_SECONDS
+        )
+        self._last_heartbeat_clock = time.monotonic()
+        self._calls_since_heartbeat = 0
+
+    def heartbeat(self):
+        """
+        Refreshes the heartbeat and extends the lease of this batch.
+
+        Returns False when this worker does not hold the batch anymore,
+        because it was stopped or reclaimed by another worker.
+        """
+        self.renew_lease()
+        updated = Batch.objects.filter(
+            pk=self.pk, status=self.STATUS_RUNNING, worker=self.worker
+        ).update(
+            last_heartbeat=self.last_heartbeat,
+            lease_expires_at=self.lease_expires_at,
+        )
+        if not updated:
+            logger.info(f"[{self}] stopped or taken from {self.worker}")
+        return updated > 0
+
+    def keep_running(self):
+        """
+        Returns False when the batch must stop processing, because
+        it was stopped by its owner or another worker holds it now.
+
+        To keep it cheap, the database is checked, with a heartbeat, only after
+        `settings.BATCH_STOP_CHECK_COMMANDS` calls or
+        `settings.BATCH_STOP_CHECK_SECONDS` seconds, whichever comes first.
+        """
+        self._calls_since_heartbeat = getattr(self, "_calls_since_heartbeat", 0) + 1
+        elapsed = time.monotonic() - getattr(self, "_last_heartbeat_clock", 0)
+        if (
+            self._calls_since_heartbeat < settings.BATCH_STOP_CHECK_COMMANDS
+            and elapsed < settings.BATCH_STOP_CHECK_SECONDS
+        ):
+            return True
+        # The commands are never more outdated than the lease
+        self.flush_commands()
+        if self.heartbeat():
+            return True
+        self.refresh_from_db(fields=["status", "message", "worker"])
+        return False
 
     def finish(self):
         logger.info(f"[{self}] finished")
-        self.message = f"Batch finished processing at {datetime.now()}"
-        self.status = self.STATUS_DONE
-        self.save()
+        self.flush_commands()
+        self.end_run(self.STATUS_DONE, f"Batch finished processing at {datetime.now()}")
+
+    def end_run(self, status, message) -> bool:
+        """
+        Writes the final status of a run, only while this worker still holds
+        the batch, so that a worker that lost its lease doesn't overwrite
+        the status set by the new holder, or a stop by the owner.
+
+        Returns False when the batch was not held anymore.
+        """
+        updated = Batch.objects.filter(
+            pk=self.pk, status=self.STATUS_RUNNING, worker=self.worker
+        ).update(status=status, message=message, modified=now())
+        if not updated:
+            logger.info(f"[{self}] stopped or taken from {self.worker}")
+            self.refresh_from_db(fields=["status", "message", "worker"])
+            return False
+        self.status = status
+        self.message = message
+        return True
 
     def stop(self):
-        if not self.is_done:
+        if self.is_preview:
+            # Started only through allow_start, which checks its import
+            logger.debug(f"[{self}] user tried to stop but batch is a preview.")
+        elif not self.is_done:
             logger.debug(f"[{self}] stop...")
             self.message = f"Batch stopped processing by owner at {datetime.now()}"
             self.status = self.STATUS_STOPPED
@@ -196,9 +758,8 @@ class Batch(models.Model):
         self.block_with_message(message)
 
     def block_with_message(self, message):
-        self.message = message
-        self.status = self.STATUS_BLOCKED
-        self.save()
+        self.flush_commands()
+        self.end_run(self.STATUS_BLOCKED, message)
 
     @property
     def is_preview(self):
@@ -242,14 +803,80 @@ class Batch(models.Model):
         else:
             return []
 
-    def save_batch_and_preview_commands(self):
-        self.status = self.STATUS_INITIAL
-        if not self.pk:
-            super(Batch, self).save()
-        if hasattr(self, "_preview_commands"):
-            for batch_command in self._preview_commands:
-                batch_command.batch = self
-                batch_command.save()
+    def save_batch_and_preview_commands(self, status=STATUS_INITIAL, commands=None):
+        """
+        Saves the batch, when it's new, and its preview commands
+        that were not saved yet, in a single transaction.
+
+        `commands` can be given instead, as any iterable, such as the
+        ones returned by the parsers' `iter_commands`, to save commands
+        without keeping them all in memory.
+
+        The commands are inserted in bulk, `settings.BATCH_INSERT_SIZE`
+        at a time. Bulk inserts don't go through `BatchCommand.save`,
+        so the counters are added here.
+        """
+        self.status = status
+        if commands is None:
+            commands = [c for c in self.get_preview_commands() if c._state.adding]
+        commands = iter(commands)
+        changes = Counter()
+        with transaction.atomic():
+            if not self.pk:
+                super(Batch, self).save()
+            while chunk := list(islice(commands, settings.BATCH_INSERT_SIZE)):
+                changes.update(self.insert_commands(chunk))
+            Batch.objects.update_counters(self.pk, changes)
+        self.add_to_counters(changes)
+
+    def insert_commands(self, commands: list) -> Counter:
+        """
+        Inserts new commands of this batch with a single `bulk_create`.
+
+        Returns the changes to the command counters, which are left
+        to the caller, so that they can be added once for many inserts.
+        """
+        changes = Counter()
+        for batch_command in commands:
+            batch_command.batch = self
+            changes[batch_command.status] += 1
+        changes["total"] += len(commands)
+        BatchCommand.objects.bulk_create(commands)
+        return changes
+
+    def add_to_counters(self, changes: dict):
+        """
+        Adds counter changes, already saved, to this instance.
+        """
+        for key, amount in changes.items():
+            field = BatchCommand.COUNTER_FIELDS[key]
+            setattr(self, field, getattr(self, field) + amount)
+
+    def save_preview(self, commands=None):
+        """
+        Saves the batch and its preview commands with the PREVIEW status,
+        so that they are only run after `allow_start`.
+        """
+        self.save_batch_and_preview_commands(self.STATUS_PREVIEW, commands)
+
+    def allow_start(self) -> bool:
+        """
+        Puts a saved preview into the queue, as INITIAL.
+
+        Returns False when the batch was no longer in preview,
+        or while its commands are still being imported.
+        """
+        started = (
+            Batch.objects.filter(pk=self.pk, status=self.STATUS_PREVIEW)
+            .filter(
+                Q(batch_import__isnull=True)
+                | Q(batch_import__status=BatchImport.STATUS_DONE)
+            )
+            .update(status=self.STATUS_INITIAL, modified=now())
+        )
+        if started:
+            self.status = self.STATUS_INITIAL
+        return bool(started)
 
     def wikibase_url(self):
         """
@@ -267,37 +894,78 @@ class Batch(models.Model):
     # REPORT
     # ------
 
-    def write_report(self, csvfile):
-        """
-        Uses `csvfile` as the csv writer's file to write the batch report.
-        """
-        writer = csv.writer(csvfile)
-        writer.writerow(
-            [
-                "batch_id",
+    REPORT_HEADER = [
+        "batch_id",
+        "index",
+        "operation",
+        "status",
+        "error",
+        "message",
+        "entity_id",
+        "raw_input",
+    ]
+
+    # Commands read by each report query
+    REPORT_CHUNK_SIZE = 1000
+
+    def report_rows(self, chunk_size=REPORT_CHUNK_SIZE):
+        """
+        Yields the rows of the batch report, starting with the header.
+
+        The commands are read in chunks of `chunk_size`, each chunk
+        continuing from the last (index, pk) of the previous one, so
+        memory stays constant with the size of the batch.
+
+        Only the report columns are read: the entity id is extracted
+        from the command json by the database.
+        """
+        yield self.REPORT_HEADER
+        statuses = dict(BatchCommand.STATUS_CHOICES)
+        commands = (
+            BatchCommand.objects.filter(batch_id=self.pk)
+            .annotate(item=KT("json__item"), entity=KT("json__entity__id"))
+            .order_by("index", "pk")
+            .values_list(
                 "index",
+                "pk",
                 "operation",
                 "status",
                 "error",
                 "message",
-                "entity_id",
-                "raw_input",
-            ]
+                "item",
+                "entity",
+                "raw",
+                named=True,
+            )
         )
-        for cmd in self.commands():
-            writer.writerow(
-                [
+        chunk = commands
+        while True:
+            rows = list(chunk[:chunk_size])
+            for row in rows:
+                yield [
                     self.pk,
-                    cmd.index,
-                    cmd.operation,
-                    cmd.get_status_display(),
-                    cmd.error,
-                    cmd.message,
-                    cmd.entity_id(),
-                    cmd.raw.replace("\t", "|"),  # tabs are weird in csv
+                    row.index,
+                    row.operation,
+                    statuses[row.status],
+                    row.error,
+                    row.message,
+                    row.item or row.entity,
+                    row.raw.replace("\t", "|"),  # tabs are weird in csv
                 ]
+            if len(rows) < chunk_size:
+                return
+            last = rows[-1]
+            chunk = commands.filter(
+                Q(index__gt=last.index) | Q(index=last.index, pk__gt=last.pk)
             )
 
+    def write_report(self, csvfile):
+        """
+        Uses `csvfile` as the csv writer's file to write the batch report.
+        """
+        writer = csv.writer(csvfile)
+        writer.writerows(self.report_rows())
+
 
 class BatchCommand(models.Model):
     """
@@ -316,6 +984,15 @@ class BatchCommand(models.Model):
         (STATUS_DONE, _("Done")),
     )
 
+    # Batch counter of each status
+    COUNTER_FIELDS = {
+        STATUS_ERROR: "error_commands",
+        STATUS_INITIAL: "initial_commands",
+        STATUS_RUNNING: "running_commands",
+        STATUS_DONE: "done_commands",
+        "total": "total_commands",
+    }
+
     ACTION_CREATE = 0
     ACTION_ADD = 1
     ACTION_REMOVE = 2
@@ -425,21 +1102,77 @@ class BatchCommand(models.Model):
     def __str__(self):
         return f"Batch #{self.batch.pk} Command #{self.pk} ##{self.index}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        command = super().from_db(db, field_names, values)
+        command.saved_status = command.__dict__.get("status")
+        return command
+
+    def counter_changes(self) -> Counter:
+        """
+        Returns how the counters of the batch change when this command is saved.
+        """
+        changes = Counter()
+        if self._state.adding:
+            changes["total"] += 1
+            changes[self.status] += 1
+        else:
+            saved = getattr(self, "saved_status", None)
+            if saved is not None and saved != self.status:
+                changes[saved] -= 1
+                changes[self.status] += 1
+        return changes
+
+    def save(self, *args, **kwargs):
+        changes = self.counter_changes()
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Batch.objects.update_counters(self.batch_id, changes)
+        self.saved_status = self.status
+
+    # Operations whose edit is calculated from the current entity, so that
+    # sending them again, when a crash lost their status, changes nothing
+    IDEMPOTENT_OPERATIONS = [
+        Operation.SET_STATEMENT,
+        Operation.SET_SITELINK,
+        Operation.SET_LABEL,
+        Operation.SET_DESCRIPTION,
+        Operation.ADD_ALIAS,
+    ]
+
+    def is_idempotent(self):
+        """
+        Returns True when the edit of this command, and of the commands
+        combined into it, can be sent again without changing the result.
+        """
+        commands = [self, *getattr(self, "previous_commands", [])]
+        return all(c.operation in self.IDEMPOTENT_OPERATIONS for c in commands)
+
     # -----------------
     # Status-changing methods
     # -----------------
 
+    def save_status(self):
+        """
+        Saves the command through the write buffer of its running batch, if any.
+        """
+        buffer = getattr(self, "buffer", None)
+        if buffer is None or self.pk is None:
+            self.save()
+        else:
+            buffer.add(self)
+
     def start(self):
         logger.debug(f"[{self}] running...")
         self.status = BatchCommand.STATUS_RUNNING
-        self.save()
+        self.save_status()
 
     def finish(self):
         logger.info(f"[{self}] finished")
         self.status = BatchCommand.STATUS_DONE
         if self.is_id_last_or_create_item():
             self.set_entity_id(self.response_id())
-        self.save()
+        self.save_status()
         self.propagate_to_previous_commands()
 
     def error_with_value(self, value: Error, message: str = None):
@@ -455,9 +1188,10 @@ class BatchCommand(models.Model):
 
     def error_with_message(self, message):
         logger.error(f"[{self}] error: {message}")
+        self.forget_entity()
         self.message = message
         self.status = BatchCommand.STATUS_ERROR
-        self.save()
+        self.save_status()
         self.propagate_to_previous_commands()
 
     def propagate_to_previous_commands(self):
@@ -469,7 +1203,7 @@ class BatchCommand(models.Model):
                 cmd.message = cmd.error.label
             elif cmd.is_id_last_or_create_item():
                 cmd.set_entity_id(self.entity_id())
-            cmd.save()
+            cmd.save_status()
 
     # -----------------
     # Entity id methods
@@ -724,7 +1458,7 @@ class BatchCommand(models.Model):
         """
         if self.entity_id() == "LAST" and last_id is not None:
             self.set_entity_id(last_id)
-            self.save()
+            self.save_status()
 
     # -----------------
     # Wikibase API basic methods
@@ -891,7 +1625,7 @@ class BatchCommand(models.Model):
         to save a copy into it, so that the get_previous_entity_json
         method does not have to call the API agian.
         """
-        entity = client.get_entity(self.entity_id())
+        entity = self.fetch_entity(client)
         if getattr(self, "previous_entity_json", None) is None:
             self.previous_entity_json = copy.deepcopy(entity)
         return entity
@@ -914,7 +1648,39 @@ class BatchCommand(models.Model):
         else:
             if self.entity_id() == "LAST":
                 raise LastCouldNotBeEvaluated()
+            return self.fetch_entity(client)
+
+    def fetch_entity(self, client: Client):
+        """
+        Returns the entity json from the batch's entity cache, when
+        running in a batch, or from the API.
+
+        Keeps the revision it is based on, to send along with the edit.
+        """
+        cache = getattr(self, "entity_cache", None)
+        if cache is None:
             return client.get_entity(self.entity_id())
+        entity, self.base_revision = cache.get(client, self.entity_id())
+        return entity
+
+    def remember_entity(self, response: dict, revision: Optional[str]):
+        """
+        Seeds the batch's entity cache with the entity returned by the API.
+
+        Other operations don't return the entity, so nothing cached can be trusted.
+        """
+        cache = getattr(self, "entity_cache", None)
+        if cache is None:
+            return
+        if self.operation_is_combinable() and response.get("id"):
+            cache.set(response["id"], response, revision)
+        else:
+            cache.clear()
+
+    def forget_entity(self):
+        cache = getattr(self, "entity_cache", None)
+        if cache is not None:
+            cache.invalidate(self.entity_id())
 
     def get_previous_entity_json(self, client: Client):
         """
@@ -1110,9 +1876,27 @@ class BatchCommand(models.Model):
         """
         if self.operation == self.Operation.CREATE_PROPERTY:
             raise NotImplementedError()
+        try:
+            return self.send_edit(client)
+        except EditConflict:
+            self.forget_entity()
+            # The combined modifications were based on the outdated entity
+            if getattr(self, "previous_commands", []):
+                raise
+            logger.info(f"[{self}] edit conflict, retrying with the current entity")
+            self.previous_entity_json = None
+            return self.send_edit(client)
+
+    def send_edit(self, client: Client) -> dict:
+        self.base_revision = None
         method, endpoint = self.operation_method_and_endpoint(client)
         body = self.api_body(client)
-        return client.wikibase_request_wrapper(method, endpoint, body)
+        revision = self.base_revision if method == "PATCH" else None
+        response, new_revision = client.wikibase_request_with_revision(
+            method, endpoint, body, revision
+        )
+        self.remember_entity(response, new_revision)
+        return response
 
     # -----------------
     # Auxiliary methods for Wikibase API interaction
@@ -1138,7 +1922,13 @@ class BatchCommand(models.Model):
     # -----------------
 
     @classmethod
-    def load_labels(cls, client: Client, commands: List["BatchCommand"], language="en"):
+    def load_labels(
+        cls,
+        client: Client,
+        commands: List["BatchCommand"],
+        language="en",
+        cached_only=False,
+    ):
         """
         This commands loads labels in the command entity ids
         in the `display_label` attribute.
@@ -1146,29 +1936,59 @@ class BatchCommand(models.Model):
         If there is no label returned from the API, it
         sets `display_label` as None.
 
-        It loops twice through the commands list.
+        The labels come from the shared label cache when possible.
+        With `cached_only`, they come only from the cache.
+
+        Returns the entity ids whose labels were not loaded.
         """
         ids = set()
         for command in commands:
             id = command.entity_id()
             if id is not None and id != "LAST":
-                ids.add(command.entity_id())
-        ids = list(ids)
-        api_json = client.get_multiple_labels(ids, language)
-        entities = api_json.get("entities", {})
+                ids.add(id)
+        if cached_only:
+            labels = client.get_cached_labels(ids, language)
+        else:
+            labels = client.get_labels(ids, language) if ids else {}
         for command in commands:
-            id = command.entity_id()
-            response_labels = entities.get(id, {}).get("labels", {})
-            label = response_labels.get(language, {}).get("value", None)
-            if not label:
-                label = response_labels.get("en", {}).get("value", None)
-            command.display_label = label
+            command.display_label = labels.get(command.entity_id())
+        return sorted(ids - labels.keys())
 
     # -----------------
     # Value type verification
     # -----------------
 
+    def properties_to_verify(self):
+        """
+        Returns the ids of the properties used in the statement,
+        in the qualifiers and in the references.
+        """
+        return self.json_properties(self.json)
+
+    @staticmethod
+    def json_properties(json: dict) -> list:
+        """
+        Returns the ids of the properties used in the json of a
+        statement command, in the qualifiers and in the references.
+        """
+        ids = [json.get("property", "")]
+        ids.extend(q["property"] for q in json.get("qualifiers", []))
+        ids.extend(p["property"] for ref in json.get("references", []) for p in ref)
+        return ids
+
     def verify_value_types(self, client: Client):
+        """
+        Checks the value types and marks the command as verified.
+
+        # Raises
+
+        - InvalidPropertyValueType: when the value type is not valid.
+        """
+        self.check_value_types(client)
+        self.value_type_verified = True
+        self.save_status()
+
+    def check_value_types(self, client: Client):
         """
         Checks if the supplied value type is allowed by the property's required value type.
 
@@ -1195,9 +2015,6 @@ class BatchCommand(models.Model):
                 self.error_with_message(e.message)
                 raise e
 
-        self.value_type_verified = True
-        self.save()
-
     def should_verify_value_types(self):
         """
         Checks if this command needs value type verification.
@@ -1220,3 +2037,231 @@ class BatchCommand(models.Model):
         verbose_name = _("Batch Command")
         verbose_name_plural = _("Batch Commands")
         index_together = ("batch", "index")
+        indexes = [
+            # Commands of a batch by status, in order, and the status counts
+            models.Index(
+                fields=["batch", "status", "index"], name="batchcommand_status_idx"
+            ),
+        ]
+
+
+class BatchImportManager(models.Manager):
+    # How many waiting imports are tried per claim attempt
+    CLAIM_CANDIDATES = 10
+
+    def submit(self, batch: Batch, batch_type: str, source: File) -> "BatchImport":
+        """
+        Saves `batch` as an empty preview, and `source`, a file with its
+        commands as submitted, optionally compressed with gzip, to be
+        parsed by the workers.
+
+        The file is copied to the storage a chunk at a time.
+        """
+        with transaction.atomic():
+            batch.save_preview(commands=[])
+            return self.create(batch=batch, batch_type=batch_type, source_file=source)
+
+    def claim_next(self, worker: str, lease_seconds: Optional[int] = None):
+        """
+        Claims the oldest INITIAL import for `worker`, leased for `lease_seconds`
+        (defaults to `settings.BATCH_LEASE_SECONDS`), as RUNNING.
+
+        Returns the claimed import or None if there is nothing to claim.
+        """
+        if lease_seconds is None:
+            lease_seconds = settings.BATCH_LEASE_SECONDS
+        candidates = (
+            self.filter(status=BatchImport.STATUS_INITIAL)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        for pk in candidates[: self.CLAIM_CANDIDATES]:
+            current = now()
+            claimed = self.filter(pk=pk, status=BatchImport.STATUS_INITIAL).update(
+                status=BatchImport.STATUS_RUNNING,
+                worker=worker,
+                lease_expires_at=current + timedelta(seconds=lease_seconds),
+                modified=current,
+            )
+            if claimed:
+                batch_import = self.select_related("batch").get(pk=pk)
+                logger.info(f"[{batch_import}] claimed by {worker}")
+                return batch_import
+        return None
+
+    def reclaim_expired(self):
+        """
+        Puts back the RUNNING imports whose worker stopped renewing the lease.
+
+        The commands they already inserted are deleted,
+        so that they are parsed again from the start.
+
+        Returns the number of reclaimed imports.
+        """
+        expired = self.filter(
+            status=BatchImport.STATUS_RUNNING, lease_expires_at__lt=now()
+        )
+        reclaimed = 0
+        for pk, batch_id in expired.values_list("pk", "batch_id"):
+            with transaction.atomic():
+                updated = expired.filter(pk=pk).update(
+                    status=BatchImport.STATUS_INITIAL,
+                    worker=None,
+                    lease_expires_at=None,
+                    parsed_lines=0,
+                    modified=now(),
+                )
+                if updated:
+                    BatchCommand.objects.filter(batch_id=batch_id).delete()
+                    Batch.objects.filter(pk=batch_id).update(
+                        **{field: 0 for field in Batch.COUNTERS}
+                    )
+                    logger.info(
+                        f"[Batch import #{pk}] reclaimed after its lease expired"
+                    )
+                    reclaimed += updated
+        return reclaimed
+
+
+class BatchImport(models.Model):
+    """
+    The commands of a new batch, as they were submitted, to be parsed
+    by the workers into the commands of its preview.
+
+    Used for the submissions that are too large to be parsed in the web request.
+    The progress is counted in lines: commands for V1, rows for CSV.
+    """
+
+    STATUS_ERROR = -1
+    STATUS_INITIAL = 0
+    STATUS_RUNNING = 1
+    STATUS_DONE = 2
+
+    STATUS_CHOICES = (
+        (STATUS_ERROR, _("Error")),
+        (STATUS_INITIAL, _("Initial")),
+        (STATUS_RUNNING, _("Running")),
+        (STATUS_DONE, _("Done")),
+    )
+
+    batch = models.OneToOneField(
+        Batch, on_delete=models.CASCADE, related_name="batch_import"
+    )
+    batch_type = models.CharField(max_length=8)
+    # In the storage shared with the workers, deleted once parsed
+    source_file = models.FileField(upload_to="imports/", blank=True)
+    status = models.IntegerField(
+        default=STATUS_INITIAL, choices=STATUS_CHOICES, db_index=True
+    )
+    message = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+
+    total_lines = models.IntegerField(default=0)
+    parsed_lines = models.IntegerField(default=0)
+
+    objects = BatchImportManager()
+
+    def __str__(self):
+        return f"Batch import #{self.pk}"
+
+    class Meta:
+        verbose_name = _("Batch Import")
+        verbose_name_plural = _("Batch Imports")
+
+    @property
+    def is_pending(self):
+        return self.status in [self.STATUS_INITIAL, self.STATUS_RUNNING]
+
+    @property
+    def is_done(self):
+        return self.status == self.STATUS_DONE
+
+    @property
+    def is_error(self):
+        return self.status == self.STATUS_ERROR
+
+    def held(self):
+        """
+        Returns the imports that are still RUNNING in this worker.
+        """
+        return BatchImport.objects.filter(
+            pk=self.pk, status=self.STATUS_RUNNING, worker=self.worker
+        )
+
+    def start(self, total_lines: int) -> bool:
+        self.total_lines = total_lines
+        return self.held().update(total_lines=total_lines, modified=now()) > 0
+
+    def save_commands(self, commands: list, parsed_lines: int) -> bool:
+        """
+        Inserts a chunk of parsed commands with the progress of the import,
+        in a single transaction, and extends the lease.
+
+        Returns False when this worker does not hold the import anymore.
+        """
+        current = now()
+        with transaction.atomic():
+            held = self.held().update(
+                parsed_lines=parsed_lines,
+                lease_expires_at=current
+                + timedelta(seconds=settings.BATCH_LEASE_SECONDS),
+                modified=current,
+            )
+            if not held:
+                logger.info(f"[{self}] taken from {self.worker}")
+                return False
+            changes = self.batch.insert_commands(commands)
+            Batch.objects.update_counters(self.batch_id, changes)
+        self.batch.add_to_counters(changes)
+        self.parsed_lines = parsed_lines
+        return True
+
+    def finish(self):
+        """
+        Marks the import as DONE, dropping the source, which is no longer needed.
+
+        The batch is touched, so that its preview expires counting from now.
+        """
+        with transaction.atomic():
+            if self.held().update(
+                status=self.STATUS_DONE,
+                source_file="",
+                parsed_lines=self.total_lines,
+                modified=now(),
+            ):
+                Batch.objects.filter(pk=self.batch_id).update(modified=now())
+                self.status = self.STATUS_DONE
+                self.delete_source()
+        logger.info(f"[{self}] finished")
+
+    def delete_source(self):
+        """
+        Deletes the file of the source from the storage,
+        once the current transaction is committed.
+        """
+        if self.source_file:
+            storage, name = self.source_file.storage, self.source_file.name
+            transaction.on_commit(lambda: storage.delete(name))
+            self.source_file = ""
+
+    def fail(self, message: str):
+        self.held().update(status=self.STATUS_ERROR, message=message, modified=now())
+        self.status = self.STATUS_ERROR
+        self.message = message
+
+    def progress(self) -> dict:
+        """
+        Returns the progress of the import and the counters of its batch.
+        """
+        return {
+            "status": self.status,
+            "message": self.message,
+            "total_lines": self.total_lines,
+            "parsed_lines": self.parsed_lines,
+            "total_commands": self.batch.total_commands,
+            "error_commands": self.batch.error_commands,
+        }
@@ -1,7 +1,62 @@
 import re
+import string
 
 from decimal import Decimal
 
+# Compiled once, instead of on every call through the regex cache
+ITEM_ID = re.compile(r"^[QM]\d+$")
+PROPERTY_ID = re.compile(r"^P\d+$")
+SOURCE_ID = re.compile(r"^S\d+$")
+LEXEME_ID = re.compile(r"^L\d+$")
+FORM_ID = re.compile(r"^L\d+\-F\d+")
+SENSE_ID = re.compile(r"^L\d+\-S\d+")
+ENTITY_ID = re.compile(r"^[QMPL]\d+$")
+FORM_OR_SENSE_ID = re.compile(r"^L\d+\-[FS]\d+$")
+LABEL = re.compile(r"^L[a-z]{2}$")
+ALIAS = re.compile(r"^A[a-z]{2}$")
+DESCRIPTION = re.compile(r"^D[a-z]{2}$")
+SITELINK = re.compile(r"^S[a-z]+$")
+STATEMENT_RANK = re.compile(r"^R(-|0|\+|deprecated|normal|preferred)$")
+
+STRING_VALUE = re.compile(r'^"(.*)"$')
+MONOLINGUALTEXT_VALUE = re.compile(r'^([a-z_-]+):"(.*)"$')
+URL_VALUE = re.compile(r'^"""(http(s)?:.*)"""$')
+COMMONS_MEDIA_VALUE = re.compile(r'^"""(.*\.(?:jpg|JPG|jpeg|JPEG|png|PNG))"""$')
+EXTERNAL_ID_VALUE = re.compile(r'^"""(.*)"""$')
+TIME_VALUE = re.compile(
+    r"^([+-]{0,1})(\d+)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z\/{0,1}(\d*)(\/J){0,1}$"
+)
+JULIAN_SUFFIX = re.compile(r"/J$")
+PRECISION_SUFFIX = re.compile(r"/\d+$")
+LOCATION_VALUE = re.compile(r"^\@\s*([+-]{0,1}[0-9.]+)\s*\/\s*([+-]{0,1}[0-9.]+)$")
+QUANTITY_VALUE = re.compile(r"^([\+\-]{0,1}\d+(\.\d+){0,1})(U(\d+)){0,1}$")
+QUANTITY_BOUNDS_VALUE = re.compile(
+    r"^([\+\-]{0,1}\d+(\.\d+){0,1})"
+    r"\[([\+\-]{0,1}\d+(\.\d+){0,1}),\s{0,1}"
+    r"([\+\-]{0,1}\d+(\.\d+){0,1})\]"
+    r"(U(\d+)){0,1}$"
+)
+QUANTITY_ERROR_VALUE = re.compile(
+    r"^([\+\-]{0,1}\d+(\.\d+){0,1})\s*~\s*([\+\-]{0,1}\d+(\.\d+){0,1})(U(\d+)){0,1}$"
+)
+
+# Entity types that an entity can have, by its first character,
+# in the order they are checked
+ENTITY_TYPES = {
+    "Q": [("item", ITEM_ID)],
+    "M": [("item", ITEM_ID)],
+    "P": [("property", PROPERTY_ID)],
+    "L": [
+        ("lexeme", LEXEME_ID),
+        ("form", FORM_ID),
+        ("sense", SENSE_ID),
+        ("label", LABEL),
+    ],
+    "A": [("alias", ALIAS)],
+    "D": [("description", DESCRIPTION)],
+    "S": [("sitelink", SITELINK)],
+}
+
 
 class ParserException(Exception):
     def __init__(self, message):
@@ -19,35 +74,35 @@ class BaseParser(object):
         Returns True if value is a valid PROPERTY ID
         PXXXX
         """
-        return value is not None and re.match("^P\\d+$", value) is not None
+        return value is not None and PROPERTY_ID.match(value) is not None
 
     def is_valid_source_id(self, value):
         """
         Returns True if value is a valid SOURCE ID
         SXXXX
         """
-        return value is not None and re.match("^S\\d+$", value) is not None
+        return value is not None and SOURCE_ID.match(value) is not None
 
     def is_valid_lexeme_id(self, value):
         """
         Returns True if value is a valid LEXEME ID
         LXXXX
         """
-        return value is not None and re.match("^L\\d+$", value) is not None
+        return value is not None and LEXEME_ID.match(value) is not None
 
     def is_valid_form_id(self, value):
         """
         Returns True if value is a valid FORM ID
         LXXXX-FXXXX
         """
-        return value is not None and re.match("^L\\d+\\-F\\d+", value) is not None
+        return value is not None and FORM_ID.match(value) is not None
 
     def is_valid_sense_id(self, value):
         """
         Returns True if value is a valid SENSE ID
         LXXXX-SXXXX
         """
-        return value is not None and re.match("^L\\d+\\-S\\d+", value) is not None
+        return value is not None and SENSE_ID.match(value) is not None
 
     def is_valid_item_id(self, value):
         """
@@ -55,10 +110,7 @@ class BaseParser(object):
         QXXXXX
         MXXXXX
         """
-        return value is not None and (
-            re.match("^Q\\d+$", value) is not None
-            or re.match("^M\\d+$", value) is not None
-        )
+        return value is not None and ITEM_ID.match(value) is not None
 
     def is_valid_entity_id(self, value):
         """
@@ -73,8 +125,8 @@ class BaseParser(object):
 
         """
         return value is not None and (
-            re.match(r"^[QMPL]\d+$", value) is not None
-            or re.match(r"^L\d+\-[FS]\d+$", value) is not None
+            ENTITY_ID.match(value) is not None
+            or FORM_OR_SENSE_ID.match(value) is not None
         )
 
     def is_valid_label(self, value):
@@ -83,7 +135,7 @@ class BaseParser(object):
         Len
         Lpt
         """
-        return value is not None and re.match("^L[a-z]{2}$", value) is not None
+        return value is not None and LABEL.match(value) is not None
 
     def is_valid_alias(self, value):
         """
@@ -91,7 +143,7 @@ class BaseParser(object):
         Aen
         Apt
         """
-        return value is not None and re.match("^A[a-z]{2}$", value) is not None
+        return value is not None and ALIAS.match(value) is not None
 
     def is_valid_description(self, value):
         """
@@ -99,14 +151,14 @@ class BaseParser(object):
         Den
         Dpt
         """
-        return value is not None and re.match("^D[a-z]{2}$", value) is not None
+        return value is not None and DESCRIPTION.match(value) is not None
 
     def is_valid_sitelink(self, value):
         """
         Returns True if value is a valid sitelink
         Swiki
         """
-        return value is not None and re.match("^S[a-z]+$", value) is not None
+        return value is not None and SITELINK.match(value) is not None
 
     def is_valid_statement_rank(self, value):
         """
@@ -114,10 +166,7 @@ class BaseParser(object):
         Rdeprecated,  Rnormal,  Rpreferred
         R=, R0, R+
         """
-        return (
-            value is not None
-            and re.match(r"^R(-|0|\+|deprecated|normal|preferred)$", value) is not None
-        )
+        return value is not None and STATEMENT_RANK.match(value) is not None
 
     def get_entity_type(self, entity):
         """
@@ -125,25 +174,13 @@ class BaseParser(object):
         Returns item, property, lexeme, form, sense if its a valid pattern.
         Returns None otherwise
         """
-        if entity is not None:
-            if entity == "LAST" or self.is_valid_item_id(entity):
-                return "item"
-            if self.is_valid_property_id(entity):
-                return "property"
-            if self.is_valid_lexeme_id(entity):
-                return "lexeme"
-            if self.is_valid_form_id(entity):
-                return "form"
-            if self.is_valid_sense_id(entity):
-                return "sense"
-            if self.is_valid_alias(entity):
-                return "alias"
-            if self.is_valid_description(entity):
-                return "description"
-            if self.is_valid_label(entity):
-                return "label"
-            if self.is_valid_sitelink(entity):
-                return "sitelink"
+        if not entity:
+            return None
+        if entity == "LAST":
+            return "item"
+        for entity_type, pattern in ENTITY_TYPES.get(entity[0], []):
+            if pattern.match(entity):
+                return entity_type
         return None
 
     def convert_to_utf8(self, s):
@@ -189,7 +226,7 @@ class BaseParser(object):
 
         Returns None otherwise
         """
-        string_match = re.match(r'^"(.*)"$', v)
+        string_match = STRING_VALUE.match(v)
         if string_match:
             return {
                 "type": "string",
@@ -206,7 +243,7 @@ class BaseParser(object):
 
         Returns None otherwise
         """
-        monolingualtext_match = re.match(r'^([a-z_-]+):"(.*)"$', v)
+        monolingualtext_match = MONOLINGUALTEXT_VALUE.match(v)
         if monolingualtext_match:
             return {
                 "type": "monolingualtext",
@@ -228,7 +265,7 @@ class BaseParser(object):
 
         Returns None otherwise
         """
-        url_match = re.match(r'^"""(http(s)?:.*)"""$', v)
+        url_match = URL_VALUE.match(v)
         if url_match:
             return {
                 # TODO: maybe implement again data_type: url
@@ -245,7 +282,7 @@ class BaseParser(object):
 
         Returns None otherwise
         """
-        url_match = re.match(r'^"""(.*\.(?:jpg|JPG|jpeg|JPEG|png|PNG))"""$', v)
+        url_match = COMMONS_MEDIA_VALUE.match(v)
         if url_match:
             return {
                 # TODO: maybe implement again data_type: commonsMedia
@@ -262,7 +299,7 @@ class BaseParser(object):
 
         Returns None otherwise
         """
-        id_match = re.match(r'^"""(.*)"""$', v)
+        id_match = EXTERNAL_ID_VALUE.match(v)
         if id_match:
             return {
                 # TODO: maybe implement again data_type: commonsMedia
@@ -279,21 +316,18 @@ class BaseParser(object):
 
         Returns None otherwise
         """
-        time_match = re.match(
-            r"^([+-]{0,1})(\d+)-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z\/{0,1}(\d*)(\/J){0,1}$",
-            v,
-        )
+        time_match = TIME_VALUE.match(v)
         if time_match:
             prec = 9
             if time_match.group(8):
                 prec = int(time_match.group(8))
             is_julian = time_match.group(9) is not None
             if is_julian:
-                v = re.sub(r"/J$", "", v)
+                v = JULIAN_SUFFIX.sub("", v)
             return {
                 "type": "time",
                 "value": {
-                    "time": re.sub(r"/\d+$", "", v),
+                    "time": PRECISION_SUFFIX.sub("", v),
                     "precision": prec,
                     "calendarmodel": (
                         "http://www.wikidata.org/entity/Q1985786"
@@ -312,7 +346,7 @@ class BaseParser(object):
 
         Returns None otherwise
         """
-        gps_match = re.match(r"^\@\s*([+-]{0,1}[0-9.]+)\s*\/\s*([+-]{0,1}[0-9.]+)$", v)
+        gps_match = LOCATION_VALUE.match(v)
         if gps_match:
             return {
                 "type": "globecoordinate",
@@ -341,7 +375,7 @@ class BaseParser(object):
         def str_amount(amount):
             return f"+{amount}" if amount >= 0 else f"{amount}"
 
-        quantity_match = re.match(r"^([\+\-]{0,1}\d+(\.\d+){0,1})(U(\d+)){0,1}$", v)
+        quantity_match = QUANTITY_VALUE.match(v)
         if quantity_match:
             amount = Decimal(quantity_match.group(1))
             unit = quantity_match.group(4)
@@ -353,13 +387,7 @@ class BaseParser(object):
                 },
             }
 
-        bounds_match = re.match(
-            r"^([\+\-]{0,1}\d+(\.\d+){0,1})"
-            r"\[([\+\-]{0,1}\d+(\.\d+){0,1}),\s{0,1}"
-            r"([\+\-]{0,1}\d+(\.\d+){0,1})\]"
-            r"(U(\d+)){0,1}$",
-            v,
-        )
+        bounds_match = QUANTITY_BOUNDS_VALUE.match(v)
         if bounds_match:
             value = Decimal(bounds_match.group(1))
             lowerBound = Decimal(bounds_match.group(3))
@@ -375,10 +403,7 @@ class BaseParser(object):
                 },
             }
 
-        quantity_error_match = re.match(
-            r"^([\+\-]{0,1}\d+(\.\d+){0,1})\s*~\s*([\+\-]{0,1}\d+(\.\d+){0,1})(U(\d+)){0,1}$",
-            v,
-        )
+        quantity_error_match = QUANTITY_ERROR_VALUE.match(v)
         if quantity_error_match:
             value = Decimal(quantity_error_match.group(1))
             error = Decimal(quantity_error_match.group(3))
@@ -401,19 +426,42 @@ class BaseParser(object):
         """
         v = v.strip()
         v = v.replace("“", '"').replace("”", '"')  # fixes weird double-quotes
-        for fn in [
-            self.parse_value_somevalue_novalue,
-            self.parse_value_entity,
-            self.parse_value_url,
-            self.parse_value_commons_media_file,
-            self.parse_value_external_id,
-            self.parse_value_monolingualtext,
-            self.parse_value_string,
-            self.parse_value_time,
-            self.parse_value_location,
-            self.parse_value_quantity,
-        ]:
-            ret = fn(v)
+        if not v:
+            return None
+        for name in self.value_parsers(v[0]):
+            ret = getattr(self, name)(v)
             if ret is not None:
                 return ret
         return None
+
+    # The value parsers that can match a value, by its first character,
+    # in the same order as they were tried one after the other
+    NUMBER_VALUE_PARSERS = ["parse_value_time", "parse_value_quantity"]
+    VALUE_PARSERS = {
+        **dict.fromkeys("QMPL", ["parse_value_entity"]),
+        '"': [
+            "parse_value_url",
+            "parse_value_commons_media_file",
+            "parse_value_external_id",
+            "parse_value_string",
+        ],
+        "-": ["parse_value_monolingualtext", *NUMBER_VALUE_PARSERS],
+        "+": NUMBER_VALUE_PARSERS,
+        "@": ["parse_value_location"],
+        **dict.fromkeys(string.digits, NUMBER_VALUE_PARSERS),
+        **dict.fromkeys(
+            string.ascii_lowercase + "_",
+            ["parse_value_somevalue_novalue", "parse_value_monolingualtext"],
+        ),
+    }
+
+    def value_parsers(self, first):
+        """
+        Returns the names of the value parsers that can match
+        a value starting with `first`.
+        """
+        parsers = self.VALUE_PARSERS.get(first)
+        if parsers is None:
+            # Other digits are also matched by "\d"
+            return self.NUMBER_VALUE_PARSERS if first.isdecimal() else []
+        return parsers
@@ -1,13 +1,44 @@
 import re
 import csv
 import io
+from dataclasses import dataclass
+from typing import Optional
 
 from .base import BaseParser
 from .base import ParserException
+from .parallel import iter_parsed
 
 from core.models import Batch
 from core.models import BatchCommand
 
+# Sources, starting a new reference (S) or adding to the last one (s)
+SOURCE_HEADER = re.compile(r"^[Ss]\d+$")
+
+
+@dataclass(frozen=True)
+class Column:
+    """
+    What the cells of a CSV column mean, from its header.
+    """
+
+    QID = "qid"
+    COMMENT = "comment"
+    QUALIFIER = "qualifier"
+    SOURCE = "source"
+    STATEMENT = "statement"
+    TERM = "term"
+    IGNORED = "ignored"
+
+    kind: str
+    # "add" or "remove", for statements and terms
+    action: Optional[str] = None
+    # label, alias, description or sitelink, for terms
+    what: Optional[str] = None
+    # The property, or the language or site of terms
+    name: Optional[str] = None
+    # For sources
+    new_reference: bool = False
+
 
 class CSVCommandParser(BaseParser):
     ADD_WHAT_OP = {
@@ -26,38 +57,41 @@ class CSVCommandParser(BaseParser):
     }
 
     def parse_line(self, row, header):
+        return self.parse_row(row, self.compile_header(header))
+
+    def parse_row(self, row, columns):
+        """
+        Returns the commands of a row, following the columns
+        returned by `compile_header`.
+        """
+        if len(row) > len(columns):
+            raise ParserException("CSV row has more cells than the header")
+
         commands = []
         current_command = None
-        current_property = None
-        current_action = None
-        current_what = None
         current_summary = None
         qid = None
         entity_type = None
 
-        for index, cell in enumerate(row):
+        for column, cell in zip(columns, row):
+            kind = column.kind
             cell_value = cell.strip()
-            current_value = self.parse_value(cell_value)
-            if current_value is None:
-                current_value = {"type": "string", "value": cell_value}
 
-            header_value = header[index]  # HEADER VALUE
-
-            if index == 0:  # That is the QID, alway in the firs column
+            if kind == Column.QID:  # That is the QID, alway in the firs column
                 if not cell_value:
                     # Our qid is empty, so it means we are creating a new item
                     commands.append({"action": "create", "type": "item"})
                     qid = "LAST"
-                    entity_type = self.get_entity_type(qid)
                 else:
                     # Just modifying and existing one
                     qid = cell_value
-                    entity_type = self.get_entity_type(qid)
+                entity_type = self.get_entity_type(qid)
+                continue
 
-            elif not cell_value:
+            if not cell_value or kind == Column.IGNORED:
                 continue  # Empty, does nothing
 
-            elif header_value == "#":
+            if kind == Column.COMMENT:
                 # Our header indicates that this column represents comments
                 # We add the cell value to the last command created
                 if not current_summary:
@@ -67,24 +101,23 @@ class CSVCommandParser(BaseParser):
                 current_command["summary"] = current_summary
                 continue
 
-            elif header_value.startswith("qal"):
+            current_value = self.parse_value(cell_value)
+            if current_value is None:
+                current_value = {"type": "string", "value": cell_value}
+
+            if kind == Column.QUALIFIER:
                 # Our header indicates that this column represents a qualifier
                 # We add the cell value to the last command created
-                qualifier = {
-                    "property": header_value.replace("qal", "P"),
-                    "value": current_value,
-                }
+                qualifier = {"property": column.name, "value": current_value}
                 qualifiers = current_command.get("qualifiers", [])
                 qualifiers.append(qualifier)
                 current_command["qualifiers"] = qualifiers
-                continue
 
-            elif re.match("^[Ss]\\d+$", header_value):
+            elif kind == Column.SOURCE:
                 # Our header indicates that this column represents a source
                 # We add the cell value to the last command created
-                reference = {"property": "P" + header_value[1:], "value": current_value}
-
-                if header_value[0] == "S":
+                reference = {"property": column.name, "value": current_value}
+                if column.new_reference:
                     previous_references = [reference]
                     references = current_command.get("references", [])
                     references.append(previous_references)
@@ -92,6 +125,65 @@ class CSVCommandParser(BaseParser):
                 else:
                     previous_references.append(reference)
 
+            else:
+                # NEW STATEMENT STARTING...
+                current_summary = None
+
+                if kind == Column.STATEMENT:
+                    # We have a property based statement
+                    current_command = {
+                        "action": column.action,
+                        "what": "statement",
+                        "entity": {"type": entity_type, "id": qid},
+                        "property": column.name,
+                        "value": current_value,
+                    }
+
+                else:
+                    # ALIAS, DESCRIPTION, SITELINK or LABEL
+                    current_command = {
+                        "action": column.action,
+                        "what": column.what,
+                        "item": qid,
+                        "value": current_value,
+                    }
+                    if column.what == "sitelink":
+                        current_command["site"] = column.name
+                    else:
+                        current_command["language"] = column.name
+                    # Code expects aliases to be a list of alias, like in v1
+                    if column.what == "alias":
+                        current_value["type"] = "aliases"
+                        current_value["value"] = [current_value["value"]]
+
+                commands.append(current_command)
+
+        return commands
+
+    def compile_header(self, header):
+        """
+        Returns a Column for each cell of a valid header, telling
+        what the cells of that column mean, so that the header
+        is only interpreted once and not for every row.
+        """
+        columns = []
+        for index, header_value in enumerate(header):
+            if index == 0:
+                columns.append(Column(Column.QID))
+            elif header_value == "#":
+                columns.append(Column(Column.COMMENT))
+            elif header_value.startswith("qal"):
+                columns.append(
+                    Column(Column.QUALIFIER, name=header_value.replace("qal", "P"))
+                )
+            elif SOURCE_HEADER.match(header_value):
+                columns.append(
+                    Column(
+                        Column.SOURCE,
+                        name="P" + header_value[1:],
+                        new_reference=header_value[0] == "S",
+                    )
+                )
             else:
                 # Checking action
                 if header_value[0] == "-":
@@ -101,50 +193,22 @@ class CSVCommandParser(BaseParser):
                     action = "add"
 
                 _type = self.get_entity_type(header_value)
-                if _type in ["property", "alias", "description", "label", "sitelink"]:
-                    # NEW STATEMENT STARTING...
-
-                    current_summary = None
-
-                    if _type == "property":
-                        # We have a property based statement
-                        current_property = header_value
-                        current_action = action
-                        current_what = "statement"
-
-                        current_command = {
-                            "action": current_action,
-                            "what": current_what,
-                            "entity": {"type": entity_type, "id": qid},
-                            "property": current_property,
-                            "value": current_value,
-                        }
-
-                    else:
-                        # ALIAS, DESCRIPTION, SITELINK or LABEL
-                        current_action = action
-                        current_what = _type
-                        lang = header_value[1:]
-                        current_command = {
-                            "action": action,
-                            "what": current_what,
-                            "item": qid,
-                            "value": current_value,
-                        }
-                        if current_what == "sitelink":
-                            current_command["site"] = lang
-                        else:
-                            current_command["language"] = lang
-                        # Code expects aliases to be a list of alias, like in v1
-                        if current_command["what"] == "alias":
-                            current_command["value"]["type"] = "aliases"
-                            current_command["value"]["value"] = [
-                                current_command["value"]["value"]
-                            ]
-
-                    commands.append(current_command)
-
-        return commands
+                if _type == "property":
+                    columns.append(
+                        Column(Column.STATEMENT, action=action, name=header_value)
+                    )
+                elif _type in ["alias", "description", "label", "sitelink"]:
+                    columns.append(
+                        Column(
+                            Column.TERM,
+                            action=action,
+                            what=_type,
+                            name=header_value[1:],
+                        )
+                    )
+                else:
+                    columns.append(Column(Column.IGNORED))
+        return columns
 
     def check_header(self, header):
         """
@@ -170,63 +234,90 @@ class CSVCommandParser(BaseParser):
                     raise ParserException("A valid property must precede a comment")
                 elif clean_cell.startswith("qal"):
                     raise ParserException("A valid property must precede a qualifier")
-                elif (clean_cell[0] == "s" or clean_cell[0] == "S") and re.match(
-                    "^[Ss]\\d+$", clean_cell
-                ):
+                elif SOURCE_HEADER.match(clean_cell):
                     raise ParserException("A valid property must precede a source")
         return True
 
-    def parse(self, batch_name, batch_owner, raw_csv):
-        batch = Batch(name=batch_name, user=batch_owner)
+    def row_to_raw(self, row):
+        """
+        Returns the row as a CSV line, stored as the raw text of its commands.
+        """
+        output = io.StringIO()
+        csv.writer(output, lineterminator="").writerow(row)
+        return output.getvalue()
 
-        memory_file = io.StringIO(raw_csv, newline="")
+    def iter_commands(self, source, batch=None, progress=None):
+        """
+        Yields a preview BatchCommand of `batch` for each command of `source`,
+        a string or a text file opened with newline="", row by row.
 
-        first_line = True
-        reader = csv.reader(memory_file, delimiter=",")
-        index = 0
+        Large sources are parsed in parallel, see `iter_parsed`.
+        """
+        if isinstance(source, str):
+            source = io.StringIO(source, newline="")
+
+        reader = csv.reader(source, delimiter=",")
+        header = next(reader, None)
+        if header is None:
+            return
+        self.check_header(header)
+        columns = self.compile_header(header)
+        yield from iter_parsed(
+            self.parse_chunk, reader, batch, columns, progress=progress
+        )
+
+    def count_lines(self, source):
+        """
+        Returns the number of rows of `source`, after the header, without parsing them.
+        """
+        if isinstance(source, str):
+            source = io.StringIO(source, newline="")
+        return max(sum(1 for _ in csv.reader(source, delimiter=",")) - 1, 0)
 
-        for row in reader:
-            if first_line:
-                self.check_header(row)
-                header = row
-                first_line = False
-            else:
-                commands = self.parse_line(row, header)
-                for command in commands:
+    def parse_chunk(self, rows, columns):
+        """
+        Returns the commands of a list of rows, indexed from 0.
+        """
+        batch_commands = []
+        for row in rows:
+            commands = self.parse_row(row, columns)
+            raw = self.row_to_raw(row)
+            for command in commands:
+                action = BatchCommand.ACTION_CREATE
+                operation = None
+                if command["action"] == "add":
+                    action = BatchCommand.ACTION_ADD
+                    what = command.get("what")
+                    operation = self.ADD_WHAT_OP[what]
+                elif command["action"] == "remove":
+                    action = BatchCommand.ACTION_REMOVE
+                    what = command.get("what")
+                    operation = self.REMOVE_WHAT_OP[what]
+                elif command["action"] == "create":
                     action = BatchCommand.ACTION_CREATE
-                    operation = None
-                    if command["action"] == "add":
-                        action = BatchCommand.ACTION_ADD
-                        what = command.get("what")
-                        operation = self.ADD_WHAT_OP[what]
-                    elif command["action"] == "remove":
-                        action = BatchCommand.ACTION_REMOVE
-                        what = command.get("what")
-                        operation = self.REMOVE_WHAT_OP[what]
-                    elif command["action"] == "create":
-                        action = BatchCommand.ACTION_CREATE
-                        if command["type"] == "item":
-                            operation = BatchCommand.Operation.CREATE_ITEM
-                        elif command["type"] == "property":
-                            operation = BatchCommand.Operation.CREATE_PROPERTY
-                    else:
-                        action = BatchCommand.ACTION_MERGE
-
-                    user_summary = command.pop("summary", None)
-
-                    bc = BatchCommand(
-                        batch=batch,
-                        index=index,
-                        json=command,
-                        raw=raw_csv,
-                        action=action,
-                        operation=operation,
-                        status=BatchCommand.STATUS_INITIAL,
-                        user_summary=user_summary,
-                    )
-
-                    batch.add_preview_command(bc)
-
-                    index += 1
+                    if command["type"] == "item":
+                        operation = BatchCommand.Operation.CREATE_ITEM
+                    elif command["type"] == "property":
+                        operation = BatchCommand.Operation.CREATE_PROPERTY
+                else:
+                    action = BatchCommand.ACTION_MERGE
+
+                user_summary = command.pop("summary", None)
+
+                bc = BatchCommand(
+                    index=len(batch_commands),
+                    json=command,
+                    raw=raw,
+                    action=action,
+                    operation=operation,
+                    status=BatchCommand.STATUS_INITIAL,
+                    user_summary=user_summary,
+                )
+                batch_commands.append(bc)
+        return batch_commands
 
+    def parse(self, batch_name, batch_owner, raw_csv):
+        batch = Batch(name=batch_name, user=batch_owner)
+        for bc in self.iter_commands(raw_csv, batch):
+            batch.add_preview_command(bc)
         return batch
@@ -0,0 +1,56 @@
+import logging
+from itertools import islice
+
+from django.conf import settings
+
+from .base import ParserException
+from .csv import CSVCommandParser
+from .uploads import open_upload
+from .v1 import V1CommandParser
+
+logger = logging.getLogger("qsts3")
+
+
+def get_parser(batch_type):
+    """
+    Returns a parser for the batch type: "v1", or else CSV.
+    """
+    if batch_type == "v1":
+        return V1CommandParser()
+    return CSVCommandParser()
+
+
+def run_import(batch_import):
+    """
+    Parses the source of a claimed BatchImport into the commands of its batch.
+
+    The source file is decoded as it is read, once to count its lines and
+    once to parse them, so that memory does not grow with its size.
+    The commands are saved `settings.BATCH_INSERT_SIZE` at a time, each chunk
+    committed with the progress, so that the preview can be shown meanwhile.
+
+    A source that can't be parsed marks the import as ERROR.
+    This function should not fail.
+    """
+    parser = get_parser(batch_import.batch_type)
+    parsed_lines = 0
+
+    def parsed(lines):
+        nonlocal parsed_lines
+        parsed_lines += lines
+
+    try:
+        with batch_import.source_file.open("rb") as upload:
+            if not batch_import.start(parser.count_lines(open_upload(upload))):
+                return
+            source = open_upload(upload)
+            commands = parser.iter_commands(source, batch_import.batch, progress=parsed)
+            while chunk := list(islice(commands, settings.BATCH_INSERT_SIZE)):
+                if not batch_import.save_commands(chunk, parsed_lines):
+                    return
+        batch_import.finish()
+    except ParserException as e:
+        batch_import.fail(e.message)
+    except Exception as e:
+        logger.exception(f"[{batch_import}] failed: {e}")
+        batch_import.fail(str(e))
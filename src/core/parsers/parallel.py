@@ -0,0 +1,142 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import chain
+from itertools import islice
+
+import django
+from django.conf import settings
+
+from core.models import BatchCommand
+
+_pool = None
+_pool_enabled = False
+_pool_lock = threading.Lock()
+
+
+def enable_pool():
+    """
+    Lets this process parse large batches in the pool of parser processes.
+
+    Only the `send_batches` workers do: in the web server, every process
+    would keep a pool of its own, and its executable may not be Python.
+    """
+    global _pool_enabled
+    _pool_enabled = True
+
+
+def get_pool():
+    """
+    Returns the pool of parser processes of this process, started
+    on first use and reused afterwards.
+
+    The processes are spawned, not forked, so that they don't inherit
+    the threads and database connections of the workers. They run
+    `settings.PARSER_EXECUTABLE`.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            context = multiprocessing.get_context("spawn")
+            context.set_executable(settings.PARSER_EXECUTABLE)
+            _pool = ProcessPoolExecutor(
+                settings.PARSER_PROCESSES,
+                mp_context=context,
+                initializer=django.setup,
+            )
+        return _pool
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def command_values(command):
+    return [
+        getattr(command, field.attname) for field in BatchCommand._meta.concrete_fields
+    ]
+
+
+def commands_from_values(values):
+    # Fast path of the model constructor, with the values of every field
+    return [BatchCommand(*command) for command in values]
+
+
+def parse_chunk_values(parse_chunk, chunk, args):
+    """
+    Runs in the parser processes. Model instances are sent back as their
+    field values, which are much cheaper to pickle.
+    """
+    return [command_values(command) for command in parse_chunk(chunk, *args)]
+
+
+def parse_in_pool(parse_chunk, chunks, args):
+    """
+    Yields the number of units and the commands of each chunk,
+    parsed in the pool, in order.
+
+    Only a few chunks per process are sent ahead, so that the
+    input is read as the commands are consumed.
+    """
+    global _pool
+    pool = get_pool()
+    ahead = 2 * settings.PARSER_PROCESSES
+    pending = deque()
+    try:
+        for chunk in chunks:
+            future = pool.submit(parse_chunk_values, parse_chunk, chunk, args)
+            pending.append((len(chunk), future))
+            if len(pending) > ahead:
+                size, future = pending.popleft()
+                yield size, commands_from_values(future.result())
+        while pending:
+            size, future = pending.popleft()
+            yield size, commands_from_values(future.result())
+    except BrokenProcessPool:
+        # A process died: start a new pool next time
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+
+
+def iter_parsed(parse_chunk, units, batch=None, *args, progress=None):
+    """
+    Yields the commands returned by `parse_chunk(chunk, *args)` for each
+    chunk of `units`, the lines or rows of a batch, as commands of `batch`
+    with their index in the whole batch.
+
+    The chunks have `settings.PARSER_CHUNK_SIZE` units. When there are at
+    least `settings.PARSER_PARALLEL_MIN_LINES` units, and the pool was
+    enabled in this process, they are parsed in
+    `settings.PARSER_PROCESSES` processes at the same time.
+
+    `progress`, when given, is called with the number of units of each
+    chunk once all of its commands were yielded.
+    """
+    units = iter(units)
+    head = list(islice(units, settings.PARSER_PARALLEL_MIN_LINES))
+    chunks = chunked(chain(head, units), settings.PARSER_CHUNK_SIZE)
+    parallel = (
+        _pool_enabled
+        and settings.PARSER_PROCESSES > 1
+        and len(head) >= settings.PARSER_PARALLEL_MIN_LINES
+    )
+    if parallel:
+        parsed = parse_in_pool(parse_chunk, chunks, args)
+    else:
+        parsed = ((len(chunk), parse_chunk(chunk, *args)) for chunk in chunks)
+
+    index = 0
+    for size, commands in parsed:
+        for command in commands:
+            command.batch = batch
+            command.index = index
+            index += 1
+            yield command
+        if progress is not None:
+            progress(size)
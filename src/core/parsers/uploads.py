@@ -0,0 +1,91 @@
+import gzip
+import io
+import zlib
+
+from django.conf import settings
+
+from .base import ParserException
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class LimitedStream(io.RawIOBase):
+    """
+    Binary stream over `stream` that raises a ParserException as soon as
+    more than `max_size` bytes or `max_lines` new lines were read from it,
+    before they reach the parsers.
+    """
+
+    def __init__(self, stream, max_size, max_lines):
+        self.stream = stream
+        self.max_size = max_size
+        self.max_lines = max_lines
+        self.size = 0
+        self.lines = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self.stream.read(len(buffer))
+        except (OSError, EOFError, zlib.error) as e:
+            # Corrupt or truncated gzip files
+            raise ParserException(f"The file could not be read: {e}")
+        self.size += len(data)
+        self.lines += data.count(b"\n")
+        if self.size > self.max_size:
+            raise ParserException(f"The file is larger than {self.max_size} bytes")
+        if self.lines > self.max_lines:
+            raise ParserException(f"The file has more than {self.max_lines} lines")
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def is_gzip(upload):
+    upload.seek(0)
+    magic = upload.read(len(GZIP_MAGIC))
+    upload.seek(0)
+    return magic == GZIP_MAGIC
+
+
+def upload_size(upload):
+    """
+    Returns the size of an uploaded file once decompressed.
+
+    For gzip files it's the size recorded at their end, which
+    can't be trusted, but is enough to reject them early:
+    the actual size is enforced while reading.
+    """
+    if not is_gzip(upload):
+        return upload.size
+    upload.seek(-4, io.SEEK_END)
+    size = int.from_bytes(upload.read(4), "little")
+    upload.seek(0)
+    return size
+
+
+def open_upload(upload, max_size=None, max_lines=None):
+    """
+    Returns a text file reading an uploaded file of commands, in UTF-8,
+    optionally compressed with gzip.
+
+    The file is decompressed and decoded incrementally, a chunk at a time,
+    as the parsers read it, so that memory does not grow with its size.
+    The limits, `settings.BATCH_UPLOAD_MAX_SIZE` bytes once decompressed
+    and `settings.BATCH_UPLOAD_MAX_LINES` lines, are checked before
+    reading when possible, and while reading otherwise.
+    """
+    if max_size is None:
+        max_size = settings.BATCH_UPLOAD_MAX_SIZE
+    if max_lines is None:
+        max_lines = settings.BATCH_UPLOAD_MAX_LINES
+    if upload_size(upload) > max_size:
+        raise ParserException(f"The file is larger than {max_size} bytes")
+
+    stream = upload
+    if is_gzip(upload):
+        stream = gzip.GzipFile(fileobj=upload, mode="rb")
+    limited = io.BufferedReader(LimitedStream(stream, max_size, max_lines))
+    # newline="" keeps the line endings, as the CSV reader needs
+    return io.TextIOWrapper(limited, encoding="utf-8-sig", newline="")
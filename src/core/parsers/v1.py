@@ -1,12 +1,16 @@
+import io
 import re
 
 from .base import BaseParser
 from .base import ParserException
+from .parallel import iter_parsed
 from core.models import Batch
 from core.models import BatchCommand
 
 
 class V1CommandParser(BaseParser):
+    # Characters read at a time from the commands source
+    READ_SIZE = 64 * 1024
 
     CREATE_PROPERTY_ALLOWED_DATATYPES = [
         "commonsMedia",
@@ -283,74 +287,128 @@ class V1CommandParser(BaseParser):
 
         return data
 
+    def iter_raw_commands(self, source):
+        """
+        Yields the raw commands of `source`, a string or a text file,
+        reading it READ_SIZE characters at a time.
+
+        Commands are separated by new lines or "||", and their
+        columns by tabs or "|", which are replaced by tabs.
+        """
+        if isinstance(source, str):
+            source = io.StringIO(source)
+        pending = ""
+        while True:
+            chunk = source.read(self.READ_SIZE)
+            text = pending + chunk
+            if chunk:
+                # The last command can go on in the next chunk,
+                # and a trailing "|" can be half of a "||"
+                complete = text.rstrip("|")
+                lines = complete.replace("||", "\n").split("\n")
+                pending = lines.pop() + text.removeprefix(complete)
+            else:
+                lines = text.replace("||", "\n").split("\n")
+            for line in lines:
+                raw_command = line.replace("|", "\t").strip()
+                if raw_command:
+                    yield raw_command
+            if not chunk:
+                return
+
+    def iter_commands(self, source, batch=None, progress=None):
+        """
+        Yields a preview BatchCommand of `batch` for each command of `source`,
+        a string or a text file, without keeping them.
+
+        Large sources are parsed in parallel, see `iter_parsed`.
+        """
+        return iter_parsed(
+            self.parse_chunk, self.iter_raw_commands(source), batch, progress=progress
+        )
+
+    def count_lines(self, source):
+        """
+        Returns the number of commands of `source`, without parsing them.
+        """
+        return sum(1 for _ in self.iter_raw_commands(source))
+
+    def parse_chunk(self, raw_commands):
+        """
+        Returns the commands of a list of raw commands, indexed from 0.
+        """
+        return [
+            self.build_command(None, index, raw_command)
+            for index, raw_command in enumerate(raw_commands)
+        ]
+
+    def build_command(self, batch, index, raw_command):
+        bc = BatchCommand(
+            batch=batch,
+            index=index,
+            raw=raw_command,
+            json={},
+            action=BatchCommand.ACTION_CREATE,
+            status=BatchCommand.STATUS_INITIAL,
+        )
+        try:
+            command = self.parse_command(raw_command)
+            if command["action"] == "force_add" and command["what"] == "statement":
+                bc.action = BatchCommand.ACTION_ADD
+            if command["action"] == "add":
+                bc.action = BatchCommand.ACTION_ADD
+                what = command.get("what")
+                if what == "sitelink":
+                    bc.operation = bc.Operation.SET_SITELINK
+                elif what == "label":
+                    bc.operation = bc.Operation.SET_LABEL
+                elif what == "description":
+                    bc.operation = bc.Operation.SET_DESCRIPTION
+                elif what == "alias":
+                    bc.operation = bc.Operation.ADD_ALIAS
+                elif what == "statement":
+                    bc.operation = bc.Operation.SET_STATEMENT
+            elif command["action"] == "remove":
+                bc.action = BatchCommand.ACTION_REMOVE
+                what = command.get("what")
+                if what == "statement":
+                    if "id" in command:
+                        bc.operation = bc.Operation.REMOVE_STATEMENT_BY_ID
+                    else:
+                        bc.operation = bc.Operation.REMOVE_STATEMENT_BY_VALUE
+                elif what == "sitelink":
+                    bc.operation = bc.Operation.REMOVE_SITELINK
+                elif what == "label":
+                    bc.operation = bc.Operation.REMOVE_LABEL
+                elif what == "description":
+                    bc.operation = bc.Operation.REMOVE_DESCRIPTION
+                elif what == "alias":
+                    bc.operation = bc.Operation.REMOVE_ALIAS
+                elif what == "qualifier":
+                    bc.operation = bc.Operation.REMOVE_QUALIFIER
+                elif what == "reference":
+                    bc.operation = bc.Operation.REMOVE_REFERENCE
+            elif command["action"] == "create":
+                bc.action = BatchCommand.ACTION_CREATE
+                what_or_type = command.get("type", command.get("what"))
+                if what_or_type == "item":
+                    bc.operation = bc.Operation.CREATE_ITEM
+                elif what_or_type == "property":
+                    bc.operation = bc.Operation.CREATE_PROPERTY
+                elif what_or_type == "statement":
+                    bc.operation = bc.Operation.CREATE_STATEMENT
+            else:
+                bc.action = BatchCommand.ACTION_MERGE
+            bc.user_summary = command.pop("summary", None)
+            bc.json = command
+        except ParserException as e:
+            bc.status = BatchCommand.STATUS_ERROR
+            bc.message = e.message
+
+        return bc
+
     def parse(self, batch_name, batch_owner, raw_commands):
         batch = Batch(name=batch_name, user=batch_owner)
-        commands = raw_commands.replace("||", "\n").replace("|", "\t")
-        commands = [c.strip() for c in commands.split("\n") if c.strip()]
-
-        for index, raw_command in enumerate(commands):
-            bc = BatchCommand(
-                batch=batch,
-                index=index,
-                raw=raw_command,
-                json={},
-                action=BatchCommand.ACTION_CREATE,
-                status=BatchCommand.STATUS_INITIAL,
-            )
-            try:
-                command = self.parse_command(raw_command)
-                if command["action"] == "force_add" and command["what"] == "statement":
-                    bc.action = BatchCommand.ACTION_ADD
-                if command["action"] == "add":
-                    bc.action = BatchCommand.ACTION_ADD
-                    what = command.get("what")
-                    if what == "sitelink":
-                        bc.operation = bc.Operation.SET_SITELINK
-                    elif what == "label":
-                        bc.operation = bc.Operation.SET_LABEL
-                    elif what == "description":
-                        bc.operation = bc.Operation.SET_DESCRIPTION
-                    elif what == "alias":
-                        bc.operation = bc.Operation.ADD_ALIAS
-                    elif what == "statement":
-                        bc.operation = bc.Operation.SET_STATEMENT
-                elif command["action"] == "remove":
-                    bc.action = BatchCommand.ACTION_REMOVE
-                    what = command.get("what")
-                    if what == "statement":
-                        if "id" in command:
-                            bc.operation = bc.Operation.REMOVE_STATEMENT_BY_ID
-                        else:
-                            bc.operation = bc.Operation.REMOVE_STATEMENT_BY_VALUE
-                    elif what == "sitelink":
-                        bc.operation = bc.Operation.REMOVE_SITELINK
-                    elif what == "label":
-                        bc.operation = bc.Operation.REMOVE_LABEL
-                    elif what == "description":
-                        bc.operation = bc.Operation.REMOVE_DESCRIPTION
-                    elif what == "alias":
-                        bc.operation = bc.Operation.REMOVE_ALIAS
-                    elif what == "qualifier":
-                        bc.operation = bc.Operation.REMOVE_QUALIFIER
-                    elif what == "reference":
-                        bc.operation = bc.Operation.REMOVE_REFERENCE
-                elif command["action"] == "create":
-                    bc.action = BatchCommand.ACTION_CREATE
-                    what_or_type = command.get("type", command.get("what"))
-                    if what_or_type == "item":
-                        bc.operation = bc.Operation.CREATE_ITEM
-                    elif what_or_type == "property":
-                        bc.operation = bc.Operation.CREATE_PROPERTY
-                    elif what_or_type == "statement":
-                        bc.operation = bc.Operation.CREATE_STATEMENT
-                else:
-                    bc.action = BatchCommand.ACTION_MERGE
-                bc.user_summary = command.pop("summary", None)
-                bc.json = command
-            except ParserException as e:
-                bc.status = BatchCommand.STATUS_ERROR
-                bc.message = e.message
-
+        for bc in self.iter_commands(raw_commands, batch):
             batch.add_preview_command(bc)
-
         return batch
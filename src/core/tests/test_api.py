@@ -1,5 +1,10 @@
 import requests_mock
+import threading
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
 
 from django.test import TestCase
 from django.test import override_settings
@@ -9,13 +14,16 @@ from django.utils.timezone import now
 
 from web.models import Token
 
+from core.cache import SharedCache
 from core.client import Client
+from core.client import property_value_types
 from core.models import BatchCommand
 from core.exceptions import NonexistantPropertyOrNoDataType
 from core.exceptions import NoValueTypeForThisDataType
 from core.exceptions import InvalidPropertyValueType
 from core.exceptions import UnauthorizedToken
 from core.exceptions import ServerError
+from core.exceptions import UserError
 from core.parsers.v1 import V1CommandParser
 
 
@@ -322,6 +330,28 @@ class ApiMocker:
             status_code=200,
         )
 
+    @classmethod
+    def multiple_data_types(cls, mocker, data_types: dict):
+        """
+        Mocks wbgetentities returning the data types of the requested properties.
+        """
+
+        def callback(request, context):
+            ids = parse_qs(urlparse(request.url).query)["ids"][0].split("|")
+            entities = {}
+            for id in ids:
+                if id in data_types:
+                    entities[id] = {"id": id, "datatype": data_types[id]}
+                else:
+                    entities[id] = {"id": id, "missing": ""}
+            return {"entities": entities}
+
+        mocker.get(
+            Client.BASE_REST_URL.replace("/w/rest.php", "/w/api.php"),
+            json=callback,
+            status_code=200,
+        )
+
     @classmethod
     def wikidata_property_data_types(cls, mocker):
         cls.property_data_types(
@@ -425,6 +455,7 @@ class ClientTests(TestCase):
         # this is needed for the property-data-types to work correctly,
         # since it uses the cache
         django_cache.clear()
+        SharedCache.clear_all_local()
 
     def api_client(self):
         user, _ = User.objects.get_or_create(username="test_token_user")
@@ -478,6 +509,82 @@ class ClientTests(TestCase):
         with self.assertRaises(NoValueTypeForThisDataType):
             self.api_client().get_property_value_type("P1")
 
+    @requests_mock.Mocker()
+    def test_prefetch_property_value_types(self, mocker):
+        ApiMocker.wikidata_property_data_types(mocker)
+        data_types = {f"P{i}": "quantity" for i in range(1, 121)}
+        ApiMocker.multiple_data_types(mocker, data_types)
+        client = self.api_client()
+        client.prefetch_property_value_types([*data_types.keys(), "P1", "P999"])
+
+        action_api = client.action_api_url()
+        calls = [r for r in mocker.request_history if r.url.startswith(action_api)]
+        self.assertEqual(len(calls), 3)
+        self.assertTrue(
+            all(
+                len(parse_qs(urlparse(c.url).query)["ids"][0].split("|")) <= 50
+                for c in calls
+            )
+        )
+
+        self.assertEqual(client.get_property_value_type("P120"), "quantity")
+        with self.assertRaises(NonexistantPropertyOrNoDataType):
+            client.get_property_value_type("P999")
+
+        # Nothing is requested again
+        client.prefetch_property_value_types(["P1", "P2"])
+        calls = [r for r in mocker.request_history if r.url.startswith(action_api)]
+        self.assertEqual(len(calls), 3)
+
+    @requests_mock.Mocker()
+    def test_prefetch_ignores_failed_requests(self, mocker):
+        ApiMocker.wikidata_property_data_types(mocker)
+        client = self.api_client()
+        mocker.get(client.action_api_url(), json={"error": "x"}, status_code=500)
+        ApiMocker.property_data_type(mocker, "P1", "quantity")
+        client.prefetch_property_value_types(["P1"])
+        self.assertIsNone(property_value_types.get(client.property_cache_key("P1")))
+        self.assertEqual(client.get_property_value_type("P1"), "quantity")
+
+    @requests_mock.Mocker()
+    def test_property_value_type_is_shared_between_clients(self, mocker):
+        ApiMocker.wikidata_property_data_types(mocker)
+        ApiMocker.property_data_type(mocker, "P1104", "quantity")
+        self.assertEqual(self.api_client().get_property_value_type("P1104"), "quantity")
+        self.assertEqual(self.api_client().get_property_value_type("P1104"), "quantity")
+        self.assertEqual(mocker.call_count, 2)
+        self.assertEqual(property_value_types.stats()["hits"], 1)
+
+        # Other processes find it in the Django cache
+        SharedCache.clear_all_local()
+        self.assertEqual(self.api_client().get_property_value_type("P1104"), "quantity")
+        self.assertEqual(mocker.call_count, 2)
+
+    @requests_mock.Mocker()
+    def test_nonexistent_properties_are_cached(self, mocker):
+        ApiMocker.wikidata_property_data_types(mocker)
+        ApiMocker.property_data_type_not_found(mocker, "P321341234")
+        for _ in range(2):
+            with self.assertRaises(NonexistantPropertyOrNoDataType):
+                self.api_client().get_property_value_type("P321341234")
+        self.assertEqual(mocker.call_count, 1)
+
+    @requests_mock.Mocker()
+    def test_other_errors_are_not_cached_as_nonexistent(self, mocker):
+        ApiMocker.wikidata_property_data_types(mocker)
+        mocker.get(
+            self.wikibase_url("/entities/properties/P1104"),
+            json={"code": "rate-limit-reached", "message": "Too many requests"},
+            status_code=429,
+        )
+        client = self.api_client()
+        with self.assertRaises(UserError):
+            client.get_property_value_type("P1104")
+        self.assertIsNone(property_value_types.get(client.property_cache_key("P1104")))
+
+        ApiMocker.property_data_type(mocker, "P1104", "quantity")
+        self.assertEqual(self.api_client().get_property_value_type("P1104"), "quantity")
+
     @requests_mock.Mocker()
     def test_get_labels(self, mocker):
         labels = {
@@ -503,6 +610,89 @@ class ClientTests(TestCase):
             },
         )
 
+    @requests_mock.Mocker()
+    def test_labels_are_cached(self, mocker):
+        client = self.api_client()
+        labels = {
+            "Q1": {"pt": "pt1", "en": "en1"},
+            "Q2": {"en": "en2"},
+            "Q3": {},
+        }
+        ApiMocker.labels(mocker, client, labels)
+
+        def requested_ids():
+            query = parse_qs(urlparse(mocker.last_request.url).query)
+            return sorted(query["ids"][0].split("|"))
+
+        expected = {"Q1": "pt1", "Q2": "en2", "Q3": None, "Q4": None}
+        self.assertEqual(client.get_labels(["Q1", "Q2", "Q3", "Q4"], "pt"), expected)
+        self.assertEqual(mocker.call_count, 1)
+
+        # Labels, and entities without them, come from the cache
+        self.assertEqual(client.get_labels(["Q4", "Q3", "Q2", "Q1"], "pt"), expected)
+        self.assertEqual(client.get_labels(["Q1"], "pt"), {"Q1": "pt1"})
+        self.assertEqual(mocker.call_count, 1)
+
+        # Only the missing labels are requested
+        self.assertEqual(
+            client.get_labels(["Q1", "Q5"], "pt"), {"Q1": "pt1", "Q5": None}
+        )
+        self.assertEqual(mocker.call_count, 2)
+        self.assertEqual(requested_ids(), ["Q5"])
+
+        # Labels are cached by language
+        self.assertEqual(client.get_labels(["Q1"], "en"), {"Q1": "en1"})
+        self.assertEqual(mocker.call_count, 3)
+
+        # and shared by every client
+        SharedCache.clear_all_local()
+        other = Client.from_token(Token(value="OTHER_TOKEN"))
+        self.assertEqual(
+            other.get_labels(["Q1", "Q2"], "pt"), {"Q1": "pt1", "Q2": "en2"}
+        )
+        self.assertEqual(mocker.call_count, 3)
+
+    @requests_mock.Mocker()
+    def test_labels_in_concurrent_chunks(self, mocker):
+        client = self.api_client()
+        ids = [f"Q{n}" for n in range(1, 121)]
+        failing = set(sorted(ids)[50:100])
+
+        def callback(request, context):
+            requested = parse_qs(urlparse(request.url).query)["ids"][0].split("|")
+            if failing.intersection(requested):
+                context.status_code = 500
+                return {"error": "timeout"}
+            return {
+                "entities": {
+                    id: {"labels": {"en": {"language": "en", "value": f"label {id}"}}}
+                    for id in requested
+                }
+            }
+
+        mocker.get(client.action_api_url(), json=callback)
+        labels = client.get_labels(ids, "en")
+        self.assertEqual(mocker.call_count, 3)
+        for request in mocker.request_history:
+            self.assertLessEqual(
+                len(parse_qs(urlparse(request.url).query)["ids"][0].split("|")), 50
+            )
+        for id in ids:
+            self.assertEqual(labels[id], None if id in failing else f"label {id}")
+
+        # The labels of the failed chunk were not cached
+        failing.clear()
+        labels = client.get_labels(ids, "en")
+        self.assertEqual(mocker.call_count, 4)
+        self.assertEqual(labels, {id: f"label {id}" for id in ids})
+
+    @requests_mock.Mocker()
+    def test_labels_with_expired_token(self, mocker):
+        client = self.api_client()
+        mocker.get(client.action_api_url(), json={}, status_code=401)
+        with self.assertRaises(UnauthorizedToken):
+            client.get_labels(["Q1"], "en")
+
     @requests_mock.Mocker()
     def test_verify_value_type(self, mocker):
         ApiMocker.wikidata_property_data_types(mocker)
@@ -672,6 +862,55 @@ class ClientTests(TestCase):
         }
         self.assertEqual(client.headers(), headers)
 
+    @requests_mock.Mocker()
+    def test_clients_share_the_session(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        client = self.api_client()
+        user = User.objects.create(username="other_user")
+        other = Client.from_token(Token.objects.create(user=user, value="OTHER_TOKEN"))
+        self.assertIs(client.session, other.session)
+
+        client.get_profile()
+        other.get_profile()
+        first, second = mocker.request_history
+        self.assertEqual(first.headers["Authorization"], "Bearer TEST_TOKEN")
+        self.assertEqual(second.headers["Authorization"], "Bearer OTHER_TOKEN")
+        self.assertIn("gzip", first.headers["Accept-Encoding"])
+
+    def test_session_keeps_connections_alive_without_cookies(self):
+        requests = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                requests.append((self.client_address, self.headers.get("Cookie")))
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.send_header("Set-Cookie", "session=secret; Path=/")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = f"http://127.0.0.1:{server.server_port}/"
+            user = User.objects.create(username="other_user")
+            other = Client.from_token(Token.objects.create(user=user, value="OTHER"))
+            self.api_client().get(url)
+            other.get(url)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        (first, _), (second, cookie) = requests
+        self.assertEqual(first, second)
+        self.assertIsNone(cookie)
+
 
 class TestBatchCommand(TestCase):
     def login_user_and_get_token(self, username):
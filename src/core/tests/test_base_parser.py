@@ -375,3 +375,84 @@ class TestBaseParser(TestCase):
         }
         self.assertEqual(parser.parse_value("9.123~0.123"), ret)
         self.assertEqual(parser.parse_value("9.123[9.000,9.246]"), ret)
+
+    def test_parse_value_tries_only_the_parsers_that_can_match(self):
+        parser = BaseParser()
+        every_parser = [
+            parser.parse_value_somevalue_novalue,
+            parser.parse_value_entity,
+            parser.parse_value_url,
+            parser.parse_value_commons_media_file,
+            parser.parse_value_external_id,
+            parser.parse_value_monolingualtext,
+            parser.parse_value_string,
+            parser.parse_value_time,
+            parser.parse_value_location,
+            parser.parse_value_quantity,
+        ]
+
+        def first_match(v):
+            for fn in every_parser:
+                ret = fn(v)
+                if ret is not None:
+                    return ret
+            return None
+
+        values = [
+            "somevalue",
+            "novalue",
+            "Q1",
+            "M2",
+            "P3",
+            "L4",
+            "L4-F5",
+            "L4-S6",
+            "LAST",
+            '"text"',
+            'pt:"texto"',
+            '-x:"y"',
+            '"""https://a.b"""',
+            '"""a.jpg"""',
+            '"""id"""',
+            "+1967-01-17T00:00:00Z/11",
+            "-1967-01-17T00:00:00Z/9/J",
+            "@1.5/-2",
+            "12",
+            "-1.5",
+            "+3U5",
+            "9.6~0.1U11573",
+            "9[8, 10]",
+            "٣U5",
+            "q1",
+            "Len",
+            "",
+            "x",
+            "somevalues",
+            '""',
+            "@",
+            "1967-01-17",
+        ]
+        for v in values:
+            self.assertEqual(parser.parse_value(v), first_match(v), v)
+
+    def test_entity_type(self):
+        parser = BaseParser()
+        types = {
+            "Q1": "item",
+            "M1": "item",
+            "LAST": "item",
+            "P1": "property",
+            "L1": "lexeme",
+            "L1-F2": "form",
+            "L1-S2": "sense",
+            "Aen": "alias",
+            "Den": "description",
+            "Len": "label",
+            "Senwiki": "sitelink",
+            "S1": None,
+            "X1": None,
+            "": None,
+            None: None,
+        }
+        for entity, entity_type in types.items():
+            self.assertEqual(parser.get_entity_type(entity), entity_type, entity)
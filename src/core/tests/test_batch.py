@@ -1,3 +1,6 @@
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count
 from django.test import TestCase
 from django.test import override_settings
 
@@ -159,6 +162,166 @@ class TestBatch(TestCase):
         self.assertTrue(batch.is_initial)
         self.assertTrue(batch.message.startswith("Batch restarted by owner"))
 
+    def test_report_rows_in_chunks(self):
+        batch = Batch.objects.create(name="teste")
+        commands = [
+            (0, {"item": "Q1"}, "Q1\tP2\tQ3"),
+            (1, {"entity": {"type": "item", "id": "Q2"}}, "Q2|Len|x"),
+            (1, {"item": "", "entity": {"id": "Q3"}}, "Q3|Len|y"),
+            (2, {"action": "create", "type": "item"}, "CREATE"),
+            (5, {"item": "Q5"}, "Q5|Len|z"),
+        ]
+        for index, json, raw in commands:
+            BatchCommand.objects.create(
+                batch=batch,
+                index=index,
+                json=json,
+                raw=raw,
+                status=BatchCommand.STATUS_DONE,
+                operation="set_label",
+            )
+        expected = [
+            Batch.REPORT_HEADER,
+            [batch.pk, 0, "set_label", "Done", None, None, "Q1", "Q1|P2|Q3"],
+            [batch.pk, 1, "set_label", "Done", None, None, "Q2", "Q2|Len|x"],
+            [batch.pk, 1, "set_label", "Done", None, None, "Q3", "Q3|Len|y"],
+            [batch.pk, 2, "set_label", "Done", None, None, None, "CREATE"],
+            [batch.pk, 5, "set_label", "Done", None, None, "Q5", "Q5|Len|z"],
+        ]
+        for chunk_size in [1, 2, 5, 1000]:
+            with self.assertNumQueries(len(commands) // chunk_size + 1):
+                self.assertEqual(list(batch.report_rows(chunk_size)), expected)
+
+
+class TestBatchCounters(TestCase):
+    def counters(self, batch):
+        batch.refresh_from_db()
+        return [getattr(batch, field) for field in Batch.COUNTERS]
+
+    def create_commands(self, batch, statuses):
+        for index, status in enumerate(statuses):
+            BatchCommand.objects.create(
+                batch=batch, index=index, raw="", json={}, status=status
+            )
+
+    def test_counters_follow_saves(self):
+        batch = Batch.objects.create(name="batch")
+        self.create_commands(
+            batch, [BatchCommand.STATUS_INITIAL] * 3 + [BatchCommand.STATUS_ERROR]
+        )
+        self.assertEqual(self.counters(batch), [3, 0, 0, 1, 4])
+        command = batch.commands()[0]
+        command.status = BatchCommand.STATUS_RUNNING
+        command.save()
+        self.assertEqual(self.counters(batch), [2, 1, 0, 1, 4])
+        command.status = BatchCommand.STATUS_DONE
+        command.save()
+        self.assertEqual(self.counters(batch), [2, 0, 1, 1, 4])
+
+    @override_settings(BATCH_INSERT_SIZE=10)
+    def test_preview_commands_are_inserted_in_bulk(self):
+        raw = "||".join("Q1|P1|Q2" if n % 4 else "Q1|P1|" for n in range(25))
+        batch = V1CommandParser().parse("teste", "user", raw)
+        with self.assertNumQueries(7):
+            # batch, 3 inserts, counters and the transaction savepoints
+            batch.save_batch_and_preview_commands()
+        self.assertEqual(
+            list(batch.commands().values_list("index", flat=True)), list(range(25))
+        )
+        expected = [18, 0, 0, 7, 25]
+        self.assertEqual([getattr(batch, field) for field in Batch.COUNTERS], expected)
+        self.assertEqual(self.counters(batch), expected)
+
+        # Saving again inserts nothing
+        batch.save_batch_and_preview_commands()
+        self.assertEqual(batch.commands().count(), 25)
+        self.assertEqual(self.counters(batch), expected)
+
+    def test_saving_an_outdated_batch_keeps_counters(self):
+        batch = Batch.objects.create(name="batch")
+        outdated = Batch.objects.get(pk=batch.pk)
+        self.create_commands(batch, [BatchCommand.STATUS_INITIAL] * 2)
+        outdated.status = Batch.STATUS_STOPPED
+        outdated.save()
+        self.assertEqual(self.counters(batch), [2, 0, 0, 0, 2])
+        self.assertEqual(batch.status, Batch.STATUS_STOPPED)
+
+    def test_reconcile_counters(self):
+        batch = Batch.objects.create(name="batch", status=Batch.STATUS_RUNNING)
+        self.create_commands(batch, [BatchCommand.STATUS_INITIAL] * 3)
+        batch.commands().filter(index__lt=2).update(status=BatchCommand.STATUS_DONE)
+        self.assertEqual(self.counters(batch), [3, 0, 0, 0, 3])
+        Batch.objects.reconcile_counters()
+        self.assertEqual(self.counters(batch), [1, 0, 2, 0, 3])
+
+    def test_reconcile_counters_command(self):
+        batch = Batch.objects.create(name="batch", status=Batch.STATUS_DONE)
+        self.create_commands(batch, [BatchCommand.STATUS_INITIAL])
+        batch.commands().update(status=BatchCommand.STATUS_DONE)
+        call_command("reconcile_counters")
+        self.assertEqual(self.counters(batch), [1, 0, 0, 0, 1])
+        call_command("reconcile_counters", "--all")
+        self.assertEqual(self.counters(batch), [0, 0, 1, 0, 1])
+
+
+class TestCommandQueryPlans(TestCase):
+    """
+    The hot command queries must read an index in order:
+    no full table scan and no sorting of the rows.
+    """
+
+    def setUp(self):
+        self.batch = Batch.objects.create(name="Batch", user="user")
+        BatchCommand.objects.bulk_create(
+            BatchCommand(batch=self.batch, index=i, json={}, raw="", status=i % 4)
+            for i in range(2000)
+        )
+
+    def assertIndexedPlan(self, queryset, index=None):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ANALYZE"
+                if connection.vendor == "sqlite"
+                else "ANALYZE TABLE core_batchcommand"
+            )
+        plan = queryset.explain()
+        if index:
+            self.assertIn(index, plan)
+        if connection.vendor == "sqlite":
+            self.assertNotIn("SCAN core_batchcommand", plan)
+            self.assertNotIn("USE TEMP B-TREE", plan)
+        elif connection.vendor == "mysql":
+            self.assertNotIn("Using filesort", plan)
+            self.assertNotIn("\tALL\t", plan)
+        self.assertIn("INDEX", plan.upper())
+
+    def test_commands_not_done(self):
+        self.assertIndexedPlan(
+            self.batch.commands().exclude(status=BatchCommand.STATUS_DONE)
+        )
+
+    def test_commands_not_verified(self):
+        self.batch.commands().filter(index__lt=1900).update(value_type_verified=True)
+        self.assertIndexedPlan(self.batch.commands().filter(value_type_verified=False))
+
+    def test_commands_with_errors(self):
+        self.assertIndexedPlan(
+            self.batch.commands().filter(status=BatchCommand.STATUS_ERROR)[:31],
+            "batchcommand_status_idx",
+        )
+
+    def test_last_commands(self):
+        self.assertIndexedPlan(self.batch.commands().order_by("-index")[:31])
+
+    def test_status_counts(self):
+        self.assertIndexedPlan(
+            BatchCommand.objects.filter(batch_id=self.batch.pk)
+            .order_by()
+            .values("status")
+            .annotate(count=Count("pk")),
+            "batchcommand_status_idx",
+        )
+
 
 class TestV1Batch(TestCase):
     def test_v1_correct_create_command(self):
@@ -320,6 +483,17 @@ class TestV1Batch(TestCase):
 
 
 class TestCSVBatch(TestCase):
+    def test_raw_is_the_source_row(self):
+        COMMAND = """qid,Len,Den,P31
+,Regina Phalange,"fictional character, sitcom",Q95074
+Q1,"Say ""hi"" now",,Q5"""
+        batch = CSVCommandParser().parse("My batch", "myuser", COMMAND)
+        batch.save_batch_and_preview_commands()
+        raws = list(batch.commands().values_list("raw", flat=True))
+        first = ',Regina Phalange,"fictional character, sitcom",Q95074'
+        second = 'Q1,"Say ""hi"" now",,Q5'
+        self.assertEqual(raws, [first] * 4 + [second] * 2)
+
     def test_create_property(self):
         COMMAND = """qid,Len,Den,P31
 ,Regina Phalange,fictional character,Q95074"""
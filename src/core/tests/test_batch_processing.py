@@ -1,11 +1,17 @@
 import requests_mock
+from datetime import timedelta
 from io import StringIO
 
+from django.core.cache import cache as django_cache
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
+from django.utils.timezone import now
 
+from core.cache import SharedCache
 from core.tests.test_api import ApiMocker
 from core.client import Client as ApiClient
 from core.models import Batch
@@ -15,6 +21,10 @@ from web.models import Token
 
 
 class ProcessingTests(TestCase):
+    def setUp(self):
+        django_cache.clear()
+        SharedCache.clear_all_local()
+
     def parse(self, text):
         user, _ = User.objects.get_or_create(username="user")
         Token.objects.get_or_create(user=user, value="tokenvalue")
@@ -236,6 +246,32 @@ class ProcessingTests(TestCase):
         self.assertEqual(commands[2].message, "LAST could not be evaluated.")
         self.assertEqual(commands[3].status, BatchCommand.STATUS_DONE)
 
+    @requests_mock.Mocker()
+    def test_resumed_run_keeps_the_last_id(self, mocker):
+        """
+        Checks that a run resuming a batch, after its worker died, gives
+        the LAST commands the item created before, which is already done.
+        """
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.wikidata_property_data_types(mocker)
+        ApiMocker.property_data_type(mocker, "P1", "quantity")
+        ApiMocker.item_empty(mocker, "Q5")
+        ApiMocker.add_statement_successful(mocker, "Q5")
+        batch = self.parse("CREATE||LAST|P1|1||LAST|P1|1")
+        create = batch.commands()[0]
+        create.status = BatchCommand.STATUS_DONE
+        create.response_json = {"id": "Q5"}
+        create.set_entity_id("Q5")
+        create.save()
+
+        batch.run()
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        commands = batch.commands()
+        self.assertEqual(commands[1].status, BatchCommand.STATUS_DONE)
+        self.assertEqual(commands[1].entity_id(), "Q5")
+        self.assertEqual(commands[2].status, BatchCommand.STATUS_DONE)
+        self.assertEqual(commands[2].entity_id(), "Q5")
+
     @requests_mock.Mocker()
     def test_block_on_errors_last_id(self, mocker):
         """
@@ -243,6 +279,7 @@ class ProcessingTests(TestCase):
         fails, all subsequent LAST commands stay in INITIAL.
         """
         ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.wikidata_property_data_types(mocker)
         ApiMocker.property_data_type(mocker, "P1", "quantity")
         ApiMocker.add_statement_successful(mocker, "Q1")
         ApiMocker.create_item_failed_server(mocker)
@@ -904,6 +941,292 @@ class ProcessingTests(TestCase):
         # was not updated because we hacked the status:
         self.assertEqual(commands[1].entity_id(), "LAST")
 
+    def batch_queries(self, queries):
+        """
+        Returns the queries on the batch, apart from the command counter updates.
+        """
+        return [
+            q
+            for q in queries
+            if '"core_batch"' in q["sql"] and '_commands" = ("core_batch".' not in q["sql"]
+        ]
+
+    @override_settings(BATCH_STOP_CHECK_COMMANDS=50, BATCH_STOP_CHECK_SECONDS=60)
+    @requests_mock.Mocker()
+    def test_stop_check_does_not_query_every_command(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.item_empty(mocker, "Q1")
+        ApiMocker.patch_item_successful(mocker, "Q1", {})
+        batch = self.parse("||".join(f'Q1|Lpt|"label {i}"' for i in range(100)))
+        with CaptureQueriesContext(connection) as context:
+            batch.run()
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        # Start, finish and a stop check every 50 commands in the loops that
+        # collect the properties, verify and edit, instead of one per command
+        self.assertEqual(len(self.batch_queries(context.captured_queries)), 8)
+
+    @override_settings(BATCH_STOP_CHECK_COMMANDS=10, BATCH_STOP_CHECK_SECONDS=60)
+    @requests_mock.Mocker()
+    def test_stop_takes_effect_within_the_check_interval(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.item_empty(mocker, "Q1")
+        batch = self.parse("||".join(f'Q1|Lpt|"label {i}"' for i in range(100)))
+        patches = []
+
+        def stop_after_5_edits(request, context):
+            patches.append(request)
+            if len(patches) == 5:
+                Batch.objects.get(pk=batch.pk).stop()
+            return {}
+
+        mocker.patch(ApiMocker.wikibase_url("/entities/items/Q1"), json=stop_after_5_edits)
+        batch.run()
+        self.assertEqual(batch.status, Batch.STATUS_STOPPED)
+        done = batch.commands().filter(status=BatchCommand.STATUS_DONE).count()
+        self.assertGreaterEqual(done, 5)
+        self.assertLessEqual(done, 5 + 10)
+
+    def command_updates(self, queries):
+        return [q for q in queries if q["sql"].startswith('UPDATE "core_batchcommand"')]
+
+    @override_settings(BATCH_COMMAND_BUFFER_SIZE=50, BATCH_COMMAND_BUFFER_SECONDS=60)
+    @requests_mock.Mocker()
+    def test_command_transitions_are_written_in_bulk(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.item_empty(mocker, "Q1")
+        ApiMocker.patch_item_successful(mocker, "Q1", {})
+        batch = self.parse("||".join(f'Q1|Lpt|"label {i}"' for i in range(100)))
+        with CaptureQueriesContext(connection) as context:
+            batch.run()
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        # Four saves per command before: verified, running, verified again and done
+        self.assertLess(len(self.command_updates(context.captured_queries)), 10)
+        self.assertEqual(
+            batch.commands().filter(status=BatchCommand.STATUS_DONE).count(), 100
+        )
+        self.assertFalse(batch.commands().filter(value_type_verified=False).exists())
+        batch.refresh_from_db()
+        self.assertEqual(batch.done_commands, 100)
+        self.assertEqual(batch.initial_commands, 0)
+        self.assertEqual(batch.total_commands, 100)
+
+    @override_settings(BATCH_COMMAND_BUFFER_SIZE=50, BATCH_COMMAND_BUFFER_SECONDS=60)
+    @requests_mock.Mocker()
+    def test_buffered_transitions_are_written_when_blocked(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.item_empty(mocker, "Q1")
+        ApiMocker.patch_item_successful(mocker, "Q1", {})
+        ApiMocker.patch_item_fail(mocker, "Q2", 400, {"message": "error"})
+        ApiMocker.item_empty(mocker, "Q2")
+        batch = self.parse_with_block_on_errors(
+            'Q1|Lpt|"a"||Q1|Lpt|"b"||Q2|Lpt|"c"||Q1|Lpt|"d"'
+        )
+        batch.run()
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, Batch.STATUS_BLOCKED)
+        self.assertEqual(
+            [c.status for c in batch.commands()],
+            [
+                BatchCommand.STATUS_DONE,
+                BatchCommand.STATUS_DONE,
+                BatchCommand.STATUS_ERROR,
+                BatchCommand.STATUS_INITIAL,
+            ],
+        )
+
+    @override_settings(BATCH_COMMAND_BUFFER_SIZE=50, BATCH_COMMAND_BUFFER_SECONDS=60)
+    @requests_mock.Mocker()
+    def test_created_items_are_written_before_the_next_command(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.create_item(mocker, "Q5")
+        ApiMocker.item_empty(mocker, "Q5")
+        batch = self.parse('CREATE||LAST|Lpt|"label"')
+        statuses = []
+
+        def record_create_status(request, context):
+            statuses.append(batch.commands()[0].status)
+            return {}
+
+        mocker.patch(ApiMocker.wikibase_url("/entities/items/Q5"), json=record_create_status)
+        batch.run()
+        self.assertEqual(statuses, [BatchCommand.STATUS_DONE])
+        self.assertEqual(batch.commands()[1].entity_id(), "Q5")
+
+    @override_settings(BATCH_COMMAND_BUFFER_SIZE=50, BATCH_COMMAND_BUFFER_SECONDS=60)
+    @requests_mock.Mocker()
+    def test_edits_that_can_not_be_repeated_are_written_before_the_next(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.delete_statement_sucessful(mocker, "Q1$a")
+        ApiMocker.item_empty(mocker, "Q1")
+        ApiMocker.patch_item_successful(mocker, "Q1", {})
+        batch = self.parse('-STATEMENT|Q1$a||Q1|Lpt|"a"||Q1|Lpt|"b"||-STATEMENT|Q1$b')
+        statuses = []
+
+        def record_statuses(request, context):
+            statuses.append([c.status for c in batch.commands()])
+            return "Statement deleted"
+
+        mocker.delete(ApiMocker.wikibase_url("/statements/Q1$b"), json=record_statuses)
+        batch.run()
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        # The removal is written right away, the labels are still buffered
+        self.assertEqual(
+            statuses,
+            [
+                [
+                    BatchCommand.STATUS_DONE,
+                    BatchCommand.STATUS_INITIAL,
+                    BatchCommand.STATUS_INITIAL,
+                    BatchCommand.STATUS_INITIAL,
+                ]
+            ],
+        )
+
+    @requests_mock.Mocker()
+    def test_value_types_are_verified_in_bulk(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.wikidata_property_data_types(mocker)
+        ApiMocker.multiple_data_types(
+            mocker, {"P1": "wikibase-item", "P2": "string", "P3": "quantity"}
+        )
+        ApiMocker.item_empty(mocker, "Q1")
+        ApiMocker.add_statement_successful(mocker, "Q1")
+        lines = [f'Q1|P1|Q{i}|P2|"q"|S3|{i}' for i in range(100)]
+        batch = self.parse_run("||".join(lines))
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        self.assertFalse(batch.commands().filter(value_type_verified=False).exists())
+        urls = [r.url for r in mocker.request_history]
+        self.assertFalse([u for u in urls if "/entities/properties/" in u])
+        self.assertEqual(len([u for u in urls if "wbgetentities" in u]), 1)
+
+    @requests_mock.Mocker()
+    def test_bulk_verification_blocks_on_the_first_invalid_command(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.wikidata_property_data_types(mocker)
+        ApiMocker.multiple_data_types(mocker, {"P1": "wikibase-item", "P2": "string"})
+        batch = self.parse_with_block_on_errors("Q1|P1|Q2||Q1|P2|Q3||Q1|P1|Q4")
+        batch.run()
+        self.assertEqual(batch.status, Batch.STATUS_BLOCKED)
+        self.assertEqual(batch.message, "blocked by command 1")
+        commands = batch.commands()
+        self.assertTrue(commands[0].value_type_verified)
+        self.assertEqual(commands[1].status, BatchCommand.STATUS_ERROR)
+        self.assertFalse(commands[1].value_type_verified)
+        self.assertFalse(commands[2].value_type_verified)
+
+    @requests_mock.Mocker()
+    def test_bulk_verification_does_not_list_the_failed_commands(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.wikidata_property_data_types(mocker)
+        ApiMocker.multiple_data_types(mocker, {"P1": "wikibase-item", "P2": "string"})
+        batch = self.parse("||".join(["Q1|P2|Q3"] * 50 + ["Q1|P1|Q2"]))
+        batch.start()
+        client = ApiClient.from_username("user")
+        with CaptureQueriesContext(connection) as context:
+            self.assertTrue(batch.verify_value_types(client))
+        verified = [
+            q["sql"]
+            for q in context.captured_queries
+            if q["sql"].startswith('UPDATE "core_batchcommand" SET "value_type_verified"')
+        ]
+        self.assertEqual(len(verified), 1)
+        self.assertLess(len(verified[0]), 500)
+        commands = batch.commands()
+        self.assertEqual(commands.filter(status=BatchCommand.STATUS_ERROR).count(), 50)
+        verified = commands.filter(value_type_verified=True)
+        self.assertEqual(list(verified.values_list("index", flat=True)), [50])
+
+    def mock_item_with_revisions(self, mocker, item_id, failures=None):
+        """
+        Mocks an item that gets a new revision on every PATCH.
+
+        `failures` maps PATCH numbers to the error status code they get.
+        """
+        failures = failures or {}
+        revision = {"id": 1, "patches": 0}
+        item = {"type": "item", "id": item_id, "labels": {}, "statements": {}}
+        url = ApiMocker.wikibase_url(f"/entities/items/{item_id}")
+
+        def get(request, context):
+            context.headers["ETag"] = f'"{revision["id"]}"'
+            return item
+
+        def patch(request, context):
+            revision["patches"] += 1
+            if revision["patches"] in failures:
+                # Someone else edited it
+                revision["id"] += 1
+                context.status_code = failures[revision["patches"]]
+                return {"code": "error", "message": "error"}
+            revision["id"] += 1
+            context.headers["ETag"] = f'"{revision["id"]}"'
+            return item
+
+        mocker.get(url, json=get)
+        mocker.patch(url, json=patch)
+        return url
+
+    def requests_to(self, mocker, method, url):
+        return [r for r in mocker.request_history if r.method == method and r.url == url]
+
+    @requests_mock.Mocker()
+    def test_consecutive_edits_reuse_the_returned_entity(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        url = self.mock_item_with_revisions(mocker, "Q1")
+        batch = self.parse_run("||".join(f'Q1|Lpt|"label {i}"' for i in range(10)))
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        self.assertEqual(len(self.requests_to(mocker, "GET", url)), 1)
+        patches = self.requests_to(mocker, "PATCH", url)
+        self.assertEqual(len(patches), 10)
+        self.assertEqual(
+            [p.headers["If-Match"] for p in patches],
+            [f'"{i}"' for i in range(1, 11)],
+        )
+
+    @requests_mock.Mocker()
+    def test_created_entity_is_reused(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        mocker.post(
+            ApiMocker.wikibase_url("/entities/items"),
+            json={"type": "item", "id": "Q5", "labels": {}},
+            headers={"ETag": '"1"'},
+        )
+        ApiMocker.patch_item_successful(mocker, "Q5", {"id": "Q5"})
+        batch = self.parse_run('CREATE||LAST|Lpt|"label"')
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        self.assertEqual([r.method for r in mocker.request_history][-2:], ["POST", "PATCH"])
+        self.assertEqual(mocker.request_history[-1].headers["If-Match"], '"1"')
+
+    @requests_mock.Mocker()
+    def test_edit_conflict_gets_the_entity_again(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        url = self.mock_item_with_revisions(mocker, "Q1", failures={2: 412})
+        batch = self.parse_run('Q1|Lpt|"a"||Q1|Lpt|"b"||Q1|Lpt|"c"')
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        self.assertEqual(
+            [c.status for c in batch.commands()], [BatchCommand.STATUS_DONE] * 3
+        )
+        self.assertEqual(len(self.requests_to(mocker, "GET", url)), 2)
+        patches = self.requests_to(mocker, "PATCH", url)
+        self.assertEqual(
+            [p.headers["If-Match"] for p in patches], ['"1"', '"2"', '"3"', '"4"']
+        )
+
+    @requests_mock.Mocker()
+    def test_errors_invalidate_the_cached_entity(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        url = self.mock_item_with_revisions(mocker, "Q1", failures={2: 400})
+        batch = self.parse_run('Q1|Lpt|"a"||Q1|Lpt|"b"||Q1|Lpt|"c"')
+        self.assertEqual(
+            [c.status for c in batch.commands()],
+            [
+                BatchCommand.STATUS_DONE,
+                BatchCommand.STATUS_ERROR,
+                BatchCommand.STATUS_DONE,
+            ],
+        )
+        self.assertEqual(len(self.requests_to(mocker, "GET", url)), 2)
+
     @requests_mock.Mocker()
     def test_restart_batches(self, mocker):
         ApiMocker.is_autoconfirmed(mocker)
@@ -917,25 +1240,37 @@ class ProcessingTests(TestCase):
         batch2.save_batch_and_preview_commands()
         batch3 = self.parse(raw)
         batch3.save_batch_and_preview_commands()
+        batch4 = self.parse(raw)
+        batch4.save_batch_and_preview_commands()
         self.assertEqual(batch1.status, Batch.STATUS_INITIAL)
         self.assertEqual(batch2.status, Batch.STATUS_INITIAL)
         self.assertEqual(batch3.status, Batch.STATUS_INITIAL)
+        self.assertEqual(batch4.status, Batch.STATUS_INITIAL)
         call_command("restart_batches")
         batch1.refresh_from_db()
         batch2.refresh_from_db()
         batch3.refresh_from_db()
         batch1.start()
         batch2.run()
+        batch4.start()
         self.assertEqual(batch1.status, Batch.STATUS_RUNNING)
         self.assertEqual(batch2.status, Batch.STATUS_DONE)
         self.assertEqual(batch3.status, Batch.STATUS_INITIAL)
+        self.assertEqual(batch4.status, Batch.STATUS_RUNNING)
+        # batch1's worker stopped sending heartbeats
+        Batch.objects.filter(pk=batch1.pk).update(
+            lease_expires_at=now() - timedelta(seconds=1)
+        )
         call_command("restart_batches")
         batch1.refresh_from_db()
         batch2.refresh_from_db()
         batch3.refresh_from_db()
+        batch4.refresh_from_db()
         self.assertEqual(batch1.status, Batch.STATUS_INITIAL)
         self.assertEqual(batch2.status, Batch.STATUS_DONE)
         self.assertEqual(batch3.status, Batch.STATUS_INITIAL)
-        self.assertIn("Restarted after a server restart", batch1.message)
-        self.assertNotIn("Restarted after a server restart", batch2.message)
+        self.assertEqual(batch4.status, Batch.STATUS_RUNNING)
+        self.assertIn("Restarted after its worker stopped responding", batch1.message)
+        self.assertNotIn("Restarted", batch2.message)
         self.assertIsNone(batch3.message)
+        self.assertNotIn("Restarted", batch4.message)
@@ -0,0 +1,402 @@
+import gzip
+import multiprocessing
+import tempfile
+import time
+from datetime import timedelta
+from unittest import skipIf
+
+import requests
+import requests_mock
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.db import connections
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.utils.timezone import now
+
+from core.client import Client
+from core.management.commands.send_batches import process_batches
+from core.models import Batch
+from core.models import BatchCommand
+from core.models import BatchImport
+from core.parsers.imports import run_import
+from core.parsers.v1 import V1CommandParser
+from core.tests.test_api import ApiMocker
+from web.models import Token
+
+
+class ClaimTests(TestCase):
+    def create(self, user, status=Batch.STATUS_INITIAL):
+        return Batch.objects.create(name="batch", user=user, status=status)
+
+    def test_claims_oldest_batch(self):
+        first = self.create("user1")
+        self.create("user1")
+        batch = Batch.objects.claim_next("worker")
+        self.assertEqual(batch.pk, first.pk)
+        self.assertEqual(batch.status, Batch.STATUS_RUNNING)
+        self.assertEqual(batch.worker, "worker")
+        self.assertIsNotNone(batch.lease_expires_at)
+
+    def test_nothing_to_claim(self):
+        self.create("user1", Batch.STATUS_PREVIEW)
+        self.create("user1", Batch.STATUS_STOPPED)
+        self.create("user1", Batch.STATUS_BLOCKED)
+        self.create("user1", Batch.STATUS_DONE)
+        self.assertIsNone(Batch.objects.claim_next("worker"))
+
+    def test_one_batch_per_user(self):
+        b1 = self.create("user1")
+        b2 = self.create("user1")
+        b3 = self.create("user2")
+        self.assertEqual(Batch.objects.claim_next("w1").pk, b1.pk)
+        self.assertEqual(Batch.objects.claim_next("w2").pk, b3.pk)
+        self.assertIsNone(Batch.objects.claim_next("w3"))
+        Batch.objects.filter(pk=b1.pk).update(status=Batch.STATUS_DONE)
+        self.assertEqual(Batch.objects.claim_next("w3").pk, b2.pk)
+
+    def test_users_with_many_batches_do_not_starve_others(self):
+        for _ in range(Batch.objects.CLAIM_CANDIDATES + 5):
+            self.create("user1")
+        Batch.objects.claim_next("w1")
+        other = self.create("user2")
+        self.assertEqual(Batch.objects.claim_next("w2").pk, other.pk)
+
+    @requests_mock.Mocker()
+    def test_process_batches_until_empty(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.create_item(mocker, "Q1")
+        user = User.objects.create(username="user1")
+        Token.objects.create(user=user, value="tokenvalue")
+        b1 = self.create("user1")
+        b2 = self.create("user1")
+        for batch in [b1, b2]:
+            batch.batchcommand_set.create(
+                index=0,
+                raw="CREATE",
+                json={"action": "create", "type": "item"},
+                operation="create_item",
+            )
+        process_batches("worker", until_empty=True)
+        b1.refresh_from_db()
+        b2.refresh_from_db()
+        self.assertEqual(b1.status, Batch.STATUS_DONE)
+        self.assertEqual(b2.status, Batch.STATUS_DONE)
+        self.assertEqual(b1.worker, "worker")
+
+    @requests_mock.Mocker()
+    def test_batch_that_fails_to_run_is_blocked(self, mocker):
+        mocker.get(Client.ENDPOINT_PROFILE, exc=requests.exceptions.ConnectTimeout)
+        user = User.objects.create(username="user1")
+        Token.objects.create(user=user, value="tokenvalue")
+        batch = self.create("user1")
+        process_batches("worker", until_empty=True)
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, Batch.STATUS_BLOCKED)
+        self.assertIn("The batch failed", batch.message)
+        # Not reclaimed and run again
+        self.assertEqual(Batch.objects.reclaim_expired(), 0)
+
+
+class LeaseTests(TestCase):
+    def claimed(self, user="user1"):
+        Batch.objects.create(name="batch", user=user)
+        return Batch.objects.claim_next("worker")
+
+    def expire(self, batch):
+        Batch.objects.filter(pk=batch.pk).update(
+            lease_expires_at=now() - timedelta(seconds=1)
+        )
+
+    def test_reclaims_only_expired_leases(self):
+        b1 = self.claimed("user1")
+        b2 = self.claimed("user2")
+        self.expire(b1)
+        self.assertEqual(Batch.objects.reclaim_expired(), 1)
+        b1.refresh_from_db()
+        b2.refresh_from_db()
+        self.assertEqual(b1.status, Batch.STATUS_INITIAL)
+        self.assertIsNone(b1.worker)
+        self.assertEqual(b2.status, Batch.STATUS_RUNNING)
+        self.assertEqual(b2.worker, "worker")
+        self.assertEqual(Batch.objects.claim_next("other").pk, b1.pk)
+
+    def test_reclaimed_batch_resumes_from_first_command_not_done(self):
+        batch = self.claimed()
+        for index, status in enumerate(
+            [
+                BatchCommand.STATUS_DONE,
+                BatchCommand.STATUS_RUNNING,
+                BatchCommand.STATUS_RUNNING,
+                BatchCommand.STATUS_INITIAL,
+            ]
+        ):
+            batch.batchcommand_set.create(index=index, raw="", json={}, status=status)
+        self.expire(batch)
+        Batch.objects.reclaim_expired()
+        batch.refresh_from_db()
+        self.assertEqual(batch.running_commands, 0)
+        self.assertEqual(batch.initial_commands, 3)
+        self.assertEqual(batch.done_commands, 1)
+        self.assertEqual(
+            [c.status for c in batch.commands()],
+            [
+                BatchCommand.STATUS_DONE,
+                BatchCommand.STATUS_INITIAL,
+                BatchCommand.STATUS_INITIAL,
+                BatchCommand.STATUS_INITIAL,
+            ],
+        )
+
+    def test_heartbeat_extends_lease(self):
+        batch = self.claimed()
+        self.expire(batch)
+        self.assertTrue(batch.heartbeat())
+        batch.refresh_from_db()
+        self.assertGreater(batch.lease_expires_at, now())
+        self.assertIsNotNone(batch.last_heartbeat)
+        self.assertEqual(Batch.objects.reclaim_expired(), 0)
+
+    def test_heartbeat_fails_after_losing_the_batch(self):
+        batch = self.claimed()
+        self.expire(batch)
+        Batch.objects.reclaim_expired()
+        Batch.objects.claim_next("other")
+        self.assertFalse(batch.heartbeat())
+
+    def test_stale_worker_does_not_overwrite_the_status(self):
+        batch = self.claimed()
+        self.expire(batch)
+        Batch.objects.reclaim_expired()
+        Batch.objects.claim_next("other")
+        batch.finish()
+        self.assertTrue(batch.is_running)
+        self.assertEqual(batch.worker, "other")
+
+        Batch.objects.filter(pk=batch.pk).update(status=Batch.STATUS_STOPPED)
+        batch.block_with_message("blocked")
+        batch.refresh_from_db()
+        self.assertTrue(batch.is_stopped)
+
+    def test_stop_between_the_claim_and_the_run_is_kept(self):
+        batch = self.claimed()
+        Batch.objects.get(pk=batch.pk).stop()
+        self.assertFalse(batch.start())
+        self.assertTrue(batch.is_stopped)
+        batch.run()
+        batch.refresh_from_db()
+        self.assertTrue(batch.is_stopped)
+
+    @override_settings(BATCH_STOP_CHECK_COMMANDS=1)
+    @requests_mock.Mocker()
+    def test_run_stops_after_losing_the_batch(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.create_item(mocker, "Q1")
+        user = User.objects.create(username="user1")
+        Token.objects.create(user=user, value="tokenvalue")
+        batch = self.claimed()
+        batch.batchcommand_set.create(
+            index=0,
+            raw="CREATE",
+            json={"action": "create", "type": "item"},
+            operation="create_item",
+        )
+        Batch.objects.filter(pk=batch.pk).update(worker="other")
+        batch.run()
+        self.assertEqual(batch.commands()[0].status, BatchCommand.STATUS_INITIAL)
+        batch.refresh_from_db()
+        self.assertEqual(batch.worker, "other")
+
+
+class PreviewTests(TestCase):
+    def preview(self, age):
+        batch = Batch.objects.create(
+            name="batch", user="user1", status=Batch.STATUS_PREVIEW
+        )
+        batch.batchcommand_set.create(index=0, raw="", json={})
+        Batch.objects.filter(pk=batch.pk).update(
+            modified=now() - timedelta(seconds=age)
+        )
+        return batch
+
+    @override_settings(BATCH_PREVIEW_SECONDS=60)
+    def test_deletes_only_expired_previews(self):
+        expired = self.preview(120)
+        recent = self.preview(10)
+        started = self.preview(120)
+        self.assertTrue(started.allow_start())
+        self.assertFalse(started.allow_start())
+
+        self.assertEqual(Batch.objects.delete_expired_previews(), 1)
+        self.assertFalse(Batch.objects.filter(pk=expired.pk).exists())
+        self.assertFalse(BatchCommand.objects.filter(batch_id=expired.pk).exists())
+        self.assertEqual(
+            set(Batch.objects.values_list("pk", flat=True)), {recent.pk, started.pk}
+        )
+        self.assertEqual(list(Batch.objects.visible()), [started])
+
+    def test_previews_can_not_be_stopped(self):
+        preview = self.preview(0)
+        preview.stop()
+        preview.restart()
+        preview.refresh_from_db()
+        self.assertTrue(preview.is_preview)
+
+
+class ImportTests(TestCase):
+    V1 = 'CREATE||LAST|Len|"new"||Q1|P1||Q1|P31|Q5||Q2|Den|"d"'
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media = override_settings(MEDIA_ROOT=media_root.name)
+        media.enable()
+        self.addCleanup(media.disable)
+
+    def submit(self, batch_type="v1", source=V1, compress=False):
+        batch = Batch(name="batch", user="user1")
+        data = source.encode()
+        if compress:
+            data = gzip.compress(data)
+        upload = ContentFile(data, "commands.txt")
+        return BatchImport.objects.submit(batch, batch_type, upload)
+
+    def fields(self, commands):
+        return [(c.index, c.raw, c.json, c.status, c.operation) for c in commands]
+
+    @override_settings(BATCH_INSERT_SIZE=2)
+    def test_workers_parse_imports_in_chunks(self):
+        batch_import = self.submit(compress=True)
+        batch = batch_import.batch
+        self.assertTrue(batch.is_preview)
+        self.assertFalse(batch.allow_start())
+        storage, name = batch_import.source_file.storage, batch_import.source_file.name
+        self.assertTrue(storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            process_batches("worker", until_empty=True)
+        batch_import.refresh_from_db()
+        batch.refresh_from_db()
+        self.assertTrue(batch_import.is_done)
+        self.assertFalse(batch_import.source_file)
+        self.assertFalse(storage.exists(name))
+        self.assertEqual(batch_import.total_lines, 5)
+        self.assertEqual(batch_import.parsed_lines, 5)
+        self.assertEqual(
+            self.fields(batch.commands()),
+            self.fields(V1CommandParser().iter_commands(self.V1)),
+        )
+        self.assertEqual(batch.total_commands, 5)
+        self.assertEqual(batch.error_commands, 1)
+        self.assertTrue(batch.is_preview)
+        self.assertTrue(batch.allow_start())
+
+    def test_import_that_can_not_be_parsed(self):
+        batch_import = self.submit("csv", "P31,qid\nQ5,Q1\n")
+        batch_import = BatchImport.objects.claim_next("worker")
+        run_import(batch_import)
+        batch_import.refresh_from_db()
+        self.assertTrue(batch_import.is_error)
+        self.assertTrue(batch_import.message)
+        self.assertFalse(batch_import.batch.allow_start())
+
+        # Kept until the preview expires
+        storage, name = batch_import.source_file.storage, batch_import.source_file.name
+        self.assertTrue(storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            Batch.objects.delete_expired_previews(max_age=-1)
+        self.assertFalse(BatchImport.objects.exists())
+        self.assertFalse(storage.exists(name))
+
+    @override_settings(BATCH_INSERT_SIZE=2)
+    def test_reclaims_expired_imports(self):
+        batch_import = self.submit()
+        batch_import = BatchImport.objects.claim_next("worker")
+        self.assertIsNone(BatchImport.objects.claim_next("other"))
+        commands = list(V1CommandParser().iter_commands(self.V1, batch_import.batch))
+        self.assertTrue(batch_import.save_commands(commands[:2], 2))
+        BatchImport.objects.filter(pk=batch_import.pk).update(
+            lease_expires_at=now() - timedelta(seconds=1)
+        )
+
+        self.assertEqual(BatchImport.objects.reclaim_expired(), 1)
+        self.assertFalse(batch_import.save_commands(commands[2:], 5))
+        batch = Batch.objects.get(pk=batch_import.batch_id)
+        self.assertEqual(batch.total_commands, 0)
+        self.assertFalse(batch.commands().exists())
+
+        batch_import = BatchImport.objects.claim_next("other")
+        run_import(batch_import)
+        batch.refresh_from_db()
+        self.assertEqual(batch.total_commands, 5)
+        self.assertEqual(batch.commands().count(), 5)
+
+
+def claim_loop(worker, results):
+    """
+    Stand-in for a worker process: claims batches and marks
+    them as done, recording when each batch was held.
+    """
+    while Batch.objects.filter(status=Batch.STATUS_INITIAL).exists():
+        batch = Batch.objects.claim_next(worker)
+        if batch is None:
+            time.sleep(0.01)
+            continue
+        start = time.time()
+        time.sleep(0.02)
+        end = time.time()
+        results.put((batch.pk, batch.user, worker, start, end))
+        Batch.objects.filter(pk=batch.pk).update(status=Batch.STATUS_DONE)
+    connection.close()
+
+
+@skipIf(
+    connection.vendor == "sqlite"
+    and connection.creation.is_in_memory_db(
+        connection.settings_dict["TEST"]["NAME"] or ":memory:"
+    ),
+    "worker processes need a database they can share: define DB_TEST_NAME",
+)
+class MultiProcessClaimTests(TransactionTestCase):
+    PROCESSES = 4
+    USERS = 5
+    BATCHES_PER_USER = 6
+
+    def test_workers_share_batches_safely(self):
+        for i in range(self.BATCHES_PER_USER):
+            for u in range(self.USERS):
+                Batch.objects.create(name=f"b{i}", user=f"user{u}")
+
+        # Child processes must open their own connections
+        connections.close_all()
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        processes = [
+            context.Process(target=claim_loop, args=(f"worker{n}", results))
+            for n in range(self.PROCESSES)
+        ]
+        for p in processes:
+            p.start()
+
+        total = self.USERS * self.BATCHES_PER_USER
+        claims = [results.get(timeout=60) for _ in range(total)]
+        for p in processes:
+            p.join(timeout=60)
+            self.assertEqual(p.exitcode, 0)
+
+        # Every batch was claimed exactly once
+        self.assertEqual(len({pk for pk, *_ in claims}), total)
+        self.assertFalse(Batch.objects.exclude(status=Batch.STATUS_DONE).exists())
+
+        # The load was shared
+        self.assertGreater(len({worker for _, _, worker, _, _ in claims}), 1)
+
+        # No user had two batches running at the same time
+        for u in range(self.USERS):
+            periods = sorted(
+                (start, end) for _, user, _, start, end in claims if user == f"user{u}"
+            )
+            for (_, previous_end), (start, _) in zip(periods, periods[1:]):
+                self.assertGreaterEqual(start, previous_end)
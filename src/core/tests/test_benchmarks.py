@@ -0,0 +1,272 @@
+import os
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest import mock
+from unittest import skipUnless
+
+import requests
+import requests_mock
+from django.contrib.auth.models import User
+from django.core.cache import cache as django_cache
+from django.db import connection
+from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+
+from core.cache import SharedCache
+from core.client import http_session
+from core.models import Batch
+from core.parsers.base import BaseParser
+from core.parsers.csv import CSVCommandParser
+from core.parsers.v1 import V1CommandParser
+from core.tests.test_api import ApiMocker
+from web.models import Token
+
+
+@skipUnless(os.getenv("BENCHMARKS"), "benchmarks only run when BENCHMARKS is defined")
+class Benchmark(TestCase):
+    """
+    Measures the changes made for performance against the way things
+    were done before, reproduced with the current code.
+
+    They print their measurements rather than asserting timings,
+    which depend on the machine.
+    """
+
+    def setUp(self):
+        django_cache.clear()
+        SharedCache.clear_all_local()
+
+    def report(self, title, **measurements):
+        print(f"\n{title}:")
+        for name, value in measurements.items():
+            print(f"  {name.replace('_', ' ')}: {value}")
+
+    def parse(self, text):
+        user, _ = User.objects.get_or_create(username="user")
+        Token.objects.get_or_create(user=user, value="tokenvalue")
+        batch = V1CommandParser().parse("Test", "user", text)
+        batch.save_batch_and_preview_commands()
+        return batch
+
+
+class StopCheckBenchmark(Benchmark):
+    def batch_queries(self, commands, stop_check_commands):
+        with override_settings(
+            BATCH_STOP_CHECK_COMMANDS=stop_check_commands, BATCH_STOP_CHECK_SECONDS=60
+        ):
+            batch = self.parse(
+                "||".join(f'Q1|Lpt|"label {i}"' for i in range(commands))
+            )
+            with CaptureQueriesContext(connection) as context:
+                batch.run()
+        self.assertEqual(batch.status, Batch.STATUS_DONE)
+        # Apart from the command counter updates
+        return len(
+            [
+                q
+                for q in context.captured_queries
+                if '"core_batch"' in q["sql"]
+                and '_commands" = ("core_batch".' not in q["sql"]
+            ]
+        )
+
+    @requests_mock.Mocker()
+    def test_stop_check_queries(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        ApiMocker.item_empty(mocker, "Q1")
+        ApiMocker.patch_item_successful(mocker, "Q1", {})
+        # Checking on every command stands for refreshing the batch before
+        # each one, in each of the loops over the commands
+        self.report(
+            "core_batch queries for a 100 command batch",
+            checking_every_command=self.batch_queries(100, 1),
+            checking_every_50_commands=self.batch_queries(100, 50),
+        )
+
+
+class ConnectionPoolBenchmark(Benchmark):
+    def test_pooled_session(self):
+        connections = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Otherwise each response waits for the client's delayed ACK
+            disable_nagle_algorithm = True
+
+            def handle(self):
+                connections.append(self.client_address)
+                super().handle()
+
+            def answer(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            do_GET = answer
+            do_PATCH = answer
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = f"http://127.0.0.1:{server.server_port}/entities/items/Q1"
+
+        def ms_per_command(http, commands=2000):
+            # A command reads the entity, then edits it
+            connections.clear()
+            start = time.perf_counter()
+            for i in range(commands):
+                http.get(url).json()
+                http.patch(url, json={"patch": [], "comment": f"edit {i}"}).json()
+            return f"{(time.perf_counter() - start) * 1000 / commands:.2f} ms/command"
+
+        try:
+            module_level = ms_per_command(requests)
+            module_level_connections = len(connections)
+            pooled = ms_per_command(http_session())
+            pooled_connections = len(connections)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        self.report(
+            "2000 commands of GET and PATCH on a local server",
+            module_level_requests=f"{module_level}, {module_level_connections} connections",
+            pooled_session=f"{pooled}, {pooled_connections} connections",
+        )
+
+
+class CSVRawBenchmark(Benchmark):
+    def test_raw_text_of_csv_commands(self):
+        def mb(size):
+            return f"{size / 1024 / 1024:.1f} MB"
+
+        measurements = {}
+        for rows in [5000, 20000]:
+            # Three commands per row: a label, a description and a statement
+            csv = "qid,Len,Den,P31\n" + "".join(
+                f"Q{i},label {i},description {i},Q5\n" for i in range(rows)
+            )
+            tracemalloc.start()
+            commands = list(CSVCommandParser().iter_commands(csv))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            raw = sum(len(command.raw.encode("utf-8")) for command in commands)
+            # Before, every command kept the whole CSV as its raw text
+            measurements[f"{rows}_rows_({mb(len(csv))}_CSV)"] = (
+                f"{mb(len(commands) * len(csv))} before, {mb(raw)} now, "
+                f"{mb(peak)} peak while parsing"
+            )
+        self.report("raw text stored for the commands of a CSV", **measurements)
+
+
+class ParseValueBenchmark(Benchmark):
+    VALUES = [
+        "Q1",
+        "LAST",
+        "somevalue",
+        '"text"',
+        'pt:"texto"',
+        '"""https://a.b"""',
+        '"""a.jpg"""',
+        '"""id"""',
+        "+1967-01-17T00:00:00Z/11",
+        "@1.5/-2",
+        "12",
+        "9.6~0.1U11573",
+    ]
+
+    def every_parser_in_order(self, parser):
+        """
+        Returns a parse_value trying every parser in turn, as it did before.
+
+        The parsers matched pattern strings through the cache of `re` back
+        then, so this only measures the dispatch by the first character.
+        """
+        every_parser = [
+            parser.parse_value_somevalue_novalue,
+            parser.parse_value_entity,
+            parser.parse_value_url,
+            parser.parse_value_commons_media_file,
+            parser.parse_value_external_id,
+            parser.parse_value_monolingualtext,
+            parser.parse_value_string,
+            parser.parse_value_time,
+            parser.parse_value_location,
+            parser.parse_value_quantity,
+        ]
+
+        def parse_value(v):
+            for fn in every_parser:
+                ret = fn(v)
+                if ret is not None:
+                    return ret
+            return None
+
+        return parse_value
+
+    def seconds(self, fn, inputs, calls=200000):
+        start = time.perf_counter()
+        for i in range(calls):
+            fn(inputs[i % len(inputs)])
+        return f"{time.perf_counter() - start:.2f} s"
+
+    def test_parse_value(self):
+        parser = BaseParser()
+        self.report(
+            "200k calls of parse_value",
+            every_parser_in_order=self.seconds(
+                self.every_parser_in_order(parser), self.VALUES
+            ),
+            by_first_character=self.seconds(parser.parse_value, self.VALUES),
+        )
+
+    def test_parse_command(self):
+        lines = [f"Q1\tP1\t{v}" for v in self.VALUES] + [
+            "CREATE",
+            'LAST\tLen\t"label"',
+            "-Q1\tP31\tQ5",
+        ]
+        parser = V1CommandParser()
+        dispatching = self.seconds(parser.parse_command, lines)
+        parser.parse_value = self.every_parser_in_order(parser)
+        self.report(
+            "200k calls of the V1 parse_command",
+            every_parser_in_order=self.seconds(parser.parse_command, lines),
+            by_first_character=dispatching,
+        )
+
+
+class ParserPoolBenchmark(Benchmark):
+    @override_settings(PARSER_PROCESSES=4, PARSER_PARALLEL_MIN_LINES=50000)
+    def test_parser_pool(self):
+        raw = "\n".join(f'Q{i}\tP31\tQ5\nQ{i}\tLen\t"label {i}"' for i in range(100000))
+
+        def parse():
+            start = time.perf_counter()
+            commands = list(V1CommandParser().iter_commands(raw))
+            return commands, f"{time.perf_counter() - start:.2f} s"
+
+        serial, serial_seconds = parse()
+        with mock.patch("core.parsers.parallel._pool_enabled", True):
+            # The first parse starts the processes
+            parse()
+            parallel, parallel_seconds = parse()
+        self.assertEqual(
+            [(c.index, c.raw, c.json) for c in parallel],
+            [(c.index, c.raw, c.json) for c in serial],
+        )
+        self.report(
+            f"200k V1 commands, with {os.cpu_count()} CPUs",
+            serial=serial_seconds,
+            in_4_processes=parallel_seconds,
+        )
@@ -0,0 +1,64 @@
+import time
+from unittest import mock
+
+from django.core.cache import cache as django_cache
+from django.test import TestCase
+
+from core.cache import NOT_FOUND
+from core.cache import SharedCache
+
+
+class SharedCacheTests(TestCase):
+    def setUp(self):
+        django_cache.clear()
+        self.cache = SharedCache("test", ttl=60, not_found_ttl=10, max_size=2)
+
+    def test_get_and_set(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", 1)
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "local": 1})
+
+    def test_not_found(self):
+        self.cache.set_not_found("a")
+        self.assertEqual(self.cache.get("a"), NOT_FOUND)
+
+    def test_shared_between_instances(self):
+        self.cache.set("a", 1)
+        other = SharedCache("test", ttl=60, not_found_ttl=10, max_size=2)
+        self.assertEqual(other.get("a"), 1)
+        self.assertEqual(other.stats()["local"], 1)
+
+    def test_local_copy_expires_with_the_shared_entry(self):
+        self.cache.set("a", 1)
+        other = SharedCache("test", ttl=60, not_found_ttl=10, max_size=2)
+        later = time.time() + 50
+        with mock.patch("core.cache.time.time", return_value=later):
+            self.assertEqual(other.get("a"), 1)
+        expires, _ = other.local["a"]
+        self.assertLessEqual(expires - time.monotonic(), 10)
+
+        with mock.patch("core.cache.time.time", return_value=later + 10):
+            other.clear_local()
+            self.assertIsNone(other.get("a"))
+
+    def test_least_recently_used_is_evicted_from_local(self):
+        self.cache.set("a", 1)
+        self.cache.set("b", 2)
+        self.cache.get("a")
+        self.cache.set("c", 3)
+        self.assertEqual(list(self.cache.local.keys()), ["a", "c"])
+        # Still in the shared level
+        self.assertEqual(self.cache.get("b"), 2)
+
+    def test_expired_entries(self):
+        cache = SharedCache("expiring", ttl=0, not_found_ttl=0, max_size=2)
+        cache.set("a", 1)
+        self.assertIsNone(cache.get("a"))
+        cache.set_not_found("b")
+        self.assertIsNone(cache.get("b"))
+
+    def test_clear_all_local(self):
+        self.cache.set("a", 1)
+        SharedCache.clear_all_local()
+        self.assertEqual(self.cache.stats(), {"hits": 0, "misses": 0, "local": 0})
@@ -1,5 +1,10 @@
+from unittest import mock
+
 from django.test import TestCase
+from django.test import override_settings
 
+from core.parsers.base import ParserException
+from core.parsers.csv import Column
 from core.parsers.csv import CSVCommandParser
 
 
@@ -77,6 +82,33 @@ class TestCSVParser(TestCase):
             context.exception.message, "A valid property must precede a source"
         )
 
+    def test_compile_header(self):
+        parser = CSVCommandParser()
+        header = ["qid", "P31", "qal580", "S143", "s813", "#", "-Len", "Senwiki", "X"]
+        self.assertEqual(
+            parser.compile_header(header),
+            [
+                Column(Column.QID),
+                Column(Column.STATEMENT, action="add", name="P31"),
+                Column(Column.QUALIFIER, name="P580"),
+                Column(Column.SOURCE, name="P143", new_reference=True),
+                Column(Column.SOURCE, name="P813"),
+                Column(Column.COMMENT),
+                Column(Column.TERM, action="remove", what="label", name="en"),
+                Column(Column.TERM, action="add", what="sitelink", name="enwiki"),
+                Column(Column.IGNORED),
+            ],
+        )
+
+    def test_parse_row_with_more_cells_than_the_header(self):
+        parser = CSVCommandParser()
+        columns = parser.compile_header(["qid", "P31"])
+        with self.assertRaises(ParserException) as context:
+            parser.parse_row(["Q1", "Q5", "Q6"], columns)
+        self.assertEqual(
+            context.exception.message, "CSV row has more cells than the header"
+        )
+
     def test_parse_item(self):
         parser = CSVCommandParser()
 
@@ -723,3 +755,18 @@ class TestCSVParser(TestCase):
                 },
             ],
         )
+
+    def test_parallel_parse_keeps_the_order(self):
+        rows = "".join(f"Q{i},Q5,{i},\n" for i in range(20))
+        text = "qid,P31,Len,Den\n" + rows
+        fields = ["index", "raw", "json", "status", "message", "operation"]
+        serial = list(CSVCommandParser().iter_commands(text))
+        with override_settings(
+            PARSER_PROCESSES=2, PARSER_PARALLEL_MIN_LINES=10, PARSER_CHUNK_SIZE=3
+        ), mock.patch("core.parsers.parallel._pool_enabled", True):
+            parallel = list(CSVCommandParser().iter_commands(text))
+        self.assertEqual(len(parallel), 40)
+        self.assertEqual(
+            [[getattr(c, f) for f in fields] for c in parallel],
+            [[getattr(c, f) for f in fields] for c in serial],
+        )
@@ -0,0 +1,69 @@
+import gzip
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase
+
+from core.parsers.base import ParserException
+from core.parsers.csv import CSVCommandParser
+from core.parsers.uploads import open_upload
+from core.parsers.uploads import upload_size
+from core.parsers.v1 import V1CommandParser
+
+
+class TestUploads(TestCase):
+    V1 = 'CREATE\r\nLAST|Len|"ação"\r\nQ1|P31|Q5||Q2|Den|"d"\r\n' * 100
+    CSV = 'qid,Len,P31\r\n,"ação, ""a""",Q5\r\nQ1,"line\r\nbreak",Q5\r\n'
+
+    def upload(self, text, compress=False, bom=False):
+        data = text.encode("utf-8-sig" if bom else "utf-8")
+        if compress:
+            data = gzip.compress(data)
+        return SimpleUploadedFile("commands.txt", data)
+
+    def fields(self, commands):
+        return [(c.index, c.raw, c.json, c.status, c.operation) for c in commands]
+
+    def test_v1_upload_is_parsed_like_the_text(self):
+        expected = self.fields(V1CommandParser().iter_commands(self.V1))
+        for compress in [False, True]:
+            source = open_upload(self.upload(self.V1, compress))
+            commands = V1CommandParser().iter_commands(source)
+            self.assertEqual(self.fields(commands), expected)
+
+    def test_csv_upload_is_parsed_like_the_text(self):
+        expected = self.fields(CSVCommandParser().iter_commands(self.CSV))
+        for compress in [False, True]:
+            source = open_upload(self.upload(self.CSV, compress, bom=True))
+            commands = CSVCommandParser().iter_commands(source)
+            self.assertEqual(self.fields(commands), expected)
+
+    def test_limits(self):
+        size = len(self.V1.encode())
+        lines = self.V1.count("\n")
+        self.assertEqual(upload_size(self.upload(self.V1, compress=True)), size)
+        for compress in [False, True]:
+            with self.assertRaisesRegex(ParserException, "larger than"):
+                open_upload(self.upload(self.V1, compress), max_size=size - 1)
+            source = open_upload(self.upload(self.V1, compress), max_lines=lines - 1)
+            with self.assertRaisesRegex(ParserException, "more than"):
+                source.read()
+            source = open_upload(self.upload(self.V1, compress), size, lines)
+            self.assertEqual(source.read(), self.V1)
+
+    def test_size_is_checked_while_reading_gzip(self):
+        data = bytearray(gzip.compress(self.V1.encode() * 100))
+        # The size recorded at the end of the file can lie
+        data[-4:] = (10).to_bytes(4, "little")
+        source = open_upload(SimpleUploadedFile("commands.gz", bytes(data)), 100)
+        with self.assertRaisesRegex(ParserException, "larger than"):
+            source.read()
+
+    def test_invalid_files(self):
+        source = open_upload(SimpleUploadedFile("commands.txt", b"Q1|Len|\xe3o"))
+        with self.assertRaises(UnicodeDecodeError):
+            source.read()
+        data = bytearray(gzip.compress(self.V1.encode()))
+        data[20:40] = bytes(20)
+        source = open_upload(SimpleUploadedFile("commands.gz", bytes(data)))
+        with self.assertRaisesRegex(ParserException, "could not be read"):
+            source.read()
@@ -1,4 +1,8 @@
+import io
+from unittest import mock
+
 from django.test import TestCase
+from django.test import override_settings
 
 from core.parsers.v1 import V1CommandParser
 
@@ -724,3 +728,47 @@ class TestV1ParserCommand(TestCase):
         self.assertEqual(
             context.exception.message, "REMOVE_REF command must have 1 reference"
         )
+
+
+class TestV1ParserStreaming(TestCase):
+    RAW = 'CREATE||LAST|Len|"a"|||Q1|P1|Q2\n\n  Q3\tP4\t"x|y"  ||||Q5|Dpt|"d"\r\n'
+
+    def old_raw_commands(self, raw):
+        commands = raw.replace("||", "\n").replace("|", "\t")
+        return [c.strip() for c in commands.split("\n") if c.strip()]
+
+    def test_raw_commands_in_any_chunk_size(self):
+        expected = self.old_raw_commands(self.RAW)
+        for read_size in range(1, len(self.RAW) + 2):
+            parser = V1CommandParser()
+            parser.READ_SIZE = read_size
+            self.assertEqual(list(parser.iter_raw_commands(self.RAW)), expected)
+
+    def test_commands_from_a_file(self):
+        parser = V1CommandParser()
+        parser.READ_SIZE = 7
+        commands = list(parser.iter_commands(io.StringIO(self.RAW)))
+        batch = V1CommandParser().parse("batch", "user", self.RAW)
+        self.assertEqual(
+            [(c.index, c.raw, c.json, c.status) for c in commands],
+            [(c.index, c.raw, c.json, c.status) for c in batch.get_preview_commands()],
+        )
+        self.assertEqual(len(commands), 5)
+
+    def test_parallel_parse_keeps_the_order(self):
+        raw = "||".join(f'Q{i}|P31|Q5||Q{i}|Len|"{i}"||Q{i}|P1|bad' for i in range(20))
+        fields = ["index", "raw", "json", "status", "message", "operation"]
+        with override_settings(
+            PARSER_PROCESSES=2, PARSER_PARALLEL_MIN_LINES=10, PARSER_CHUNK_SIZE=7
+        ):
+            # Only where the pool was enabled, in the workers
+            with mock.patch("core.parsers.parallel.get_pool") as get_pool:
+                serial = list(V1CommandParser().iter_commands(raw))
+            get_pool.assert_not_called()
+            with mock.patch("core.parsers.parallel._pool_enabled", True):
+                parallel = list(V1CommandParser().iter_commands(raw))
+        self.assertEqual(len(parallel), 60)
+        self.assertEqual(
+            [[getattr(c, f) for f in fields] for c in parallel],
+            [[getattr(c, f) for f in fields] for c in serial],
+        )
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 import os
+import sys
 
 from pathlib import Path
 from dotenv import load_dotenv
@@ -93,6 +94,23 @@ DATABASES = {
         "PASSWORD": os.getenv("DB_PASSWORD"),
         "HOST": os.getenv("DB_HOST", "mariadb"),
         "PORT": os.getenv("DB_PORT", 3306),
+        "TEST": {
+            # Set this to run the tests against a file based SQLite database,
+            # which is needed for the tests that use multiple processes.
+            "NAME": os.getenv("DB_TEST_NAME"),
+        },
+    },
+}
+
+
+# Cache shared by the web and the worker processes, behind the property and
+# label caches. The database cache needs its table: run `createcachetable`.
+# https://docs.djangoproject.com/en/5.0/ref/settings/#caches
+
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("CACHE_BACKEND", "django.core.cache.backends.db.DatabaseCache"),
+        "LOCATION": os.getenv("CACHE_LOCATION", "qsts3_cache"),
     },
 }
 
@@ -135,6 +153,11 @@ STATIC_URL = "/static/"
 
 STATIC_ROOT = os.getenv("STATIC_ROOT", os.path.join(BASE_DIR, "static"))
 
+# Uploaded files, such as the batches parsed by the workers, which must share it
+# https://docs.djangoproject.com/en/5.0/ref/settings/#media-root
+
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", os.path.join(BASE_DIR, "media"))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -209,3 +232,65 @@ BASE_REST_URL = os.getenv(
 
 # To use with EditGroups integration
 TOOLFORGE_TOOL_NAME = os.getenv("TOOLFORGE_TOOL_NAME")
+
+# Batch workers (send_batches)
+# Number of worker threads started by each send_batches process
+SEND_BATCHES_WORKERS = int(os.getenv("SEND_BATCHES_WORKERS", 4))
+# How long a worker holds the claim of a batch without sending a heartbeat.
+# After that, another worker can reclaim it.
+BATCH_LEASE_SECONDS = int(os.getenv("BATCH_LEASE_SECONDS", 30))
+# How often workers look for batches whose lease expired
+BATCH_RECLAIM_SECONDS = int(os.getenv("BATCH_RECLAIM_SECONDS", 10))
+# A running batch checks if it was stopped, sending a heartbeat,
+# after this many commands or seconds, whichever comes first.
+BATCH_STOP_CHECK_COMMANDS = int(os.getenv("BATCH_STOP_CHECK_COMMANDS", 50))
+BATCH_STOP_CHECK_SECONDS = float(os.getenv("BATCH_STOP_CHECK_SECONDS", 2))
+# Status changes of the commands of a running batch are written in bulk,
+# after this many commands or seconds, and when the batch stops.
+BATCH_COMMAND_BUFFER_SIZE = int(os.getenv("BATCH_COMMAND_BUFFER_SIZE", 50))
+BATCH_COMMAND_BUFFER_SECONDS = float(os.getenv("BATCH_COMMAND_BUFFER_SECONDS", 2))
+# How often workers recalculate the command counters of running batches
+BATCH_RECONCILE_SECONDS = int(os.getenv("BATCH_RECONCILE_SECONDS", 300))
+# Commands of a new batch are inserted this many at a time
+BATCH_INSERT_SIZE = int(os.getenv("BATCH_INSERT_SIZE", 1000))
+# Batches with at least PARSER_PARALLEL_MIN_LINES lines, or CSV rows, are parsed
+# in PARSER_PROCESSES processes, PARSER_CHUNK_SIZE lines at a time, by the
+# send_batches workers. The processes run the Python of PARSER_EXECUTABLE.
+PARSER_PROCESSES = int(os.getenv("PARSER_PROCESSES", min(4, os.cpu_count() or 1)))
+PARSER_EXECUTABLE = os.getenv("PARSER_EXECUTABLE", sys.executable)
+PARSER_PARALLEL_MIN_LINES = int(os.getenv("PARSER_PARALLEL_MIN_LINES", 50000))
+PARSER_CHUNK_SIZE = int(os.getenv("PARSER_CHUNK_SIZE", 5000))
+# Submissions with at least this many characters are parsed by the workers
+BATCH_IMPORT_MIN_SIZE = int(os.getenv("BATCH_IMPORT_MIN_SIZE", 1000000))
+# Uploaded files of commands are refused above this size, once decompressed,
+# or this number of lines
+BATCH_UPLOAD_MAX_SIZE = int(os.getenv("BATCH_UPLOAD_MAX_SIZE", 100 * 1024 * 1024))
+BATCH_UPLOAD_MAX_LINES = int(os.getenv("BATCH_UPLOAD_MAX_LINES", 1000000))
+# Previews that are not started in this many seconds are deleted by the workers
+BATCH_PREVIEW_SECONDS = int(os.getenv("BATCH_PREVIEW_SECONDS", 24 * 60 * 60))
+
+# Shared cache of property value types, in each process and in the Django cache.
+# Properties that don't exist are remembered for less time.
+PROPERTY_CACHE_SECONDS = int(os.getenv("PROPERTY_CACHE_SECONDS", 24 * 60 * 60))
+PROPERTY_CACHE_NOT_FOUND_SECONDS = int(
+    os.getenv("PROPERTY_CACHE_NOT_FOUND_SECONDS", 10 * 60)
+)
+PROPERTY_CACHE_LOCAL_SIZE = int(os.getenv("PROPERTY_CACHE_LOCAL_SIZE", 10000))
+
+# Shared cache of entity labels, by wikibase, entity id and language.
+# Entities without a label are remembered for less time.
+LABEL_CACHE_SECONDS = int(os.getenv("LABEL_CACHE_SECONDS", 60 * 60))
+LABEL_CACHE_NOT_FOUND_SECONDS = int(os.getenv("LABEL_CACHE_NOT_FOUND_SECONDS", 10 * 60))
+LABEL_CACHE_LOCAL_SIZE = int(os.getenv("LABEL_CACHE_LOCAL_SIZE", 10000))
+
+# Connections kept alive to each API host, in each process
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))
+# Seconds to wait for the API, well under BATCH_LEASE_SECONDS, so that a slow
+# request doesn't outlive the lease of the batch that sent it
+HTTP_TIMEOUT_SECONDS = float(os.getenv("HTTP_TIMEOUT_SECONDS", 10))
+
+# Batch page progress events, streamed when served through ASGI
+# Each process reads a followed batch once every BATCH_EVENTS_POLL_SECONDS.
+BATCH_EVENTS_POLL_SECONDS = float(os.getenv("BATCH_EVENTS_POLL_SECONDS", 1))
+BATCH_EVENTS_KEEPALIVE_SECONDS = float(os.getenv("BATCH_EVENTS_KEEPALIVE_SECONDS", 15))
+BATCH_EVENTS_RETRY_SECONDS = int(os.getenv("BATCH_EVENTS_RETRY_SECONDS", 5))
@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+from django.conf import settings
+
+from core.models import Batch
+
+# Batch fields sent in the progress events
+PROGRESS_FIELDS = ["status", *Batch.COUNTERS]
+
+
+class BatchWatch:
+    """
+    Reads the progress of a batch for every event stream
+    of this process that is following it.
+
+    The batch is read once every `settings.BATCH_EVENTS_POLL_SECONDS`,
+    no matter how many streams there are, and the streams are woken up
+    only when the progress changed.
+    """
+
+    def __init__(self, pk):
+        self.pk = pk
+        self.streams = 0
+        self.progress = None
+        self.version = 0
+        self.changed = asyncio.Condition()
+        self.task = None
+
+    async def read(self):
+        progress = (
+            await Batch.objects.filter(pk=self.pk).values(*PROGRESS_FIELDS).afirst()
+        )
+        return progress or {"status": None}
+
+    async def poll(self):
+        while True:
+            progress = await self.read()
+            if progress != self.progress:
+                async with self.changed:
+                    self.progress = progress
+                    self.version += 1
+                    self.changed.notify_all()
+            await asyncio.sleep(settings.BATCH_EVENTS_POLL_SECONDS)
+
+    async def wait(self, version, timeout):
+        """
+        Returns the progress once its version is newer than `version`,
+        or None after `timeout` seconds.
+        """
+        async with self.changed:
+            try:
+                await asyncio.wait_for(
+                    self.changed.wait_for(lambda: self.version > version), timeout
+                )
+            except asyncio.TimeoutError:
+                return None
+            return self.progress
+
+
+watches = {}
+
+
+def follow(pk):
+    watch = watches.get(pk)
+    if watch is None:
+        watch = watches[pk] = BatchWatch(pk)
+        watch.task = asyncio.create_task(watch.poll())
+    watch.streams += 1
+    return watch
+
+
+def unfollow(watch):
+    watch.streams -= 1
+    if watch.streams == 0:
+        watch.task.cancel()
+        del watches[watch.pk]
+
+
+def event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+async def progress_events(pk):
+    """
+    Yields server-sent events for the progress of a batch.
+
+    The first `progress` event has every field, the next ones only
+    the fields that changed. An `end` event is sent, and the stream
+    closed, once the batch is no longer initial or running.
+
+    Comments are sent every `settings.BATCH_EVENTS_KEEPALIVE_SECONDS`
+    without changes, to keep the connection open.
+    """
+    watch = follow(pk)
+    try:
+        yield f"retry: {settings.BATCH_EVENTS_RETRY_SECONDS * 1000}\n\n"
+        sent = {}
+        version = 0
+        while True:
+            progress = await watch.wait(
+                version, settings.BATCH_EVENTS_KEEPALIVE_SECONDS
+            )
+            if progress is None:
+                yield ": keep-alive\n\n"
+                continue
+            version = watch.version
+            changes = {
+                field: value
+                for field, value in progress.items()
+                if sent.get(field) != value
+            }
+            if changes:
+                yield event("progress", changes)
+                sent = progress
+            if progress["status"] not in [Batch.STATUS_INITIAL, Batch.STATUS_RUNNING]:
+                yield event("end", {"status": progress["status"]})
+                return
+    finally:
+        unfollow(watch)
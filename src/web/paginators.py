@@ -0,0 +1,62 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class IndexPage:
+    """
+    A page of batch commands, delimited by their indexes.
+
+    `total` is the number of commands in the listing, as counted
+    by the batch counters.
+    """
+
+    object_list: list
+    has_previous: bool
+    has_next: bool
+    total: int
+
+    def has_other_pages(self):
+        return self.has_previous or self.has_next
+
+    @property
+    def first_index(self):
+        return self.object_list[0].index if self.object_list else None
+
+    @property
+    def last_index(self):
+        return self.object_list[-1].index if self.object_list else None
+
+
+def parse_index(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def index_page(queryset, page_size, total, after=None, before=None, last=False):
+    """
+    Keyset pagination over the command index of a single batch.
+
+    Returns the page that comes right after the index `after`,
+    right before the index `before`, the last page when `last`
+    is True, or else the first page.
+
+    Every page is a single query walking the (batch, index) index
+    from its boundary, so the last page costs the same as the first.
+    """
+    if last or before is not None:
+        if before is not None:
+            queryset = queryset.filter(index__lt=before)
+        commands = list(queryset.order_by("-index")[: page_size + 1])
+        has_previous = len(commands) > page_size
+        commands = commands[:page_size][::-1]
+        has_next = before is not None
+    else:
+        if after is not None:
+            queryset = queryset.filter(index__gt=after)
+        commands = list(queryset.order_by("index")[: page_size + 1])
+        has_next = len(commands) > page_size
+        commands = commands[:page_size]
+        has_previous = after is not None
+    return IndexPage(commands, has_previous, has_next, total)
@@ -1,18 +1,34 @@
+import gzip
+import json
+import shutil
+import tempfile
+import zlib
+
 import requests_mock
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth import get_user
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache as django_cache
+from django.db import connection
 from django.test import TestCase
+from django.test import override_settings
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from core.cache import SharedCache
 from core.tests.test_api import ApiMocker
 from core.client import Client as ApiClient
+from web import events
 from web.models import Token
 from web.models import Preferences
 
 from core.models import Batch
 from core.models import BatchCommand
+from core.models import BatchImport
+from core.management.commands.send_batches import process_batches
 from core.parsers.v1 import V1CommandParser
 
 
@@ -20,6 +36,10 @@ class ViewsTest(TestCase):
     URL_NAME = "profile"
     maxDiff = None
 
+    def setUp(self):
+        django_cache.clear()
+        SharedCache.clear_all_local()
+
     def assertInRes(self, substring, response):
         """Checks if a substring is contained in response content"""
         self.assertIn(substring.lower(), str(response.content).lower().strip())
@@ -183,6 +203,71 @@ class ViewsTest(TestCase):
         self.assertEqual(response.context["only_errors"], True)
         self.assertEqual(list(response.context["page"].object_list), [b2, b4])
 
+    def test_batch_commands_keyset_pages(self):
+        batch = Batch.objects.create(name="My new batch", user="mgalves80")
+        for index in range(70):
+            BatchCommand.objects.create(
+                batch=batch,
+                index=index,
+                json={},
+                raw="{}",
+                status=(
+                    BatchCommand.STATUS_ERROR if index % 2 else BatchCommand.STATUS_INITIAL
+                ),
+            )
+        url = f"/batch/{batch.pk}/commands/"
+
+        def indexes(response):
+            return [c.index for c in response.context["page"].object_list]
+
+        response = self.client.get(url)
+        page = response.context["page"]
+        self.assertEqual(indexes(response), list(range(0, 30)))
+        self.assertEqual((page.has_previous, page.has_next, page.total), (False, True, 70))
+        self.assertInRes("?after=29", response)
+        self.assertInRes("#0 to #29 of 70", response)
+
+        response = self.client.get(f"{url}?after=29")
+        page = response.context["page"]
+        self.assertEqual(indexes(response), list(range(30, 60)))
+        self.assertEqual((page.has_previous, page.has_next), (True, True))
+        self.assertInRes("?before=30", response)
+
+        response = self.client.get(f"{url}?after=59")
+        self.assertEqual(indexes(response), list(range(60, 70)))
+        self.assertFalse(response.context["page"].has_next)
+
+        response = self.client.get(f"{url}?before=30")
+        self.assertEqual(indexes(response), list(range(0, 30)))
+        self.assertFalse(response.context["page"].has_previous)
+
+        response = self.client.get(f"{url}?last=1")
+        page = response.context["page"]
+        self.assertEqual(indexes(response), list(range(40, 70)))
+        self.assertEqual((page.has_previous, page.has_next), (True, False))
+
+        response = self.client.get(f"{url}?last=1&show_errors=1")
+        page = response.context["page"]
+        self.assertEqual(indexes(response), list(range(11, 70, 2)))
+        self.assertEqual(page.total, 35)
+        self.assertInRes("?before=11&show_errors=1", response)
+
+    def test_batch_commands_last_page_is_an_index_range(self):
+        batch = Batch.objects.create(name="My new batch", user="mgalves80")
+        BatchCommand.objects.bulk_create(
+            BatchCommand(batch=batch, index=index, json={}, raw="")
+            for index in range(1000)
+        )
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"/batch/{batch.pk}/commands/?last=1")
+        self.assertEqual(response.context["page"].object_list[0].index, 970)
+        queries = [q["sql"] for q in context.captured_queries]
+        commands = [sql for sql in queries if 'FROM "core_batchcommand"' in sql]
+        self.assertEqual(len(commands), 1)
+        self.assertIn('ORDER BY "core_batchcommand"."index" DESC LIMIT 31', commands[0])
+        self.assertNotIn("OFFSET", commands[0])
+        self.assertFalse([sql for sql in queries if "COUNT(" in sql])
+
     def test_existing_batches(self):
         b1 = Batch.objects.create(name="My new batch", user="mgalves80")
         b2 = Batch.objects.create(name="My new batch", user="mgalves80")
@@ -346,26 +431,63 @@ class ViewsTest(TestCase):
         }
         ApiMocker.labels(mocker, api_client, labels)
 
-        response = self.client.get(f"/batch/{batch.pk}/commands/")
-        self.assertEqual(response.status_code, 200)
-        self.assertTemplateUsed("batch_commands.html")
+        def labels_of_page(page_url):
+            """Renders a commands page and loads its missing labels"""
+            response = self.client.get(page_url)
+            self.assertEqual(response.status_code, 200)
+            missing = response.context["missing_labels"]
+            if missing:
+                self.assertNotInRes("English label", response)
+                self.assertNotInRes("Portuguese label", response)
+                self.assertInRes(f'data-label-for="{missing[0]}"', response)
+                return self.client.get(
+                    "/batch/labels/", {"ids": "|".join(missing)}
+                ).json()
+            return {
+                c.entity_id(): c.display_label
+                for c in response.context["page"].object_list
+            }
+
+        url = f"/batch/{batch.pk}/commands/"
+        self.assertEqual(labels_of_page(url), {"Q1234": "English label"})
+        self.assertEqual(mocker.call_count, 1)
+
+        # Now the labels are cached and rendered with the commands
+        response = self.client.get(url)
+        self.assertEqual(response.context["missing_labels"], [])
         self.assertInRes("English label", response)
+        self.assertNotInRes("data-label-for", response)
+        self.assertEqual(mocker.call_count, 1)
 
         # Portuguse uses its label
         prefs = Preferences.objects.create(
             user=user,
             language="pt",
         )
-        response = self.client.get(f"/batch/{batch.pk}/commands/")
-        self.assertEqual(response.status_code, 200)
-        self.assertInRes("Portuguese label", response)
+        self.assertEqual(labels_of_page(url), {"Q1234": "Portuguese label"})
+        self.assertInRes("Portuguese label", self.client.get(url))
 
         # Spanish will use the english label
         prefs.language = "es"
         prefs.save()
-        response = self.client.get(f"/batch/{batch.pk}/commands/")
-        self.assertEqual(response.status_code, 200)
-        self.assertInRes("English label", response)
+        self.assertEqual(labels_of_page(url), {"Q1234": "English label"})
+        self.assertInRes("English label", self.client.get(url))
+
+    def test_entity_labels(self):
+        response = self.client.get("/batch/labels/", {"ids": "Q1|Q2"})
+        self.assertEqual(response.json(), {})
+
+        user, api_client = self.login_user_and_get_token("wikiuser")
+        response = self.client.get("/batch/labels/")
+        self.assertEqual(response.json(), {})
+
+        with requests_mock.Mocker() as mocker:
+            ApiMocker.labels(mocker, api_client, {"Q1": {"en": "label"}})
+            response = self.client.get("/batch/labels/", {"ids": "Q1|Q2"})
+            self.assertEqual(response.json(), {"Q1": "label", "Q2": None})
+            response = self.client.get("/batch/labels/", {"ids": "Q1"})
+            self.assertEqual(response.json(), {"Q1": "label"})
+            self.assertEqual(mocker.call_count, 1)
 
     @requests_mock.Mocker()
     def test_profile_is_autoconfirmed(self, mocker):
@@ -461,6 +583,146 @@ class ViewsTest(TestCase):
         self.assertFalse(response.context["batch"].is_preview)
         self.assertTrue(response.context["batch"].is_initial)
 
+    @requests_mock.Mocker()
+    def test_preview_is_saved_and_started_in_place(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        user, api_client = self.login_user_and_get_token("user")
+
+        response = self.client.post(
+            "/batch/new/",
+            data={"name": "preview", "type": "v1", "commands": "CREATE||LAST|P1|Q1"},
+        )
+        self.assertEqual(response.status_code, 302)
+        batch = Batch.objects.get()
+        self.assertTrue(batch.is_preview)
+        self.assertEqual(self.client.session["preview_batch_pk"], batch.pk)
+        self.assertNotIn("preview_commands", self.client.session)
+        command_pks = list(batch.commands().values_list("pk", flat=True))
+        self.assertEqual(len(command_pks), 2)
+
+        response = self.client.get("/batch/new/preview/")
+        self.assertEqual(response.context["batch"].pk, batch.pk)
+        self.assertEqual(response.context["total_count"], 2)
+
+        # Previews are not listed
+        response = self.client.get("/batches/")
+        self.assertEqual(list(response.context["page"].object_list), [])
+
+        # Nor shown, stopped or restarted by pk, even to their owner
+        for url in ["", "commands/", "summary/"]:
+            response = self.client.get(f"/batch/{batch.pk}/{url}")
+            self.assertEqual(response.status_code, 404)
+        for url in ["stop/", "restart/"]:
+            response = self.client.post(f"/batch/{batch.pk}/{url}")
+            self.assertEqual(response.status_code, 404)
+        batch.refresh_from_db()
+        self.assertTrue(batch.is_preview)
+
+        # Other users don't see it as their preview
+        self.login_user_and_get_token("other")
+        session = self.client.session
+        session["preview_batch_pk"] = batch.pk
+        session.save()
+        response = self.client.get("/batch/new/preview/commands/")
+        self.assertEqual(response.status_code, 404)
+        response = self.client.post("/batch/new/preview/allow_start/")
+        self.assertEqual(response.url, "/batch/new/")
+
+        self.client.force_login(user)
+        session = self.client.session
+        session["preview_batch_pk"] = batch.pk
+        session.save()
+        response = self.client.post("/batch/new/preview/allow_start/")
+        self.assertEqual(response.url, f"/batch/{batch.pk}/")
+        self.assertNotIn("preview_batch_pk", self.client.session)
+        batch.refresh_from_db()
+        self.assertTrue(batch.is_initial)
+        self.assertEqual(
+            list(batch.commands().values_list("pk", flat=True)), command_pks
+        )
+        self.assertEqual(Batch.objects.count(), 1)
+
+    @override_settings(BATCH_IMPORT_MIN_SIZE=20, MEDIA_ROOT=tempfile.mkdtemp())
+    @requests_mock.Mocker()
+    def test_large_preview_is_imported_by_the_workers(self, mocker):
+        self.addCleanup(shutil.rmtree, settings.MEDIA_ROOT)
+        ApiMocker.is_autoconfirmed(mocker)
+        self.login_user_and_get_token("user")
+
+        commands = "||".join(f"Q{i}|P31|Q5" for i in range(40))
+        response = self.client.post(
+            "/batch/new/",
+            data={"name": "large", "type": "v1", "commands": commands},
+        )
+        self.assertEqual(response.status_code, 302)
+        batch = Batch.objects.get()
+        self.assertTrue(batch.is_preview)
+        self.assertEqual(batch.total_commands, 0)
+        with batch.batch_import.source_file.open("rb") as source:
+            self.assertEqual(source.read().decode(), commands)
+
+        response = self.client.get("/batch/new/preview/")
+        self.assertTrue(response.context["importing"])
+        self.assertFalse(response.context["first_page_ready"])
+        response = self.client.get("/batch/new/preview/progress/")
+        self.assertEqual(response.json()["status"], BatchImport.STATUS_INITIAL)
+        self.assertFalse(response.json()["first_page_ready"])
+
+        # It can't be started until every command is imported
+        response = self.client.post("/batch/new/preview/allow_start/")
+        self.assertEqual(response.url, "/batch/new/preview/")
+        batch.refresh_from_db()
+        self.assertTrue(batch.is_preview)
+
+        process_batches("worker", until_empty=True)
+        response = self.client.get("/batch/new/preview/progress/")
+        self.assertEqual(
+            response.json(),
+            {
+                "status": BatchImport.STATUS_DONE,
+                "message": None,
+                "total_lines": 40,
+                "parsed_lines": 40,
+                "total_commands": 40,
+                "error_commands": 0,
+                "first_page_ready": True,
+            },
+        )
+        response = self.client.get("/batch/new/preview/")
+        self.assertFalse(response.context["importing"])
+        self.assertTrue(response.context["first_page_ready"])
+
+        response = self.client.post("/batch/new/preview/allow_start/")
+        self.assertEqual(response.url, f"/batch/{batch.pk}/")
+        batch.refresh_from_db()
+        self.assertTrue(batch.is_initial)
+
+    @override_settings(BATCH_UPLOAD_MAX_LINES=50)
+    @requests_mock.Mocker()
+    def test_new_batch_from_a_gzip_upload(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        self.login_user_and_get_token("user")
+
+        commands = "\n".join(f"Q{i}|P31|Q5" for i in range(40))
+        upload = SimpleUploadedFile("commands.gz", gzip.compress(commands.encode()))
+        response = self.client.post(
+            "/batch/new/", data={"name": "upload", "type": "v1", "file": upload}
+        )
+        self.assertEqual(response.status_code, 302)
+        batch = Batch.objects.get()
+        self.assertTrue(batch.is_preview)
+        self.assertEqual(batch.total_commands, 40)
+        self.assertEqual(batch.commands().last().raw, "Q39\tP31\tQ5")
+
+        commands = "\n".join(f"Q{i}|P31|Q5" for i in range(60))
+        upload = SimpleUploadedFile("commands.txt", commands.encode())
+        response = self.client.post(
+            "/batch/new/", data={"name": "upload", "type": "v1", "file": upload}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["error"], "The file has more than 50 lines")
+        self.assertEqual(Batch.objects.count(), 1)
+
     @requests_mock.Mocker()
     def test_allow_start_after_create_is_not_autoconfirmed(self, mocker):
         ApiMocker.is_not_autoconfirmed(mocker)
@@ -666,6 +928,38 @@ class ViewsTest(TestCase):
         res = self.client.get("/batch/new/preview/commands/")
         self.assertEqual(res.status_code, 200)
 
+    @requests_mock.Mocker()
+    def test_batch_preview_commands_pages(self, mocker):
+        ApiMocker.is_autoconfirmed(mocker)
+        user, api_client = self.login_user_and_get_token("user")
+        ApiMocker.labels(mocker, api_client, {"Q1": {"en": "label"}})
+        commands = "||".join(f"Q1|P1|Q{n}" for n in range(40))
+        res = self.client.post(
+            "/batch/new/", data={"name": "batch", "type": "v1", "commands": commands}
+        )
+        self.assertEqual(res.status_code, 302)
+
+        res = self.client.get("/batch/new/preview/commands/")
+        page = res.context["page"]
+        self.assertEqual([c.index for c in page.object_list], list(range(30)))
+        self.assertEqual((page.has_previous, page.has_next, page.total), (False, True, 40))
+        self.assertInRes("?after=29", res)
+
+        res = self.client.get("/batch/new/preview/commands/?after=29")
+        page = res.context["page"]
+        self.assertEqual([c.index for c in page.object_list], list(range(30, 40)))
+        self.assertEqual((page.has_previous, page.has_next), (True, False))
+
+        res = self.client.get("/batch/new/preview/commands/?before=30")
+        self.assertEqual(
+            [c.index for c in res.context["page"].object_list], list(range(30))
+        )
+
+        res = self.client.get("/batch/new/preview/commands/?last=1")
+        self.assertEqual(
+            [c.index for c in res.context["page"].object_list], list(range(10, 40))
+        )
+
     @requests_mock.Mocker()
     def test_batch_report(self, mocker):
         ApiMocker.is_autoconfirmed(mocker)
@@ -717,7 +1011,60 @@ class ViewsTest(TestCase):
             f"""{pk},0,set_statement,Done,,,Q1234,Q1234|P2|Q1\\r\\n"""
             f"""{pk},1,set_label,Done,,,Q11,"Q11|Len|""label""\"\\r\\n\'"""
         )
-        self.assertEqual(result, str(response.content).strip())
+        content = b"".join(response.streaming_content)
+        self.assertEqual(result, str(content).strip())
+
+        response = self.client.get(f"/batch/{pk}/report/?gzip=1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "application/gzip")
+        self.assertEqual(
+            response.headers["Content-Disposition"],
+            f'attachment; filename="batch-{pk}-report.csv.gz"',
+        )
+        chunks = list(response.streaming_content)
+        self.assertEqual(gzip.decompress(b"".join(chunks)), content)
+        self.assertTrue(all(chunks))
+        # The header can be decompressed as soon as it arrives
+        header = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS).decompress(chunks[0])
+        self.assertEqual(header, content.splitlines(keepends=True)[0])
+
+    def test_batch_report_streams_in_chunks(self):
+        user = User.objects.create_user(username="wikiuser")
+        self.client.force_login(user)
+        batch = Batch.objects.create(
+            name="batch", user="wikiuser", status=Batch.STATUS_DONE
+        )
+        BatchCommand.objects.bulk_create(
+            BatchCommand(batch=batch, index=index, raw=f"Q{index}|Len|x", json={})
+            for index in range(1200)
+        )
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"/batch/{batch.pk}/report/")
+            chunks = iter(response.streaming_content)
+            header = next(chunks)
+            # The header is sent before reading any command
+            self.assertEqual(
+                header,
+                b"batch_id,index,operation,status,error,message,entity_id,raw_input\r\n",
+            )
+            queries = [q["sql"] for q in context.captured_queries]
+            self.assertFalse([sql for sql in queries if "core_batchcommand" in sql])
+            chunks = list(chunks)
+        self.assertEqual(len(chunks), 3)
+        lines = b"".join(chunks).decode().splitlines()
+        self.assertEqual(len(lines), 1200)
+        self.assertEqual(lines[-1], f"{batch.pk},1199,,Initial,,,,Q1199|Len|x")
+
+    def test_batch_summary_does_not_count_commands(self):
+        batch = Batch.objects.create(name="batch", user="user")
+        for index in range(10):
+            BatchCommand.objects.create(batch=batch, index=index, raw="", json={})
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(f"/batch/{batch.pk}/summary/")
+        self.assertEqual(response.context["total_count"], 10)
+        self.assertEqual(response.context["initial_count"], 10)
+        queries = [q["sql"] for q in context.captured_queries]
+        self.assertFalse([sql for sql in queries if "core_batchcommand" in sql])
 
     @requests_mock.Mocker()
     def test_batch_summary(self, mocker):
@@ -1094,3 +1441,96 @@ class ViewsTest(TestCase):
         # Test as not authenticated user
         response = checks_user_report_access(None, authorized=False)
         self.assertEqual(response.status_code, 403)
+
+
+@override_settings(BATCH_EVENTS_POLL_SECONDS=0.01, BATCH_EVENTS_KEEPALIVE_SECONDS=5)
+class BatchEventsTest(TestCase):
+    def events(self, chunks):
+        """Parses the server-sent events in the chunks"""
+        events = []
+        for chunk in chunks:
+            lines = dict(line.split(": ", 1) for line in chunk.decode().split("\n") if line)
+            if "event" in lines:
+                events.append((lines["event"], json.loads(lines["data"])))
+        return events
+
+    def test_events_need_asgi(self):
+        batch = Batch.objects.create(name="batch", user="user")
+        response = self.client.get(f"/batch/{batch.pk}/events/")
+        self.assertEqual(response.status_code, 204)
+
+    async def test_events_of_unknown_batch(self):
+        response = await self.async_client.get("/batch/1234/events/")
+        self.assertEqual(response.status_code, 204)
+
+    async def test_events_send_changes(self):
+        batch = await Batch.objects.acreate(
+            name="batch", user="user", status=Batch.STATUS_RUNNING, total_commands=2
+        )
+        batches = Batch.objects.filter(pk=batch.pk)
+        await batches.aupdate(initial_commands=2)
+
+        response = await self.async_client.get(f"/batch/{batch.pk}/events/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b"retry: 5000\n\n")
+        self.assertEqual(
+            self.events([await anext(chunks)]),
+            [
+                (
+                    "progress",
+                    {
+                        "status": Batch.STATUS_RUNNING,
+                        "initial_commands": 2,
+                        "running_commands": 0,
+                        "done_commands": 0,
+                        "error_commands": 0,
+                        "total_commands": 2,
+                    },
+                )
+            ],
+        )
+
+        await batches.aupdate(initial_commands=1, done_commands=1)
+        self.assertEqual(
+            self.events([await anext(chunks)]),
+            [("progress", {"initial_commands": 1, "done_commands": 1})],
+        )
+
+        await batches.aupdate(
+            status=Batch.STATUS_DONE, initial_commands=0, done_commands=2
+        )
+        remaining = [chunk async for chunk in chunks]
+        self.assertEqual(
+            self.events(remaining),
+            [
+                (
+                    "progress",
+                    {
+                        "status": Batch.STATUS_DONE,
+                        "initial_commands": 0,
+                        "done_commands": 2,
+                    },
+                ),
+                ("end", {"status": Batch.STATUS_DONE}),
+            ],
+        )
+        self.assertEqual(events.watches, {})
+
+    @override_settings(BATCH_EVENTS_KEEPALIVE_SECONDS=0.05)
+    async def test_streams_share_the_batch_reads(self):
+        batch = await Batch.objects.acreate(name="batch", user="user")
+        streams = [aiter(events.progress_events(batch.pk)) for _ in range(10)]
+        for stream in streams:
+            await anext(stream)  # retry
+            await anext(stream)  # progress
+        self.assertEqual(list(events.watches), [batch.pk])
+        self.assertEqual(events.watches[batch.pk].streams, 10)
+
+        # Without changes, only comments are sent
+        self.assertEqual(await anext(streams[0]), ": keep-alive\n\n")
+
+        for stream in streams:
+            await stream.aclose()
+        self.assertEqual(events.watches, {})
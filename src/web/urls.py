@@ -7,10 +7,12 @@ from .views.auth import oauth_redirect
 from .views.auth import oauth_callback
 from .views.batch import batch
 from .views.batch import batch_commands
+from .views.batch import batch_events
 from .views.batch import batch_stop
 from .views.batch import batch_restart
 from .views.batch import batch_report
 from .views.batch import batch_summary
+from .views.batch import entity_labels
 from .views.batches import home
 from .views.batches import last_batches
 from .views.batches import last_batches_by_user
@@ -18,6 +20,7 @@ from .views.new_batch import batch_allow_start
 from .views.new_batch import new_batch
 from .views.new_batch import preview_batch
 from .views.new_batch import preview_batch_commands
+from .views.new_batch import preview_batch_progress
 from .views.profile import profile
 
 
@@ -38,6 +41,8 @@ urlpatterns = [
     path("batch/<int:pk>/report/", batch_report, name="batch_report"),
     path("batch/<int:pk>/summary/", batch_summary, name="batch_summary"),
     path("batch/<int:pk>/commands/", batch_commands, name="batch_commands"),
+    path("batch/<int:pk>/events/", batch_events, name="batch_events"),
+    path("batch/labels/", entity_labels, name="entity_labels"),
     path("batch/new/", new_batch, name="new_batch"),
     path("batch/new/preview/", preview_batch, name="preview_batch"),
     path(
@@ -45,5 +50,10 @@ urlpatterns = [
         preview_batch_commands,
         name="preview_batch_commands",
     ),
+    path(
+        "batch/new/preview/progress/",
+        preview_batch_progress,
+        name="preview_batch_progress",
+    ),
     path("batch/new/preview/allow_start/", batch_allow_start, name="batch_allow_start"),
 ]
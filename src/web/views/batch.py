@@ -1,10 +1,16 @@
-from django.core.paginator import Paginator
+import csv
+import io
+import zlib
+
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import redirect
 from django.shortcuts import render
 from django.urls import reverse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.http import require_GET
 from django.http import HttpResponse
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
 
 from core.client import Client
 from core.models import Batch
@@ -13,7 +19,10 @@ from core.exceptions import NoToken
 from core.exceptions import UnauthorizedToken
 from core.exceptions import ServerError
 
+from web.events import progress_events
 from web.models import Preferences
+from web.paginators import index_page
+from web.paginators import parse_index
 
 from .auth import logout_per_token_expired
 
@@ -32,7 +41,7 @@ def batch(request, pk):
     Used for ajax calls
     """
     try:
-        batch = Batch.objects.get(pk=pk)
+        batch = Batch.objects.visible().get(pk=pk)
         user_is_authorized = (
             request.user.is_authenticated and
             (request.user.username == batch.user or request.user.is_superuser)
@@ -62,7 +71,7 @@ def batch_stop(request, pk):
     Used for ajax calls
     """
     try:
-        batch = Batch.objects.get(pk=pk)
+        batch = Batch.objects.visible().get(pk=pk)
         user_is_authorized = (
             request.user.is_authenticated and
             (request.user.username == batch.user or request.user.is_superuser)
@@ -87,7 +96,7 @@ def batch_restart(request, pk):
     Allows a batch that is in the preview state to start running.
     """
     try:
-        batch = Batch.objects.get(pk=pk)
+        batch = Batch.objects.visible().get(pk=pk)
         user_is_authorized = (
             request.user.is_authenticated and
             (request.user.username == batch.user or request.user.is_superuser)
@@ -101,8 +110,46 @@ def batch_restart(request, pk):
         return HttpResponse("403 Forbidden", status=403)
 
 
+# Rows written to the csv buffer before sending it to the client
+REPORT_ROWS_PER_CHUNK = 500
+
+
+def report_chunks(batch, compress=False):
+    """
+    Yields the batch report as csv, `REPORT_ROWS_PER_CHUNK` rows at
+    a time, compressed with gzip when `compress` is True.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    gzip = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    rows = 0
+    for row in batch.report_rows():
+        writer.writerow(row)
+        rows += 1
+        if rows % REPORT_ROWS_PER_CHUNK == 1:
+            # The first chunk is only the header, sent right away
+            data = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            if gzip:
+                data = gzip.compress(data)
+                if rows == 1:
+                    # Otherwise kept by the compressor until it has more
+                    data += gzip.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+    data = buffer.getvalue().encode("utf-8")
+    if gzip:
+        data = gzip.compress(data) + gzip.flush()
+    if data:
+        yield data
+
+
 @require_GET
 def batch_report(request, pk):
+    """
+    Streams the batch report as csv, or as gzipped csv with `?gzip=1`.
+    """
     try:
         batch = Batch.objects.get(pk=pk, status=Batch.STATUS_DONE)
         user_is_authorized = (
@@ -110,14 +157,13 @@ def batch_report(request, pk):
             (request.user.username == batch.user or request.user.is_superuser)
         )
         assert user_is_authorized
-        res = HttpResponse(
-            content_type="text/csv",
-            headers={
-                "Content-Disposition": f'attachment; filename="batch-{pk}-report.csv"'
-                },
+        compress = request.GET.get("gzip") == "1"
+        filename = f"batch-{pk}-report.csv.gz" if compress else f"batch-{pk}-report.csv"
+        return StreamingHttpResponse(
+            report_chunks(batch, compress),
+            content_type="application/gzip" if compress else "text/csv",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
         )
-        batch.write_report(res)
-        return res
     except Batch.DoesNotExist:
         return render(request, "batch_not_found.html", {"pk": pk}, status=404)
     except AssertionError:
@@ -134,32 +180,38 @@ def batch_commands(request, pk):
     RETURNS fragment page with PAGINATED COMMANDs FOR A GIVEN BATCH ID
     Used for ajax calls
     """
-    try:
-        page = int(request.GET.get("page", 1))
-    except (TypeError, ValueError):
-        page = 1
-
     only_errors = int(request.GET.get("show_errors", 0)) == 1
 
     filters = {"batch__pk": pk}
     if only_errors:
         filters["status"] = BatchCommand.STATUS_ERROR
 
-    paginator = Paginator(
-        BatchCommand.objects.filter(**filters).order_by("index"), PAGE_SIZE
+    # The batch counters give the total without counting the commands
+    counter = "error_commands" if only_errors else "total_commands"
+    # Previews are only shown to their owner, by the preview page
+    total = Batch.objects.visible().filter(pk=pk).values_list(counter, flat=True).first()
+    if total is None:
+        return render(request, "batch_not_found.html", {"pk": pk}, status=404)
+
+    page = index_page(
+        BatchCommand.objects.filter(**filters),
+        PAGE_SIZE,
+        total,
+        after=parse_index(request.GET.get("after")),
+        before=parse_index(request.GET.get("before")),
+        last=request.GET.get("last") == "1",
     )
-    page = paginator.page(page)
 
+    # Labels that are not cached are loaded by the page afterwards
+    missing_labels = []
     if request.user.is_authenticated:
         try:
             language = Preferences.objects.get_language(request.user, "en")
             client = Client.from_user(request.user)
-            BatchCommand.load_labels(client, page.object_list, language)
-        except UnauthorizedToken:
-            # logout but do not return 302, since this
-            # is called through HMTX
-            logout_per_token_expired(request)
-        except (NoToken, ServerError):
+            missing_labels = BatchCommand.load_labels(
+                client, page.object_list, language, cached_only=True
+            )
+        except NoToken:
             pass
 
     base_url = reverse("batch_commands", args=[pk])
@@ -171,10 +223,59 @@ def batch_commands(request, pk):
             "batch_pk": pk,
             "only_errors": only_errors,
             "base_url": base_url,
+            "missing_labels": missing_labels,
         },
     )
 
 
+# Entity ids accepted by each labels request
+MAX_LABELS_PER_REQUEST = 100
+
+
+@require_GET
+def entity_labels(request):
+    """
+    Returns the labels of the entity ids in `ids`, separated by "|",
+    as a JSON object, in the language of the user.
+
+    Used by the command fragments to fill in the labels
+    that were not cached when they were rendered.
+    """
+    ids = [id for id in request.GET.get("ids", "").split("|") if id]
+    labels = {}
+    if request.user.is_authenticated and ids:
+        try:
+            language = Preferences.objects.get_language(request.user, "en")
+            client = Client.from_user(request.user)
+            labels = client.get_labels(ids[:MAX_LABELS_PER_REQUEST], language)
+        except UnauthorizedToken:
+            # logout but do not return 302, since this
+            # is called by the commands fragment
+            logout_per_token_expired(request)
+        except (NoToken, ServerError):
+            pass
+    return JsonResponse(labels)
+
+
+@require_GET
+async def batch_events(request, pk):
+    """
+    Streams the progress of a batch as server-sent events.
+
+    Streaming needs the ASGI application: behind WSGI it answers
+    204 No Content, so the page keeps polling the summary instead.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+    if not await Batch.objects.visible().filter(pk=pk).aexists():
+        return HttpResponse(status=204)
+    return StreamingHttpResponse(
+        progress_events(pk),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @require_http_methods(
     [
         "GET",
@@ -191,28 +292,8 @@ def batch_summary(request, pk):
     INITIAL COMMANDS
     """
     try:
-        from django.db.models import Q, Count
-
-        error_commands = Count(
-            "batchcommand", filter=Q(batchcommand__status=BatchCommand.STATUS_ERROR)
-        )
-        initial_commands = Count(
-            "batchcommand", filter=Q(batchcommand__status=BatchCommand.STATUS_INITIAL)
-        )
-        running_commands = Count(
-            "batchcommand", filter=Q(batchcommand__status=BatchCommand.STATUS_RUNNING)
-        )
-        done_commands = Count(
-            "batchcommand", filter=Q(batchcommand__status=BatchCommand.STATUS_DONE)
-        )
-        batch = (
-            Batch.objects.annotate(error_commands=error_commands)
-            .annotate(initial_commands=initial_commands)
-            .annotate(running_commands=running_commands)
-            .annotate(done_commands=done_commands)
-            .annotate(total_commands=Count("batchcommand"))
-            .get(pk=pk)
-        )
+        # The command counters are kept in the batch
+        batch = Batch.objects.visible().get(pk=pk)
         show_block_on_errors_notice = (
             batch.is_preview_initial_or_running and batch.block_on_errors
         )
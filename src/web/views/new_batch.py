@@ -1,7 +1,9 @@
 from datetime import datetime
 
-from django.core.paginator import Paginator
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.core.files.base import ContentFile
+from django.http import JsonResponse
 from django.shortcuts import redirect
 from django.shortcuts import render
 from django.urls import reverse
@@ -9,17 +11,20 @@ from django.views.decorators.http import require_http_methods
 from django.utils.translation import gettext as _
 
 from core.client import Client
+from core.models import Batch
 from core.models import BatchCommand
+from core.models import BatchImport
 from core.parsers.base import ParserException
-from core.parsers.v1 import V1CommandParser
-from core.parsers.csv import CSVCommandParser
+from core.parsers.imports import get_parser
+from core.parsers.uploads import open_upload
+from core.parsers.uploads import upload_size
 from core.exceptions import NoToken
 from core.exceptions import UnauthorizedToken
 from core.exceptions import ServerError
 
-from django.core import serializers
-
 from web.models import Preferences
+from web.paginators import index_page
+from web.paginators import parse_index
 
 from .auth import logout_per_token_expired
 
@@ -27,6 +32,31 @@ from .auth import logout_per_token_expired
 PAGE_SIZE = 30
 
 
+def get_preview(request):
+    """
+    Returns the batch saved as a preview by `new_batch` for the
+    current session, or None when it was already started or deleted.
+    """
+    pk = request.session.get("preview_batch_pk")
+    if pk is None or not request.user.is_authenticated:
+        return None
+    return Batch.objects.filter(
+        pk=pk, user=request.user.username, status=Batch.STATUS_PREVIEW
+    ).first()
+
+
+def get_import(batch):
+    """
+    Returns the import of a preview parsed by the workers,
+    or None when it was parsed in the request.
+    """
+    return BatchImport.objects.filter(batch=batch).first()
+
+
+def is_first_page_ready(batch, batch_import):
+    return batch_import is None or batch_import.is_done or batch.total_commands >= PAGE_SIZE
+
+
 @require_http_methods(["GET"])
 def preview_batch(request):
     """
@@ -34,21 +64,8 @@ def preview_batch(request):
     Used for ajax calls
     """
 
-    preview_batch = request.session.get("preview_batch")
-    if preview_batch:
-        total_count = 0
-        initial_count = 0
-        error_count = 0
-        batch = list(serializers.deserialize("json", preview_batch))[0]
-        preview_batch_commands = request.session.get("preview_commands", "[]")
-        batch_commands = list(serializers.deserialize("json", preview_batch_commands))
-        for bc in batch_commands:
-            total_count += 1
-            if bc.object.status == BatchCommand.STATUS_ERROR:
-                error_count += 1
-            else:
-                initial_count += 1
-
+    batch = get_preview(request)
+    if batch:
         is_autoconfirmed = None
         try:
             client = Client.from_user(request.user)
@@ -60,17 +77,21 @@ def preview_batch(request):
             is_autoconfirmed = False
             is_blocked = False
 
+        batch_import = get_import(batch)
         return render(
             request,
             "preview_batch.html",
             {
-                "batch": batch.object,
+                "batch": batch,
+                "batch_import": batch_import,
+                "importing": batch_import is not None and not batch_import.is_done,
+                "first_page_ready": is_first_page_ready(batch, batch_import),
                 "current_owner": True,
                 "is_autoconfirmed": is_autoconfirmed,
                 "is_blocked": is_blocked,
-                "total_count": total_count,
-                "initial_count": initial_count,
-                "error_count": error_count,
+                "total_count": batch.total_commands,
+                "initial_count": batch.initial_commands,
+                "error_count": batch.error_commands,
             },
         )
     else:
@@ -83,40 +104,60 @@ def preview_batch_commands(request):
     RETURNS fragment page with PAGINATED COMMANDs FOR A GIVEN BATCH ID
     Used for ajax calls
     """
-    preview_batch_commands = request.session.get("preview_commands")
-    if preview_batch_commands:
-        batch_commands = list(serializers.deserialize("json", preview_batch_commands))
+    batch = get_preview(request)
+    if batch is None:
+        return render(request, "batch_not_found.html", status=404)
 
-        try:
-            page = int(request.GET.get("page", 1))
-        except (TypeError, ValueError):
-            page = 1
-
-        only_errors = int(request.GET.get("show_errors", 0)) == 1
-        if only_errors:
-            batch_commands = [
-                bc
-                for bc in batch_commands
-                if bc.object.status == BatchCommand.STATUS_ERROR
-            ]
-
-        paginator = Paginator(batch_commands, PAGE_SIZE)
-        page = paginator.page(page)
-        page.object_list = [d.object for d in page.object_list]
-
-        if request.user.is_authenticated:
-            client = Client.from_user(request.user)
-            language = Preferences.objects.get_language(request.user, "en")
-            BatchCommand.load_labels(client, page.object_list, language)
+    only_errors = int(request.GET.get("show_errors", 0)) == 1
+    queryset = BatchCommand.objects.filter(batch=batch)
+    if only_errors:
+        queryset = queryset.filter(status=BatchCommand.STATUS_ERROR)
+
+    page = index_page(
+        queryset,
+        PAGE_SIZE,
+        batch.error_commands if only_errors else batch.total_commands,
+        after=parse_index(request.GET.get("after")),
+        before=parse_index(request.GET.get("before")),
+        last=request.GET.get("last") == "1",
+    )
+
+    # Labels that are not cached are loaded by the page afterwards
+    client = Client.from_user(request.user)
+    language = Preferences.objects.get_language(request.user, "en")
+    missing_labels = BatchCommand.load_labels(
+        client, page.object_list, language, cached_only=True
+    )
 
     base_url = reverse("preview_batch_commands")
     return render(
         request,
         "batch_commands.html",
-        {"page": page, "only_errors": only_errors, "base_url": base_url},
+        {
+            "page": page,
+            "only_errors": only_errors,
+            "base_url": base_url,
+            "missing_labels": missing_labels,
+        },
     )
 
 
+@require_http_methods(["GET"])
+def preview_batch_progress(request):
+    """
+    RETURNS THE PROGRESS OF THE IMPORT OF THE PREVIEW, AS JSON
+    Used for ajax calls while the workers parse a large batch
+    """
+    batch = get_preview(request)
+    batch_import = get_import(batch) if batch else None
+    if batch_import is None:
+        return JsonResponse({"error": "not found"}, status=404)
+    batch_import.batch = batch
+    progress = batch_import.progress()
+    progress["first_page_ready"] = is_first_page_ready(batch, batch_import)
+    return JsonResponse(progress)
+
+
 @login_required()
 def new_batch(request):
     """
@@ -126,7 +167,8 @@ def new_batch(request):
     if request.method == "POST":
         try:
             batch_owner = request.user.username
-            batch_commands = request.POST.get("commands")
+            batch_commands = request.POST.get("commands", "")
+            batch_file = request.FILES.get("file")
             batch_name = request.POST.get(
                 "name", f"Batch  user:{batch_owner} {datetime.now().isoformat()}"
             )
@@ -134,33 +176,45 @@ def new_batch(request):
             request.session["preferred_batch_type"] = batch_type
 
             batch_commands = batch_commands.strip()
-            if not batch_commands:
+            if not batch_commands and batch_file is None:
                 raise ParserException("Command string cannot be empty")
 
             batch_name = batch_name.strip()
 
-            if batch_type == "v1":
-                parser = V1CommandParser()
-            else:
-                parser = CSVCommandParser()
-
-            batch = parser.parse(batch_name, batch_owner, batch_commands)
-
-            batch.status = batch.STATUS_PREVIEW
-            batch.block_on_errors = "block_on_errors" in request.POST
-            batch.combine_commands = "do_not_combine_commands" not in request.POST
-
-            serialized_batch = serializers.serialize("json", [batch])
-            serialized_commands = serializers.serialize(
-                "json", batch.get_preview_commands()
+            batch = Batch(
+                name=batch_name,
+                user=batch_owner,
+                block_on_errors="block_on_errors" in request.POST,
+                combine_commands="do_not_combine_commands" not in request.POST,
             )
 
-            request.session["preview_batch"] = serialized_batch
-            request.session["preview_commands"] = serialized_commands
+            # Saved to be paginated and started without parsing it again.
+            # Previews that are never started are deleted by the workers.
+            # The commands are saved as they are parsed.
+            if batch_file is not None:
+                # Decoded chunk by chunk, as it is parsed
+                source = open_upload(batch_file)
+                size = upload_size(batch_file)
+            else:
+                source = batch_commands
+                size = len(batch_commands)
+
+            if size >= settings.BATCH_IMPORT_MIN_SIZE:
+                # Too large to be parsed in the request: the workers parse it,
+                # from a file stored as it was uploaded, compressed or not
+                if batch_file is None:
+                    batch_file = ContentFile(batch_commands.encode("utf-8"), "commands.txt")
+                BatchImport.objects.submit(batch, batch_type, batch_file)
+            else:
+                parser = get_parser(batch_type)
+                batch.save_preview(parser.iter_commands(source, batch))
+            request.session["preview_batch_pk"] = batch.pk
 
             return redirect(reverse("preview_batch"))
         except ParserException as p:
             error = p.message
+        except UnicodeDecodeError:
+            error = "The file must be encoded in UTF-8"
         except Exception as p:
             error = str(p)
         return render(
@@ -231,24 +285,13 @@ def batch_allow_start(request):
             },
         )
 
-    try:
-        preview_batch = request.session.get("preview_batch")
-        if preview_batch:
-
-            batch = list(serializers.deserialize("json", preview_batch))[0].object
-
-            preview_batch_commands = request.session.get("preview_commands", "[]")
-            for batch_command in serializers.deserialize(
-                "json", preview_batch_commands
-            ):
-                batch.add_preview_command(batch_command.object)
-            batch.save_batch_and_preview_commands()
-
-            del request.session["preview_batch"]
-            del request.session["preview_commands"]
-
-            return redirect(reverse("batch", args=[batch.pk]))
-        else:
-            return redirect(reverse("new_batch"))
-    except Exception:
-        return render(request, "batch_not_found.html", status=404)
+    batch = get_preview(request)
+    if batch is None:
+        return redirect(reverse("new_batch"))
+    batch_import = get_import(batch)
+    if batch_import is not None and not batch_import.is_done:
+        return redirect(reverse("preview_batch"))
+    if not batch.allow_start():
+        return render(request, "batch_not_found.html", {"pk": batch.pk}, status=404)
+    del request.session["preview_batch_pk"]
+    return redirect(reverse("batch", args=[batch.pk]))